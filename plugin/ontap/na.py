@@ -14,9 +14,14 @@
 #
 # Author: tasleson
 
+import base64
+import select
 import socket
 import sys
+import threading
+import unittest
 import six
+from six.moves import http_client, BaseHTTPServer, socketserver
 from xml.etree import ElementTree
 import time
 from binascii import hexlify
@@ -28,24 +33,10 @@
     long = int
 
 try:
-    from urllib.request import (Request,
-                                urlopen,
-                                HTTPPasswordMgrWithDefaultRealm,
-                                HTTPBasicAuthHandler,
-                                HTTPSHandler,
-                                build_opener,
-                                install_opener)
     from urllib.error import (URLError, HTTPError)
     from urllib.parse import urlparse
 except ImportError:
-    from urllib2 import (Request,
-                         urlopen,
-                         HTTPPasswordMgrWithDefaultRealm,
-                         HTTPBasicAuthHandler,
-                         HTTPSHandler,
-                         build_opener,
-                         install_opener,
-                         URLError,
+    from urllib2 import (URLError,
                          HTTPError)
     from urlparse import urlparse
 
@@ -53,6 +44,8 @@
 # Set to an appropriate directory and file to dump the raw response.
 xml_debug = ""
 
+_ZAPI_PATH = "/servlets/netapp.servlets.admin.XMLrequest_filer"
+
 
 def netapp_filer_parse_response(resp):
     if xml_debug:
@@ -79,47 +72,147 @@ def param_value(val):
     return rc
 
 
-def netapp_filer(host, username, password, timeout, command, parameters=None,
-                 use_ssl=False, ssl_verify=False, ca_cert=None):
+def _ssl_context(ssl_verify, ca_cert):
+    ssl._DEFAULT_CIPHERS += ':RC4-SHA:3DES'
+    ssl._DEFAULT_CIPHERS = ssl._DEFAULT_CIPHERS.replace(':!3DES','')
+
+    if ca_cert:
+        try:
+            ssl_ctx = ssl.create_default_context(cafile=ca_cert)
+        except IOError as ioe:
+            raise LsmError(ErrorNumber.INVALID_ARGUMENT,
+                           "Failed to load CA file : %s" % str(ioe))
+    else:
+        ssl_ctx = ssl.create_default_context()
+
+    if ssl_verify == False:
+        ssl_ctx.check_hostname = False
+        ssl_ctx.verify_mode = ssl.CERT_NONE
+    return ssl_ctx
+
+
+class ConnectionPool(object):
     """
-    Issue a command to the NetApp filer.
-    Note: Change to default use_ssl on before we ship a release version.
+    Thread safe pool of keep-alive HTTP(S) connections to the filer, so that
+    each ZAPI call does not pay a new TCP and TLS handshake. The SSL context
+    is created once and shared by all connections.
     """
-    proto = 'http'
-    if use_ssl:
-        proto = 'https'
+    # Maximum number of idle connections kept open.
+    MAX_IDLE = 4
+
+    def __init__(self, host, use_ssl=False, ssl_verify=False, ca_cert=None):
+        self.host = host
+        self.use_ssl = use_ssl
+        self._ssl_ctx = None
+        if use_ssl:
+            self._ssl_ctx = _ssl_context(ssl_verify, ca_cert)
+        self._lock = threading.Lock()
+        self._idle = []
 
-    url = "%s://%s/servlets/netapp.servlets.admin.XMLrequest_filer" % \
-          (proto, host)
+    @staticmethod
+    def _dropped(conn):
+        """
+        Return True if the idle connection was closed by the filer. An idle
+        connection has nothing to read unless the filer closed it.
+        """
+        if conn.sock is None:
+            return True
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
 
-    req = Request(url)
-    req.add_header('Content-Type', 'text/xml')
+    def get(self, timeout):
+        """
+        Return (connection, reused), reused is True if the connection was
+        already used by a previous call.
+        """
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                break
+            if ConnectionPool._dropped(conn):
+                conn.close()
+                continue
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+            return conn, True
+        if self.use_ssl:
+            return http_client.HTTPSConnection(
+                self.host, timeout=timeout, context=self._ssl_ctx), False
+        return http_client.HTTPConnection(self.host, timeout=timeout), False
+
+    def put(self, conn):
+        """
+        Return a connection with its response fully read to the pool.
+        """
+        with self._lock:
+            if len(self._idle) < ConnectionPool.MAX_IDLE:
+                self._idle.append(conn)
+                return
+        conn.close()
 
-    password_manager = HTTPPasswordMgrWithDefaultRealm()
-    password_manager.add_password(None, url, username, password)
-    auth_manager = HTTPBasicAuthHandler(password_manager)
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            conn.close()
 
-    if use_ssl:
-        ssl._DEFAULT_CIPHERS += ':RC4-SHA:3DES'
-        ssl._DEFAULT_CIPHERS = ssl._DEFAULT_CIPHERS.replace(':!3DES','')
 
-        if ca_cert:
+def _http_post(conn_pool, url, username, password, timeout, data):
+    """
+    POST data using a connection of the pool and return (status, body).
+    Like urlopen(), HTTP errors are raised as HTTPError and errors before
+    the request is sent are raised as URLError. A connection closed by the
+    filer while idle in the pool is replaced by a new one. ZAPI commands
+    are not idempotent, so the command is only sent again when sending it
+    on a reused connection failed, never once the filer could have
+    received it.
+    """
+    headers = {
+        'Content-Type': 'text/xml',
+        'Authorization': 'Basic %s' % base64.b64encode(
+            ("%s:%s" % (username, password)).encode('utf-8')).decode('ascii'),
+    }
+    while True:
+        (conn, reused) = conn_pool.get(timeout)
+        try:
             try:
-                ssl_ctx = ssl.create_default_context(cafile=ca_cert)
-            except IOError as ioe:
-                raise LsmError(ErrorNumber.INVALID_ARGUMENT,
-                               "Failed to load CA file : %s" % str(ioe))
+                conn.request('POST', _ZAPI_PATH, data, headers)
+            except (socket.error, http_client.HTTPException) as err:
+                if reused and not isinstance(err, socket.timeout):
+                    conn.close()
+                    continue
+                raise URLError(err)
+            resp = conn.getresponse()
+            body = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
         else:
-            ssl_ctx = ssl.create_default_context()
+            conn_pool.put(conn)
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, resp.msg, None)
+        return resp.status, body
 
-        if ssl_verify == False:
-            ssl_ctx.check_hostname = False
-            ssl_ctx.verify_mode = ssl.CERT_NONE
 
-        opener = build_opener(HTTPSHandler(context=ssl_ctx), auth_manager)
-    else:
-        opener = build_opener(auth_manager)
-    install_opener(opener)
+def netapp_filer(host, username, password, timeout, command, parameters=None,
+                 use_ssl=False, ssl_verify=False, ca_cert=None,
+                 conn_pool=None):
+    """
+    Issue a command to the NetApp filer.
+    Note: Change to default use_ssl on before we ship a release version.
+    Without 'conn_pool', a new connection is used for this command only.
+    """
+    proto = 'http'
+    if use_ssl:
+        proto = 'https'
+
+    url = "%s://%s%s" % (proto, host, _ZAPI_PATH)
 
     # build the command and the arguments for it
     p = ""
@@ -137,13 +230,18 @@ def netapp_filer(host, username, password, timeout, command, parameters=None,
 </netapp>
 """ % payload
 
-    handler = None
+    own_pool = conn_pool is None
+    if own_pool:
+        conn_pool = ConnectionPool(host, use_ssl, ssl_verify, ca_cert)
+
     rc = None
     try:
-        handler = urlopen(req, data.encode('utf-8'), float(timeout))
+        (status, body) = _http_post(
+            conn_pool, url, username, password, float(timeout),
+            data.encode('utf-8'))
 
-        if handler.getcode() == 200:
-            rc = netapp_filer_parse_response(handler.read())
+        if status == 200:
+            rc = netapp_filer_parse_response(body)
     except HTTPError:
         raise
     except URLError as ue:
@@ -174,8 +272,8 @@ def netapp_filer(host, username, password, timeout, command, parameters=None,
             raise FilerError(Filer.EUNKNOWN,
                              "SSL error occurred (%s)", str(sse))
     finally:
-        if handler:
-            handler.close()
+        if own_pool:
+            conn_pool.close()
 
     return rc
 
@@ -278,6 +376,7 @@ class Filer(object):
     ESIZE_TOO_LARGE = 9034          # Specified too large a size
     ENO_SUCH_FS = 9036              # FS not found
     EVOLUME_TOO_SMALL = 9041        # Specified too small a size
+    EAPINOTFOUND = 13005            # API not found
     EAPILICENSE = 13008             # Unlicensed API
     EFSDOESNOTEXIST = 13040         # FS does not exist
     EFSOFFLINE = 13042              # FS is offline.
@@ -290,11 +389,14 @@ class Filer(object):
 
     (LSM_VOL_PREFIX, LSM_INIT_PREFIX) = ('lsm_lun_container', 'lsm_init_')
 
+    # Number of records requested by each *-iter-next call.
+    ITER_MAX_RECORDS = 500
+
     def _invoke(self, command, parameters=None):
 
         rc = netapp_filer(self.host, self.username, self.password,
                           self.timeout, command, parameters, self.use_ssl,
-                          self.ssl_verify, self.ca_cert)
+                          self.ssl_verify, self.ca_cert, self._conn_pool)
 
         t = rc['netapp']['results']['attrib']
 
@@ -312,6 +414,59 @@ def __init__(self, host, username, password, timeout, use_ssl=True,
         self.use_ssl = use_ssl
         self.ssl_verify = ssl_verify
         self.ca_cert = ca_cert
+        self._conn_pool = ConnectionPool(host, use_ssl, ssl_verify, ca_cert)
+        # Commands found without *-iter-start on this filer.
+        self._no_iter_commands = set()
+
+    def close(self):
+        """
+        Close the idle connections to the filer.
+        """
+        self._conn_pool.close()
+
+    def _invoke_iter(self, command, parameters, records_key, record_key):
+        """
+        Generator of the 'record_key' items under 'records_key' of
+        'command' reply, using the ZAPI iterator family of the command:
+            <command>-iter-start    # Return 'tag' and 'records' count
+            <command>-iter-next     # Return up to 'maximum' records
+            <command>-iter-end      # Release the 'tag'
+        so that only ITER_MAX_RECORDS records are parsed at once. If the
+        filer has no such iterator, the records of a single 'command' call
+        are returned instead.
+        """
+        if command not in self._no_iter_commands:
+            try:
+                rc = self._invoke('%s-iter-start' % command, parameters)
+            except FilerError as fe:
+                if fe.errno != Filer.EAPINOTFOUND:
+                    raise
+                self._no_iter_commands.add(command)
+
+        if command in self._no_iter_commands:
+            rc = self._invoke(command, parameters)
+            if rc[records_key]:
+                for record in to_list(rc[records_key][record_key]):
+                    yield record
+            return
+
+        tag = rc['tag']
+        try:
+            while True:
+                rc = self._invoke('%s-iter-next' % command,
+                                  {'tag': tag,
+                                   'maximum': Filer.ITER_MAX_RECORDS})
+                if int(rc['records']) == 0 or not rc.get(records_key):
+                    break
+                for record in to_list(rc[records_key][record_key]):
+                    yield record
+        finally:
+            try:
+                self._invoke('%s-iter-end' % command, {'tag': tag})
+            except Exception:
+                # Do not hide the original error, the filer will expire
+                # the tag anyway.
+                pass
 
     def system_info(self):
         rc = self._invoke('system-get-info')
@@ -384,11 +539,13 @@ def luns_get_all(self):
         """
         Return all lun-info
         """
-        try:
-            return to_list(self._invoke('lun-list-info')['luns']['lun-info'])
-        except TypeError:
-            # No LUN found.
-            return []
+        return list(self.luns_iter())
+
+    def luns_iter(self):
+        """
+        Generator of all lun-info
+        """
+        return self._invoke_iter('lun-list-info', None, 'luns', 'lun-info')
 
     def lun_min_size(self):
         return self._invoke('lun-get-minsize', {'type': 'image'})['min-size']
@@ -439,14 +596,20 @@ def volumes(self, volume_name=None):
         Return a list of NetApp volumes
         """
         if not volume_name:
-            v = self._invoke('volume-list-info')
-        else:
-            v = self._invoke('volume-list-info', {'volume': volume_name})
+            return list(self.volumes_iter())
 
+        v = self._invoke('volume-list-info', {'volume': volume_name})
         t = v['volumes']['volume-info']
         rc = to_list(t)
         return rc
 
+    def volumes_iter(self):
+        """
+        Generator of all NetApp volumes
+        """
+        return self._invoke_iter(
+            'volume-list-info', None, 'volumes', 'volume-info')
+
     def volume_create(self, aggr_name, vol_name, size_in_bytes):
         """
         Creates a volume given an aggr_name, volume name and size in bytes.
@@ -576,18 +739,24 @@ def lun_offline(self, lun_path):
         self._invoke('lun-offline', {'path': lun_path})
 
     def igroups(self, group_name=None):
-        rc = []
-
-        if group_name:
-            g = self._invoke('igroup-list-info',
-                             {'initiator-group-name': group_name})
-        else:
-            g = self._invoke('igroup-list-info')
+        if not group_name:
+            return list(self.igroups_iter())
 
+        rc = []
+        g = self._invoke('igroup-list-info',
+                         {'initiator-group-name': group_name})
         if g['initiator-groups']:
             rc = to_list(g['initiator-groups']['initiator-group-info'])
         return rc
 
+    def igroups_iter(self):
+        """
+        Generator of all initiator-group-info
+        """
+        return self._invoke_iter(
+            'igroup-list-info', None, 'initiator-groups',
+            'initiator-group-info')
+
     def igroup_create(self, name, igroup_type):
         params = {'initiator-group-name': name,
                   'initiator-group-type': igroup_type}
@@ -668,12 +837,15 @@ def lun_initiator_list_map_info(self, initiator_id, initiator_group_name):
         return luns
 
     def snapshots(self, volume_name):
-        rc = []
+        return list(self.snapshots_iter(volume_name))
+
+    def snapshots_iter(self, volume_name):
+        """
+        Generator of snapshot-info of given NetApp volume
+        """
         args = {'target-type': 'volume', 'target-name': volume_name}
-        ss = self._invoke('snapshot-list-info', args)
-        if ss['snapshots']:
-            rc = to_list(ss['snapshots']['snapshot-info'])
-        return rc
+        return self._invoke_iter(
+            'snapshot-list-info', args, 'snapshots', 'snapshot-info')
 
     def snapshot_create(self, volume_name, snapshot_name):
         self._invoke('snapshot-create', {'volume': volume_name,
@@ -922,10 +1094,94 @@ def iscsi_list(self):
 
         return i_list
 
-if __name__ == '__main__':
-    try:
-        # TODO: Need some unit test code
+
+_TEST_SYSTEM_INFO = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<netapp version="1.1" xmlns="http://www.netapp.com/filer/admin">'
+    '<results status="passed"><system-info>'
+    '<system-name>test</system-name></system-info></results></netapp>')
+
+
+class _TestFilerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Keep-alive connections idle for more than 'timeout' seconds are closed,
+    like a filer does.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 0.1
+
+    def log_message(self, *args):
         pass
 
-    except FilerError as fe:
-        print('Errno=', fe.errno, 'reason=', fe.reason)
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        if self.server.requests in self.server.drop_requests:
+            # Filer received the command but the connection is lost.
+            self.close_connection = True
+            return
+        data = _TEST_SYSTEM_INFO.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _TestFiler(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), _TestFilerHandler)
+        self.connections = 0
+        self.requests = 0
+        self.drop_requests = []
+
+
+class _TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = _TestFiler()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.filer = Filer('127.0.0.1:%d' % self.server.server_address[1],
+                           'root', 'password', 30, False)
+
+    def tearDown(self):
+        self.filer.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_keep_alive(self):
+        for _ in range(3):
+            self.assertEqual(self.filer.system_info()['system-name'], 'test')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_idle_closed(self):
+        self.filer.system_info()
+        # Filer closed the idle connection.
+        time.sleep(_TestFilerHandler.timeout * 3)
+        self.assertEqual(self.filer.system_info()['system-name'], 'test')
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_no_resend(self):
+        # Command received but no reply, it must not be sent again.
+        self.server.drop_requests = [2]
+        self.filer.system_info()
+        self.assertRaises((socket.error, http_client.HTTPException),
+                          self.filer.system_info)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.filer.system_info()['system-name'], 'test')
+        self.assertEqual(self.server.requests, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -163,7 +163,8 @@ def time_out_get(self, flags=0):
         return int(self.f.timeout * Ontap.TMO_CONV)
 
     def plugin_unregister(self, flags=0):
-        pass
+        if self.f is not None:
+            self.f.close()
 
     @staticmethod
     def _create_vpd(sn):
@@ -330,7 +331,7 @@ def _disk(self, d, flags=0):
 
     @handle_ontap_errors
     def volumes(self, search_key=None, search_value=None, flags=0):
-        luns = self.f.luns_get_all()
+        luns = self.f.luns_iter()
         return search_property(
             [self._lun(l) for l in luns], search_key, search_value)
 
@@ -577,7 +578,7 @@ def pools(self, search_key=None, search_value=None, flags=0):
         na_aggrs = self.f.aggregates()
         for na_aggr in na_aggrs:
             pools.extend([self._pool_from_na_aggr(na_aggr, flags)])
-        na_vols = self.f.volumes()
+        na_vols = self.f.volumes_iter()
         for na_vol in na_vols:
             pools.extend([self._pool_from_na_vol(na_vol, na_aggrs, flags)])
         return search_property(pools, search_key, search_value)
@@ -818,7 +819,7 @@ def _access_group(self, g):
 
     @handle_ontap_errors
     def access_groups(self, search_key=None, search_value=None, flags=0):
-        groups = self.f.igroups()
+        groups = self.f.igroups_iter()
         return search_property(
             [self._access_group(g) for g in groups], search_key, search_value)
 
@@ -1012,8 +1013,8 @@ def job_free(self, job_id, flags=0):
 
     @handle_ontap_errors
     def fs(self, search_key=None, search_value=None, flags=0):
-        volumes = self.f.volumes()
         pools = self.pools()
+        volumes = self.f.volumes_iter()
         return search_property(
             [self._vol(v, pools) for v in volumes], search_key, search_value)
 
@@ -1067,7 +1068,7 @@ def fs_file_clone(self, fs, src_file_name, dest_file_name, snapshot=None,
 
     @handle_ontap_errors
     def fs_snapshots(self, fs, flags=0):
-        snapshots = self.f.snapshots(fs.name)
+        snapshots = self.f.snapshots_iter(fs.name)
         return [Ontap._ss(s) for s in snapshots]
 
     @handle_ontap_errors
@@ -20,12 +20,17 @@
 import os
 import time
 import sqlite3
+import errno
+import fcntl
+import shutil
+import array
+import six
 
 
 from lsm import (size_human_2_size_bytes)
 from lsm import (System, Volume, Disk, Pool, FileSystem, AccessGroup,
                  FsSnapshot, NfsExport, md5, LsmError, TargetPort,
-                 ErrorNumber, JobStatus, Battery, int_div)
+                 ErrorNumber, JobStatus, Battery, BlockRanges, int_div)
 
 
 def _handle_errors(method):
@@ -72,6 +77,151 @@ def _dict_factory(cursor, row):
     return d
 
 
+class SimBlockRanges(object):
+    """
+    Disjoint block ranges replicated into a destination volume, kept as
+    three parallel integer arrays sorted by destination block and stored
+    as BLOBs in the vol_reps table.
+    """
+    try:
+        array.array('q')
+        _TYPE_CODE = 'q'
+    except ValueError:
+        _TYPE_CODE = 'l'
+
+    def __init__(self, src_blocks, dst_blocks, block_counts):
+        self.src_blocks = src_blocks
+        self.dst_blocks = dst_blocks
+        self.block_counts = block_counts
+
+    @staticmethod
+    def _invalid(msg):
+        return LsmError(ErrorNumber.INVALID_ARGUMENT, msg)
+
+    @staticmethod
+    def validated(src_blocks, dst_blocks, block_counts, src_vol_blocks,
+                  dst_vol_blocks, same_volume=False):
+        """
+        Return SimBlockRanges of the requested ranges after checking that
+        every range is inside the volumes, that no destination blocks are
+        written twice, and for replication inside the same volume, that no
+        destination block is also a source block.
+        """
+        if not len(src_blocks) == len(dst_blocks) == len(block_counts):
+            raise SimBlockRanges._invalid(
+                "Block range lists are not of the same length")
+        for value in list(src_blocks) + list(dst_blocks) + list(block_counts):
+            # bool is a subclass of int.
+            if not isinstance(value, six.integer_types) or \
+               isinstance(value, bool):
+                raise SimBlockRanges._invalid(
+                    "Block range value %r is not an integer" % (value,))
+
+        for (src_block, dst_block, block_count) in \
+                zip(src_blocks, dst_blocks, block_counts):
+            if block_count <= 0 or src_block < 0 or dst_block < 0:
+                raise SimBlockRanges._invalid(
+                    "Invalid block range: src %d, dst %d, count %d" %
+                    (src_block, dst_block, block_count))
+            if src_block + block_count > src_vol_blocks or \
+               dst_block + block_count > dst_vol_blocks:
+                raise SimBlockRanges._invalid(
+                    "Block range out of volume boundary: src %d, dst %d, "
+                    "count %d" % (src_block, dst_block, block_count))
+
+        order = sorted(range(len(block_counts)), key=dst_blocks.__getitem__)
+        ranges = SimBlockRanges(
+            list(src_blocks[i] for i in order),
+            list(dst_blocks[i] for i in order),
+            list(block_counts[i] for i in order))
+
+        for i in range(1, len(order)):
+            if ranges.dst_blocks[i] < \
+               ranges.dst_blocks[i - 1] + ranges.block_counts[i - 1]:
+                raise SimBlockRanges._invalid(
+                    "Overlapped destination block range at block %d" %
+                    ranges.dst_blocks[i])
+
+        if same_volume:
+            # Both lists are sorted, walk them together.
+            src_ranges = sorted(zip(src_blocks, block_counts))
+            j = 0
+            for (dst_block, block_count) in \
+                    zip(ranges.dst_blocks, ranges.block_counts):
+                while j < len(src_ranges) and \
+                        sum(src_ranges[j]) <= dst_block:
+                    j += 1
+                if j < len(src_ranges) and \
+                   src_ranges[j][0] < dst_block + block_count:
+                    raise SimBlockRanges._invalid(
+                        "Destination block range at block %d overlaps "
+                        "source block range" % dst_block)
+        return ranges
+
+    def merged(self, newer):
+        """
+        Return SimBlockRanges of newer ranges combined with the parts of
+        current ranges not overwritten by newer ones.
+        """
+        merged = []
+        j = 0
+        for (src_block, dst_block, block_count) in \
+                zip(self.src_blocks, self.dst_blocks, self.block_counts):
+            dst_end = dst_block + block_count
+            while j < len(newer.dst_blocks) and \
+                    newer.dst_blocks[j] + newer.block_counts[j] <= dst_block:
+                j += 1
+            cur = dst_block
+            k = j
+            while k < len(newer.dst_blocks) and \
+                    newer.dst_blocks[k] < dst_end:
+                if newer.dst_blocks[k] > cur:
+                    merged.append((cur, src_block + cur - dst_block,
+                                   newer.dst_blocks[k] - cur))
+                cur = max(cur, newer.dst_blocks[k] + newer.block_counts[k])
+                k += 1
+            if cur < dst_end:
+                merged.append(
+                    (cur, src_block + cur - dst_block, dst_end - cur))
+
+        merged.extend(zip(newer.dst_blocks, newer.src_blocks,
+                          newer.block_counts))
+        merged.sort()
+        return SimBlockRanges(list(r[1] for r in merged),
+                              list(r[0] for r in merged),
+                              list(r[2] for r in merged))
+
+    @staticmethod
+    def _blob_of(values):
+        int_array = array.array(SimBlockRanges._TYPE_CODE, values)
+        if hasattr(int_array, 'tobytes'):
+            return sqlite3.Binary(int_array.tobytes())
+        return sqlite3.Binary(int_array.tostring())
+
+    @staticmethod
+    def _values_of(blob):
+        int_array = array.array(SimBlockRanges._TYPE_CODE)
+        if hasattr(int_array, 'frombytes'):
+            int_array.frombytes(bytes(blob))
+        else:
+            int_array.fromstring(str(blob))
+        return int_array.tolist()
+
+    def to_blobs(self):
+        """
+        Return (src_blocks, dst_blocks, block_counts) BLOBs.
+        """
+        return (SimBlockRanges._blob_of(self.src_blocks),
+                SimBlockRanges._blob_of(self.dst_blocks),
+                SimBlockRanges._blob_of(self.block_counts))
+
+    @staticmethod
+    def from_blobs(src_blob, dst_blob, count_blob):
+        return SimBlockRanges(SimBlockRanges._values_of(src_blob),
+                              SimBlockRanges._values_of(dst_blob),
+                              SimBlockRanges._values_of(count_blob))
+
+
 class PoolRAID(object):
     _RAID_DISK_CHK = {
         Volume.RAID_TYPE_JBOD: lambda x: x > 0,
@@ -129,9 +279,28 @@ def data_disk_count(raid_type, disk_count):
 
 
 class BackStore(object):
-    VERSION = "4.1"
+    VERSION = "4.4"
     VERSION_SIGNATURE = 'LSM_SIMULATOR_DATA_%s_%s' % (VERSION, md5(VERSION))
+    # Stored in 'PRAGMA user_version' once state file is fully initialized.
+    _USER_VERSION = \
+        int(VERSION.split('.')[0]) * 1000 + int(VERSION.split('.')[1])
+    # Base duration in seconds of job, overridden by LSM_SIM_TIME.
     JOB_DEFAULT_DURATION = 1
+    # Number of jobs processed at once by the array, overridden by
+    # LSM_SIM_JOB_SLOTS. Extra jobs are queued.
+    JOB_DEFAULT_SLOTS = 8
+    # Size independent job, like deleting a volume.
+    JOB_OP_DEFAULT = 0
+    # Job allocating space, like creating or growing a volume.
+    JOB_OP_ALLOC = 1
+    # Job copying data, like replicating a volume.
+    JOB_OP_COPY = 2
+    # Bytes processed per second by each type of job, a job takes
+    # LSM_SIM_TIME * (1 + size / rate) seconds once started.
+    _JOB_RATES = {
+        JOB_OP_ALLOC: 16 * 2 ** 40,
+        JOB_OP_COPY: 2 ** 40,
+    }
     JOB_DATA_TYPE_VOL = 1
     JOB_DATA_TYPE_FS = 2
     JOB_DATA_TYPE_FS_SNAP = 3
@@ -148,6 +317,10 @@ class BackStore(object):
     _DEFAULT_READ_CACHE_PCT = 10
     _LIST_SPLITTER = '#'
     _ID_FMT_LEN = 5
+    # Number of prepared statements kept by each sqlite3 connection.
+    _SQL_STMT_CACHE_SIZE = 256
+    # SQL command strings keyed by (action, table, columns/condition).
+    _SQL_CMDS = {}
 
     SUPPORTED_VCR_RAID_TYPES = [
         Volume.RAID_TYPE_RAID0, Volume.RAID_TYPE_RAID1,
@@ -159,6 +332,47 @@ class BackStore(object):
         8 * 1024, 16 * 1024, 32 * 1024, 64 * 1024, 128 * 1024, 256 * 1024,
         512 * 1024, 1024 * 1024]
 
+    # Extra inventory bulk loaded into new state file, check profile_of().
+    #   disks:          Number of disks, spread across pools.
+    #   pools:          Number of RAID 5 pools.
+    #   volumes:        Number of volumes, spread across pools.
+    #   vol_size:       Size of each volume in bytes.
+    #   ags:            Number of access groups.
+    #   inits_per_ag:   Number of iSCSI initiators of each access group.
+    #   masks_per_ag:   Number of volumes masked to each access group.
+    #   fss:            Number of file systems, spread across pools.
+    #   fs_size:        Size of each file system in bytes.
+    #   snaps_per_fs:   Number of snapshots of each file system.
+    #   exps:           Number of NFS exports, spread across file systems.
+    PROFILES = {
+        'medium': {
+            'disks': 100,
+            'pools': 10,
+            'volumes': 10000,
+            'vol_size': 1024 ** 3,
+            'ags': 1000,
+            'inits_per_ag': 2,
+            'masks_per_ag': 5,
+            'fss': 1000,
+            'fs_size': 1024 ** 3,
+            'snaps_per_fs': 2,
+            'exps': 500,
+        },
+        'large': {
+            'disks': 1000,
+            'pools': 100,
+            'volumes': 100000,
+            'vol_size': 1024 ** 3,
+            'ags': 10000,
+            'inits_per_ag': 2,
+            'masks_per_ag': 5,
+            'fss': 10000,
+            'fs_size': 1024 ** 3,
+            'snaps_per_fs': 2,
+            'exps': 5000,
+        },
+    }
+
     def __init__(self, statefile, timeout):
         if not os.path.exists(statefile):
             os.close(os.open(statefile, os.O_WRONLY | os.O_CREAT))
@@ -168,13 +382,46 @@ def __init__(self, statefile, timeout):
         self.statefile = statefile
         self.lastrowid = None
         self.sql_conn = sqlite3.connect(
-            statefile, timeout=int(int_div(timeout, 1000)), isolation_level="IMMEDIATE")
+            statefile, isolation_level="IMMEDIATE",
+            cached_statements=BackStore._SQL_STMT_CACHE_SIZE)
         self.sql_conn.row_factory = _dict_factory
-        # Create tables no matter exist or not. No lock required.
+        self.busy_timeout_set(timeout)
+        self.sql_conn.execute("PRAGMA foreign_keys = ON;")
 
-        sql_cmd = "PRAGMA foreign_keys = ON;\n"
+        # Only new or not yet initialized state file need the schema, the
+        # check does not require any write lock.
+        if self._user_version() != BackStore._USER_VERSION:
+            self._schema_create()
+        self.sql_conn.execute("PRAGMA synchronous = NORMAL;")
 
-        sql_cmd += \
+    def _incompatible_error(self):
+        return LsmError(
+            ErrorNumber.INVALID_ARGUMENT,
+            "Stored simulator state incompatible with "
+            "simulator, please move or delete %s" % self.statefile)
+
+    def _user_version(self):
+        try:
+            return self._sql_exec("PRAGMA user_version;")[0]['user_version']
+        except sqlite3.DatabaseError as sql_error:
+            if str(sql_error) == 'database is locked':
+                raise
+            raise self._incompatible_error()
+
+    def _schema_create(self):
+        """
+        Create tables, indexes, triggers and views. Existing ones are kept.
+        """
+        # With WAL journal, readers do not block writer and writer does not
+        # block readers, only writers are serialized. The journal mode is
+        # persistent in state file, if other process is holding the lock,
+        # that process will switch it.
+        try:
+            self.sql_conn.execute("PRAGMA journal_mode = WAL;")
+        except sqlite3.OperationalError:
+            pass
+
+        sql_cmd = \
             """
             CREATE TABLE systems (
             id TEXT PRIMARY KEY,
@@ -210,12 +457,17 @@ def __init__(self, statefile, timeout):
             parent_pool_id INTEGER,
             member_type INTEGER,
             strip_size INTEGER,
-            total_space LONG);
+            total_space LONG,
+            consumed_size LONG NOT NULL DEFAULT 0);
             """
         # parent_pool_id:
         #   Indicate this pool is allocated from # other pool
         # total_space:
         #   is only for sub-pool \pool from pool)
+        # consumed_size:
+        #   Space used by volumes, file systems and sub-pools of this pool.
+        #   Maintained by the triggers created below, so free space of pool
+        #   could be queried without scanning volumes and file systems.
 
         sql_cmd += \
             """
@@ -292,6 +544,9 @@ def __init__(self, statefile, timeout):
             rep_type INTEGER,
             src_vol_id INTEGER NOT NULL,
             dst_vol_id INTEGER NOT NULL,
+            src_blocks BLOB,
+            dst_blocks BLOB,
+            block_counts BLOB,
             FOREIGN KEY(src_vol_id)
             REFERENCES volumes(id) ON DELETE CASCADE,
             FOREIGN KEY(dst_vol_id)
@@ -378,12 +633,21 @@ def __init__(self, statefile, timeout):
             """
             CREATE TABLE jobs (
             id INTEGER PRIMARY KEY,
+            submit_time REAL NOT NULL,
+            start_time REAL NOT NULL,
             duration REAL NOT NULL,
-            timestamp TEXT NOT NULL,
             data_type INTEGER,
             data_id INTEGER);
             """
 
+        # Time when each array job slot finishes its last queued job.
+        sql_cmd += \
+            """
+            CREATE TABLE job_slots (
+            id INTEGER PRIMARY KEY,
+            free_time REAL NOT NULL);
+            """
+
         sql_cmd += \
             """
             CREATE TABLE batteries (
@@ -393,9 +657,65 @@ def __init__(self, statefile, timeout):
             status INTEGER NOT NULL);
             """
 
+        sql_cmd += \
+            """
+            CREATE INDEX pools_parent_pool_id_idx ON pools(parent_pool_id);
+            CREATE INDEX disks_owner_pool_id_idx ON disks(owner_pool_id, role);
+            CREATE INDEX volumes_pool_id_idx ON volumes(pool_id);
+            CREATE INDEX inits_owner_ag_id_idx ON inits(owner_ag_id);
+            CREATE INDEX vol_masks_ag_id_idx ON vol_masks(ag_id, vol_id);
+            CREATE INDEX vol_masks_vol_id_idx ON vol_masks(vol_id);
+            CREATE INDEX vol_reps_src_vol_id_idx ON vol_reps(src_vol_id);
+            CREATE INDEX vol_reps_dst_vol_id_idx ON vol_reps(dst_vol_id);
+            CREATE INDEX fss_pool_id_idx ON fss(pool_id);
+            CREATE INDEX fs_snaps_fs_id_idx ON fs_snaps(fs_id);
+            CREATE INDEX fs_clones_src_fs_id_idx ON fs_clones(src_fs_id);
+            CREATE INDEX fs_clones_dst_fs_id_idx ON fs_clones(dst_fs_id);
+            CREATE INDEX exps_fs_id_idx ON exps(fs_id);
+            CREATE INDEX exp_root_hosts_exp_id_idx ON exp_root_hosts(exp_id);
+            CREATE INDEX exp_rw_hosts_exp_id_idx ON exp_rw_hosts(exp_id);
+            CREATE INDEX exp_ro_hosts_exp_id_idx ON exp_ro_hosts(exp_id);
+            """
+
+        # Keep pools.consumed_size in sync within the same transaction of
+        # volume, file system and sub-pool changes.
+        for table, size_column, pool_column in [
+                ('volumes', 'consumed_size', 'pool_id'),
+                ('fss', 'consumed_size', 'pool_id'),
+                ('pools', 'total_space', 'parent_pool_id')]:
+            sql_cmd += \
+                """
+                CREATE TRIGGER {table}_insert_pool_consume
+                AFTER INSERT ON {table}
+                BEGIN
+                    UPDATE pools
+                        SET consumed_size = consumed_size + NEW.{size}
+                        WHERE id = NEW.{pool};
+                END;
+
+                CREATE TRIGGER {table}_update_pool_consume
+                AFTER UPDATE OF {size}, {pool} ON {table}
+                BEGIN
+                    UPDATE pools
+                        SET consumed_size = consumed_size - OLD.{size}
+                        WHERE id = OLD.{pool};
+                    UPDATE pools
+                        SET consumed_size = consumed_size + NEW.{size}
+                        WHERE id = NEW.{pool};
+                END;
+
+                CREATE TRIGGER {table}_delete_pool_consume
+                AFTER DELETE ON {table}
+                BEGIN
+                    UPDATE pools
+                        SET consumed_size = consumed_size - OLD.{size}
+                        WHERE id = OLD.{pool};
+                END;
+                """.format(table=table, size=size_column, pool=pool_column)
+
         # Create views, SUBSTR() used below is alternative way of PRINTF()
         # which only exists on sqlite 3.8+ while RHEL6 or Ubuntu 12.04 ships
-        # older version.
+        # older version. ID longer than _ID_FMT_LEN digits is not truncated.
         sql_cmd += \
             """
             CREATE VIEW pools_view AS
@@ -403,7 +723,7 @@ def __init__(self, statefile, timeout):
                     pool0.id,
                         'POOL_ID_' ||
                             SUBSTR('{ID_PADDING}' || pool0.id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(pool0.id)))
                     lsm_pool_id,
                     pool0.name,
                     pool0.status,
@@ -415,80 +735,44 @@ def __init__(self, statefile, timeout):
                     pool0.parent_pool_id,
                         'POOL_ID_' ||
                             SUBSTR('{ID_PADDING}' || pool0.parent_pool_id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN},
+                                        LENGTH(pool0.parent_pool_id)))
                     parent_lsm_pool_id,
                     pool0.strip_size,
-                    pool1.total_space total_space,
-                    pool1.total_space -
-                    pool2.vol_consumed_size  -
-                    pool3.fs_consumed_size -
-                    pool4.sub_pool_consumed_size free_space,
-                    pool1.data_disk_count,
-                    pool5.disk_count
+                    pool0.real_total_space total_space,
+                    pool0.real_total_space - pool0.consumed_size free_space,
+                    pool0.data_disk_count,
+                    pool0.disk_count
                 FROM
-                    pools pool0
-                        LEFT JOIN (
-                            SELECT
-                                pool.id,
-                                    ifnull(pool.total_space,
-                                        ifnull(SUM(disk.total_space), 0))
-                                total_space,
-                                COUNT(disk.id) data_disk_count
-                            FROM pools pool
-                                LEFT JOIN disks disk
-                                    ON pool.id = disk.owner_pool_id AND
-                                       disk.role = 'DATA'
-                            GROUP BY
-                                pool.id
-                        ) pool1 ON pool0.id = pool1.id
-
-                        LEFT JOIN (
-                            SELECT
-                                pool.id,
-                                ifnull(SUM(volume.consumed_size), 0)
-                                vol_consumed_size
-                            FROM pools pool
-                                LEFT JOIN volumes volume
-                                    ON volume.pool_id = pool.id
-                            GROUP BY
-                                pool.id
-                        ) pool2 ON pool0.id = pool2.id
-
-                        LEFT JOIN (
-                            SELECT
-                                pool.id,
-                                ifnull(SUM(fs.consumed_size), 0)
-                                fs_consumed_size
-                            FROM pools pool
-                                LEFT JOIN fss fs
-                                    ON fs.pool_id = pool.id
-                            GROUP BY
-                                pool.id
-                        ) pool3 ON pool0.id = pool3.id
-
-                        LEFT JOIN (
-                            SELECT
-                                pool.id,
-                                ifnull(SUM(sub_pool.total_space), 0)
-                                sub_pool_consumed_size
-                            FROM pools pool
-                                LEFT JOIN pools sub_pool
-                                    ON sub_pool.parent_pool_id = pool.id
-                            GROUP BY
-                                pool.id
-                        ) pool4 ON pool0.id = pool4.id
-                        LEFT JOIN (
-                            SELECT
-                                pool.id,
-                                COUNT(disk.id) disk_count
-                            FROM pools pool
-                                LEFT JOIN disks disk
-                                    ON pool.id = disk.owner_pool_id
-                            GROUP BY
-                                pool.id
-                        ) pool5 ON pool0.id = pool5.id
-                GROUP BY
-                    pool0.id;
+                    (
+                        SELECT
+                            pool.*,
+                                ifnull(pool.total_space,
+                                    (
+                                        SELECT
+                                            ifnull(SUM(disk.total_space), 0)
+                                        FROM disks disk
+                                        WHERE
+                                            disk.owner_pool_id = pool.id AND
+                                            disk.role = 'DATA'
+                                    ))
+                            real_total_space,
+                                (
+                                    SELECT COUNT(disk.id)
+                                    FROM disks disk
+                                    WHERE
+                                        disk.owner_pool_id = pool.id AND
+                                        disk.role = 'DATA'
+                                )
+                            data_disk_count,
+                                (
+                                    SELECT COUNT(disk.id)
+                                    FROM disks disk
+                                    WHERE disk.owner_pool_id = pool.id
+                                )
+                            disk_count
+                        FROM pools pool
+                    ) pool0;
             """
 
         sql_cmd += \
@@ -498,7 +782,7 @@ def __init__(self, statefile, timeout):
                     id,
                         'TGT_PORT_ID_' ||
                             SUBSTR('{ID_PADDING}' || id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(id)))
                     lsm_tgt_id,
                     port_type,
                     service_address,
@@ -516,7 +800,7 @@ def __init__(self, statefile, timeout):
                     id,
                         'DISK_ID_' ||
                             SUBSTR('{ID_PADDING}' || id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(id)))
                     lsm_disk_id,
                         disk_prefix || '_' || id
                     name,
@@ -540,7 +824,7 @@ def __init__(self, statefile, timeout):
                     id,
                         'VOL_ID_' ||
                             SUBSTR('{ID_PADDING}' || id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(id)))
                     lsm_vol_id,
                     vpd83,
                     name,
@@ -554,7 +838,7 @@ def __init__(self, statefile, timeout):
                     pool_id,
                         'POOL_ID_' ||
                             SUBSTR('{ID_PADDING}' || pool_id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(pool_id)))
                     lsm_pool_id
                 FROM
                     volumes;
@@ -567,7 +851,7 @@ def __init__(self, statefile, timeout):
                     id,
                         'FS_ID_' ||
                             SUBSTR('{ID_PADDING}' || id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(id)))
                     lsm_fs_id,
                     name,
                     total_space,
@@ -576,7 +860,7 @@ def __init__(self, statefile, timeout):
                     pool_id,
                         'POOL_ID_' ||
                             SUBSTR('{ID_PADDING}' || pool_id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(pool_id)))
                     lsm_pool_id
                 FROM
                     fss;
@@ -589,7 +873,7 @@ def __init__(self, statefile, timeout):
                     id,
                         'BAT_ID_' ||
                             SUBSTR('{ID_PADDING}' || id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(id)))
                     lsm_bat_id,
                     name,
                     type,
@@ -604,14 +888,14 @@ def __init__(self, statefile, timeout):
                     id,
                         'FS_SNAP_ID_' ||
                             SUBSTR('{ID_PADDING}' || id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(id)))
                     lsm_fs_snap_id,
                     name,
                     timestamp,
                     fs_id,
                         'FS_ID_' ||
                             SUBSTR('{ID_PADDING}' || fs_id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(fs_id)))
                     lsm_fs_id
                 FROM
                     fs_snaps;
@@ -624,7 +908,7 @@ def __init__(self, statefile, timeout):
                     vol.id,
                         'VOL_ID_' ||
                             SUBSTR('{ID_PADDING}' || vol.id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(vol.id)))
                     lsm_vol_id,
                     vol.vpd83,
                     vol.name,
@@ -633,7 +917,7 @@ def __init__(self, statefile, timeout):
                     vol.pool_id,
                         'POOL_ID_' ||
                             SUBSTR('{ID_PADDING}' || vol.pool_id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(vol.pool_id)))
                     lsm_pool_id,
                     vol.admin_state,
                     vol.is_hw_raid_vol,
@@ -654,7 +938,7 @@ def __init__(self, statefile, timeout):
                     ag.id,
                         'AG_ID_' ||
                             SUBSTR('{ID_PADDING}' || ag.id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(ag.id)))
                     lsm_ag_id,
                     ag.name,
                         CASE
@@ -683,7 +967,7 @@ def __init__(self, statefile, timeout):
                     ag_new.id,
                         'AG_ID_' ||
                             SUBSTR('{ID_PADDING}' || ag_new.id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(ag_new.id)))
                     lsm_ag_id,
                     ag_new.name,
                     ag_new.init_type,
@@ -724,12 +1008,12 @@ def __init__(self, statefile, timeout):
                     exp.id,
                         'EXP_ID_' ||
                             SUBSTR('{ID_PADDING}' || exp.id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(exp.id)))
                     lsm_exp_id,
                     exp.fs_id,
                         'FS_ID_' ||
                             SUBSTR('{ID_PADDING}' || exp.fs_id,
-                                   -{ID_FMT_LEN}, {ID_FMT_LEN})
+                                   -MAX({ID_FMT_LEN}, LENGTH(exp.fs_id)))
                     lsm_fs_id,
                     exp.exp_path,
                     exp.auth_type,
@@ -796,19 +1080,22 @@ def __init__(self, statefile, timeout):
             'SPLITTER': BackStore._LIST_SPLITTER,
         })
 
+        # Create all or nothing, so concurrent plugin will never see a
+        # partial schema.
+        sql_cmd = "BEGIN IMMEDIATE TRANSACTION;\n%sCOMMIT;\n" % sql_cmd
+
         sql_cur = self.sql_conn.cursor()
         try:
             sql_cur.executescript(sql_cmd)
         except sqlite3.OperationalError as sql_error:
+            self.sql_conn.rollback()
             if 'already exists' in str(sql_error):
                 pass
             else:
                 raise sql_error
         except sqlite3.DatabaseError as sql_error:
-            raise LsmError(
-                ErrorNumber.INVALID_ARGUMENT,
-                "Stored simulator state incompatible with "
-                "simulator, please move or delete %s" % self.statefile)
+            self.sql_conn.rollback()
+            raise self._incompatible_error()
 
     def _check_version(self):
         sim_syss = self.sim_syss()
@@ -819,20 +1106,156 @@ def _check_version(self):
                sim_syss[0]['version'] == BackStore.VERSION_SIGNATURE:
                 return True
 
-        raise LsmError(
+        raise self._incompatible_error()
+
+    @staticmethod
+    def profile_of(name, parameters=None):
+        """
+        Return a copy of named profile from BackStore.PROFILES with its
+        values overridden by the same name keys in parameters dictionary.
+        """
+        if name not in BackStore.PROFILES:
+            raise LsmError(
+                ErrorNumber.INVALID_ARGUMENT,
+                "Unknown simulator profile '%s', supported: %s" %
+                (name, ", ".join(sorted(BackStore.PROFILES.keys()))))
+
+        profile = dict(BackStore.PROFILES[name])
+        for key in profile.keys():
+            if parameters and parameters.get(key) is not None:
+                try:
+                    profile[key] = int(parameters[key])
+                except ValueError:
+                    raise LsmError(
+                        ErrorNumber.INVALID_ARGUMENT,
+                        "Simulator profile parameter '%s' should be an "
+                        "integer" % key)
+                if profile[key] < 0:
+                    raise LsmError(
+                        ErrorNumber.INVALID_ARGUMENT,
+                        "Simulator profile parameter '%s' should not be "
+                        "negative" % key)
+        return profile
+
+    # ioctl of Linux to share the extents of source file with the new file.
+    _FICLONE = 0x40049409
+
+    @staticmethod
+    def _file_clone(src_path, dst_path):
+        """
+        Copy file by reflink if file system support it, else plain copy.
+        """
+        with open(src_path, 'rb') as src_file:
+            with open(dst_path, 'wb') as dst_file:
+                try:
+                    fcntl.ioctl(dst_file.fileno(), BackStore._FICLONE,
+                                src_file.fileno())
+                    return
+                except (IOError, OSError):
+                    pass
+                shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+
+    @staticmethod
+    def _empty_statefile_error(statefile, template):
+        return LsmError(
             ErrorNumber.INVALID_ARGUMENT,
-            "Stored simulator state incompatible with "
-            "simulator, please move or delete %s" % self.statefile)
+            "Simulator state file %s is empty, either being initialized by "
+            "another plugin instance or left empty, template %s not applied. "
+            "Please retry, or delete the state file to use the template" %
+            (statefile, template))
 
-    def check_version_and_init(self):
+    @staticmethod
+    def state_clone(template, statefile, timeout):
+        """
+        Create statefile as a copy of the template state file if statefile
+        does not exist or is empty, so a large prebuilt state could be
+        restored much faster than generating it.
+
+        When no other connection is using the template, the file is cloned
+        by reflink if supported or plain copy while holding the write lock
+        of template, else the sqlite3 backup API is used to copy a
+        consistent snapshot, hence the template could also be the state
+        file of a running simulator.
+
+        An existing empty statefile is never replaced: it could be opened
+        by another plugin instance creating the schema, which would keep
+        writing into the replaced file.
+        """
+        if os.path.exists(statefile):
+            if os.path.getsize(statefile) > 0:
+                return
+            raise BackStore._empty_statefile_error(statefile, template)
+        if not os.path.isfile(template):
+            raise LsmError(
+                ErrorNumber.INVALID_ARGUMENT,
+                "Simulator template state file %s not found" % template)
+
+        (tmp_fd, tmp_path) = tempfile.mkstemp(
+            prefix='.lsm_sim_',
+            dir=os.path.dirname(os.path.abspath(statefile)))
+        os.close(tmp_fd)
+        tpl_conn = sqlite3.connect(
+            template, timeout=timeout / 1000.0, isolation_level=None)
+        try:
+            try:
+                tpl_conn.execute("BEGIN IMMEDIATE TRANSACTION;")
+                tpl_conn.execute("PRAGMA user_version;").fetchall()
+            except sqlite3.OperationalError:
+                raise
+            except sqlite3.DatabaseError:
+                raise LsmError(
+                    ErrorNumber.INVALID_ARGUMENT,
+                    "Simulator template %s is not a state file" % template)
+
+            # The write-ahead log only exists while template is in use.
+            wal_path = template + '-wal'
+            if not os.path.exists(wal_path) or \
+               os.path.getsize(wal_path) == 0:
+                BackStore._file_clone(template, tmp_path)
+                tpl_conn.execute("ROLLBACK;")
+            else:
+                tpl_conn.execute("ROLLBACK;")
+                if not hasattr(tpl_conn, 'backup'):
+                    raise LsmError(
+                        ErrorNumber.TIMEOUT,
+                        "Simulator template state file %s is in use" %
+                        template)
+                dst_conn = sqlite3.connect(tmp_path)
+                try:
+                    tpl_conn.backup(dst_conn)
+                finally:
+                    dst_conn.close()
+            os.chmod(tmp_path, 0o666)
+
+            # Never replace a state file created meanwhile by other plugin
+            # instance.
+            try:
+                os.link(tmp_path, statefile)
+            except OSError as os_error:
+                if os_error.errno != errno.EEXIST:
+                    raise
+                if os.path.getsize(statefile) == 0:
+                    raise BackStore._empty_statefile_error(
+                        statefile, template)
+        finally:
+            tpl_conn.close()
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def check_version_and_init(self, profile=None):
         """
         Raise error if version not match.
-        If empty database found, initiate.
+        If empty database found, initiate. The profile dictionary, check
+        profile_of(), is only loaded for empty database.
         """
+        if self._user_version() == BackStore._USER_VERSION:
+            return
+
         # The complex lock workflow is all caused by python sqlite3 do
         # autocommit for "CREATE TABLE" command.
         self.trans_begin()
         if self._check_version():
+            self._user_version_set()
             self.trans_commit()
             return
         else:
@@ -953,107 +1376,346 @@ def check_version_and_init(self):
                 raid_type=Volume.RAID_TYPE_RAID0,
                 sim_disk_ids=test_pool_disks)
 
-            self._data_add(
-                'tgts',
+            self._data_add_many('tgts', [
                 {
                     'port_type': TargetPort.TYPE_FC,
                     'service_address': '50:0a:09:86:99:4b:8d:c5',
                     'network_address': '50:0a:09:86:99:4b:8d:c5',
                     'physical_address': '50:0a:09:86:99:4b:8d:c5',
                     'physical_name': 'FC_a_0b',
-                })
-
-            self._data_add(
-                'tgts',
+                },
                 {
                     'port_type': TargetPort.TYPE_FCOE,
                     'service_address': '50:0a:09:86:99:4b:8d:c6',
                     'network_address': '50:0a:09:86:99:4b:8d:c6',
                     'physical_address': '50:0a:09:86:99:4b:8d:c6',
                     'physical_name': 'FCoE_b_0c',
-                })
-            self._data_add(
-                'tgts',
+                },
                 {
                     'port_type': TargetPort.TYPE_ISCSI,
                     'service_address': 'iqn.1986-05.com.example:sim-tgt-03',
                     'network_address': 'sim-iscsi-tgt-3.example.com:3260',
                     'physical_address': 'a4:4e:31:47:f4:e0',
                     'physical_name': 'iSCSI_c_0d',
-                })
-            self._data_add(
-                'tgts',
+                },
                 {
                     'port_type': TargetPort.TYPE_ISCSI,
                     'service_address': 'iqn.1986-05.com.example:sim-tgt-03',
                     'network_address': '10.0.0.1:3260',
                     'physical_address': 'a4:4e:31:47:f4:e1',
                     'physical_name': 'iSCSI_c_0e',
-                })
-            self._data_add(
-                'tgts',
+                },
                 {
                     'port_type': TargetPort.TYPE_ISCSI,
                     'service_address': 'iqn.1986-05.com.example:sim-tgt-03',
                     'network_address': '[2001:470:1f09:efe:a64e:31ff::1]:3260',
                     'physical_address': 'a4:4e:31:47:f4:e1',
                     'physical_name': 'iSCSI_c_0e',
-                })
+                },
+            ])
 
-            self._data_add(
-                'batteries',
+            self._data_add_many('batteries', [
                 {
                     'name': 'Battery SIMB01, 8000 mAh, 05 March 2016',
                     'type': Battery.TYPE_CHEMICAL,
                     'status': Battery.STATUS_OK,
-                })
-
-            self._data_add(
-                'batteries',
+                },
                 {
                     'name': 'Capacitor SIMC01, 500 J, 05 March 2016',
                     'type': Battery.TYPE_CAPACITOR,
                     'status': Battery.STATUS_OK,
-                })
+                },
+            ])
+
+            if profile:
+                self._profile_load(profile)
 
+            self._user_version_set()
             self.trans_commit()
             return
 
-    def _sql_exec(self, sql_cmd):
+    def _max_id(self, table_name):
+        return self._sql_exec(
+            "SELECT ifnull(MAX(id), 0) max_id FROM %s;" %
+            table_name)[0]['max_id']
+
+    def _profile_load(self, profile):
         """
-        Execute sql command and get all output.
+        Bulk load inventory defined by profile dictionary. The IDs are
+        assigned here, so that relationships could be inserted without
+        querying them back.
+        """
+        pool_count = profile['pools']
+        fs_count = profile['fss']
+        vol_count = profile['volumes']
+        disk_size = size_human_2_size_bytes('2TiB')
+        vol_size = int_div(profile['vol_size'] + BackStore.BLK_SIZE - 1,
+                           BackStore.BLK_SIZE) * BackStore.BLK_SIZE
+        fs_size = int_div(profile['fs_size'] + BackStore.BLK_SIZE - 1,
+                          BackStore.BLK_SIZE) * BackStore.BLK_SIZE
+        disks_per_pool = 0
+        if pool_count:
+            disks_per_pool = int_div(profile['disks'], pool_count)
+
+        if (vol_count or fs_count) and disks_per_pool < 3:
+            raise LsmError(
+                ErrorNumber.INVALID_ARGUMENT,
+                "Simulator profile require at least 3 disks per pool to "
+                "hold volumes or file systems")
+        if profile['exps'] and not fs_count:
+            raise LsmError(
+                ErrorNumber.INVALID_ARGUMENT,
+                "Simulator profile require file systems to hold NFS exports")
+
+        data_disk_count = 0
+        if disks_per_pool:
+            data_disk_count = PoolRAID.data_disk_count(
+                Volume.RAID_TYPE_RAID5, disks_per_pool)
+            pool_usage = \
+                int_div(vol_count + pool_count - 1, pool_count) * vol_size + \
+                int_div(fs_count + pool_count - 1, pool_count) * fs_size
+            if pool_usage > data_disk_count * disk_size:
+                raise LsmError(
+                    ErrorNumber.INVALID_ARGUMENT,
+                    "Simulator profile volumes and file systems does not "
+                    "fit in pools")
+
+        pool_base = self._max_id('pools') + 1
+        disk_base = self._max_id('disks') + 1
+        self._data_add_many('pools', [
+            {
+                'id': pool_base + i,
+                'name': 'Scale Pool %d' % i,
+                'status': Pool.STATUS_OK,
+                'status_info': '',
+                'element_type': Pool.ELEMENT_TYPE_FS |
+                Pool.ELEMENT_TYPE_VOLUME |
+                Pool.ELEMENT_TYPE_DELTA,
+                'unsupported_actions': 0,
+                'raid_type': Volume.RAID_TYPE_RAID5,
+                'member_type': Pool.MEMBER_TYPE_DISK,
+                'strip_size': BackStore.DEFAULT_STRIP_SIZE,
+            } for i in range(pool_count)])
+
+        sim_disks = []
+        for i in range(profile['disks']):
+            sim_disk = {
+                'id': disk_base + i,
+                'disk_prefix': "2TiB SAS Disk",
+                'total_space': disk_size,
+                'disk_type': Disk.TYPE_SAS,
+                'status': Disk.STATUS_OK,
+                'vpd83': _random_vpd(),
+                'rpm': 15000,
+                'link_type': Disk.LINK_TYPE_SAS,
+                'location': "Port: %d Box: %d Bay: %d" %
+                            (i % 4, 2 + int_div(i, 24), i % 24),
+            }
+            if i < pool_count * disks_per_pool:
+                sim_disk['owner_pool_id'] = \
+                    pool_base + int_div(i, disks_per_pool)
+                if i % disks_per_pool < data_disk_count:
+                    sim_disk['role'] = 'DATA'
+                else:
+                    sim_disk['role'] = 'PARITY'
+            sim_disks.append(sim_disk)
+        # Free disks have no owner pool or role.
+        self._data_add_many(
+            'disks', [d for d in sim_disks if 'role' in d])
+        self._data_add_many(
+            'disks', [d for d in sim_disks if 'role' not in d])
+
+        vol_base = self._max_id('volumes') + 1
+        self._data_add_many('volumes', [
+            {
+                'id': vol_base + i,
+                'vpd83': _random_vpd(),
+                'name': 'Scale Volume %d' % i,
+                'total_space': vol_size,
+                'consumed_size': vol_size,
+                'admin_state': Volume.ADMIN_STATE_ENABLED,
+                'is_hw_raid_vol': 0,
+                'write_cache_policy': BackStore.DEFAULT_WRITE_CACHE_POLICY,
+                'read_cache_policy': BackStore.DEFAULT_READ_CACHE_POLICY,
+                'phy_disk_cache': BackStore.DEFAULT_PHYSICAL_DISK_CACHE,
+                'pool_id': pool_base + i % pool_count,
+            } for i in range(vol_count)])
+
+        ag_base = self._max_id('ags') + 1
+        self._data_add_many('ags', [
+            {
+                'id': ag_base + i,
+                'name': 'Scale Access Group %d' % i,
+            } for i in range(profile['ags'])])
+        self._data_add_many('inits', [
+            {
+                'id': 'iqn.2016-01.com.example:sim-scale-ag%d-%d' % (i, j),
+                'init_type': AccessGroup.INIT_TYPE_ISCSI_IQN,
+                'owner_ag_id': ag_base + i,
+            }
+            for i in range(profile['ags'])
+            for j in range(profile['inits_per_ag'])])
+
+        masks_per_ag = min(profile['masks_per_ag'], vol_count)
+        self._data_add_many('vol_masks', [
+            {
+                'ag_id': ag_base + i,
+                'vol_id': vol_base + (i * masks_per_ag + j) % vol_count,
+            }
+            for i in range(profile['ags'])
+            for j in range(masks_per_ag)])
+
+        fs_base = self._max_id('fss') + 1
+        self._data_add_many('fss', [
+            {
+                'id': fs_base + i,
+                'name': 'Scale File System %d' % i,
+                'total_space': fs_size,
+                'consumed_size': fs_size,
+                'free_space': fs_size,
+                'pool_id': pool_base + i % pool_count,
+            } for i in range(fs_count)])
+
+        timestamp = int(time.time())
+        self._data_add_many('fs_snaps', [
+            {
+                'name': 'Scale Snapshot %d_%d' % (i, j),
+                'fs_id': fs_base + i,
+                'timestamp': timestamp,
+            }
+            for i in range(fs_count)
+            for j in range(profile['snaps_per_fs'])])
+
+        exp_base = self._max_id('exps') + 1
+        self._data_add_many('exps', [
+            {
+                'id': exp_base + i,
+                'fs_id': fs_base + i % fs_count,
+                'exp_path': '/scale_exp_%d' % i,
+                'anon_uid': NfsExport.ANON_UID_GID_NA,
+                'anon_gid': NfsExport.ANON_UID_GID_NA,
+                'auth_type': None,
+                'options': None,
+            } for i in range(profile['exps'])])
+        self._data_add_many('exp_rw_hosts', [
+            {
+                'host': 'host%d.example.com' % i,
+                'exp_id': exp_base + i,
+            } for i in range(profile['exps'])])
+
+    def _user_version_set(self):
+        # PRAGMA does not support bound parameters.
+        self.sql_conn.execute(
+            "PRAGMA user_version = %d;" % BackStore._USER_VERSION)
+
+    def _sql_exec(self, sql_cmd, params=()):
+        """
+        Execute sql command with bound parameters and get all output.
         """
         sql_cur = self.sql_conn.cursor()
-        sql_cur.execute(sql_cmd)
+        sql_cur.execute(sql_cmd, params)
         self.lastrowid = sql_cur.lastrowid
         return sql_cur.fetchall()
 
+    def _sql_exec_many(self, sql_cmd, params_list):
+        """
+        Execute sql command once for each parameter sequence.
+        """
+        sql_cur = self.sql_conn.cursor()
+        sql_cur.executemany(sql_cmd, params_list)
+        self.lastrowid = sql_cur.lastrowid
+
     def _get_table(self, table_name):
         sql_cmd = "SELECT * FROM %s" % table_name
         return self._sql_exec(sql_cmd)
 
+    def busy_timeout_set(self, timeout):
+        """
+        Set the maximum time in milliseconds to wait for lock of state file.
+        The LSM_SIM_BUSY_TIMEOUT environment variable takes precedence over
+        the timeout of plugin.
+        """
+        busy_timeout = os.getenv("LSM_SIM_BUSY_TIMEOUT")
+        if busy_timeout is not None:
+            try:
+                timeout = int(busy_timeout)
+            except ValueError:
+                raise LsmError(
+                    ErrorNumber.INVALID_ARGUMENT,
+                    "Invalid LSM_SIM_BUSY_TIMEOUT '%s', expecting "
+                    "milliseconds" % busy_timeout)
+        self.sql_conn.execute("PRAGMA busy_timeout = %d;" % int(timeout))
+
     def trans_begin(self):
         self.sql_conn.execute("BEGIN IMMEDIATE TRANSACTION;")
 
+    def trans_begin_read(self):
+        """
+        Begin transaction for read only actions. The lock is only acquired
+        on first read and will not block other readers or writer.
+        Use trans_rollback() to end it.
+        """
+        self.sql_conn.execute("BEGIN DEFERRED TRANSACTION;")
+
     def trans_commit(self):
         self.sql_conn.commit()
 
     def trans_rollback(self):
         self.sql_conn.rollback()
 
+    @staticmethod
+    def _sql_cmd_of(key, sql_fmt, *args):
+        """
+        Return the SQL command for statement key, generating it from sql_fmt
+        and args only the first time. Reusing identical command strings lets
+        sqlite3 reuse its prepared statements.
+        """
+        sql_cmd = BackStore._SQL_CMDS.get(key)
+        if sql_cmd is None:
+            sql_cmd = sql_fmt % args
+            BackStore._SQL_CMDS[key] = sql_cmd
+        return sql_cmd
+
+    @staticmethod
+    def _insert_sql_cmd(table_name, keys):
+        return BackStore._sql_cmd_of(
+            ('INSERT', table_name, keys),
+            "INSERT INTO %s (%s) VALUES (%s);", table_name, ", ".join(keys),
+            ", ".join(['?'] * len(keys)))
+
+    @staticmethod
+    def _sql_value(value):
+        # Keep storing None as empty string like we always did.
+        if value is None:
+            return ''
+        return value
+
     def _data_add(self, table_name, data_dict):
-        keys = list(data_dict.keys())
-        values = ['' if v is None else str(v) for v in list(data_dict.values())]
-
-        sql_cmd = "INSERT INTO %s (%s) VALUES (%s);" % \
-                  (table_name,
-                   "'%s'" % ("', '".join(keys)),
-                   "'%s'" % ("', '".join(values)))
-        self._sql_exec(sql_cmd)
-
-    def _data_find(self, table, condition, flag_unique=False):
-        sql_cmd = "SELECT * FROM %s WHERE %s" % (table, condition)
-        sim_datas = self._sql_exec(sql_cmd)
+        keys = tuple(data_dict.keys())
+        self._sql_exec(
+            BackStore._insert_sql_cmd(table_name, keys),
+            [BackStore._sql_value(data_dict[k]) for k in keys])
+
+    def _data_add_many(self, table_name, data_dicts):
+        """
+        Insert all data_dicts into table_name using single prepared
+        statement. All dictionaries should hold the same keys.
+        """
+        if len(data_dicts) == 0:
+            return
+        keys = tuple(data_dicts[0].keys())
+        self._sql_exec_many(
+            BackStore._insert_sql_cmd(table_name, keys),
+            ([BackStore._sql_value(d[k]) for k in keys] for d in data_dicts))
+
+    def _data_find(self, table, condition, params=(), flag_unique=False):
+        """
+        The condition should use '?' as placeholder of items in params.
+        """
+        sql_cmd = BackStore._sql_cmd_of(
+            ('SELECT', table, condition), "SELECT * FROM %s WHERE %s",
+            table, condition)
+        sim_datas = self._sql_exec(sql_cmd, params)
         if flag_unique:
             if len(sim_datas) == 0:
                 return None
@@ -1066,61 +1728,110 @@ def _data_find(self, table, condition, flag_unique=False):
         else:
             return sim_datas
 
-    def _data_update(self, table, data_id, column_name, value):
-        if value is None:
-            sql_cmd = "UPDATE %s SET %s=NULL WHERE id='%s'" % \
-                (table, column_name, data_id)
-        else:
-            sql_cmd = "UPDATE %s SET %s='%s' WHERE id='%s'" % \
-                (table, column_name, value, data_id)
+    def _data_rows(self, table, columns, condition=None, params=()):
+        """
+        Return a list of tuples holding the values of columns in the same
+        order, without building a dict for each row.
+        """
+        where = ""
+        if condition:
+            where = " WHERE %s" % condition
+        sql_cmd = BackStore._sql_cmd_of(
+            ('ROWS', table, columns, condition), "SELECT %s FROM %s%s",
+            ", ".join(columns), table, where)
+        sql_cur = self.sql_conn.cursor()
+        sql_cur.row_factory = None
+        sql_cur.execute(sql_cmd, params)
+        return sql_cur.fetchall()
 
-        self._sql_exec(sql_cmd)
+    def _data_update(self, table, data_id, column_name, value):
+        sql_cmd = BackStore._sql_cmd_of(
+            ('UPDATE', table, column_name), "UPDATE %s SET %s=? WHERE id=?",
+            table, column_name)
+        self._sql_exec(sql_cmd, (value, data_id))
 
-    def _data_delete(self, table, condition):
-        sql_cmd = "DELETE FROM %s WHERE %s;" % (table, condition)
-        self._sql_exec(sql_cmd)
+    def _data_delete(self, table, condition, params=()):
+        """
+        The condition should use '?' as placeholder of items in params.
+        """
+        sql_cmd = BackStore._sql_cmd_of(
+            ('DELETE', table, condition), "DELETE FROM %s WHERE %s;",
+            table, condition)
+        self._sql_exec(sql_cmd, params)
 
-    def sim_job_create(self, job_data_type=None, data_id=None):
+    @staticmethod
+    def _job_duration(job_op, size):
+        duration = float(
+            os.getenv("LSM_SIM_TIME", BackStore.JOB_DEFAULT_DURATION))
+        if job_op in BackStore._JOB_RATES:
+            duration *= 1 + float(size) / BackStore._JOB_RATES[job_op]
+        return duration
+
+    def _job_slot_reserve(self, submit_time, duration):
+        """
+        Queue the job on the array job slot which gets free first.
+        Return the start time of job.
+        """
+        slot_count = int(
+            os.getenv("LSM_SIM_JOB_SLOTS", BackStore.JOB_DEFAULT_SLOTS))
+        free_times = dict(
+            (r['id'], r['free_time'])
+            for r in self._data_find('job_slots', 'id<?', (slot_count,)))
+        slot_id = min(range(max(slot_count, 1)),
+                      key=lambda i: (free_times.get(i, 0), i))
+        start_time = max(submit_time, free_times.get(slot_id, 0))
+        self._sql_exec(
+            "INSERT OR REPLACE INTO job_slots (id, free_time) VALUES (?, ?);",
+            (slot_id, start_time + duration))
+        return start_time
+
+    def sim_job_create(self, job_data_type=None, data_id=None,
+                       job_op=JOB_OP_DEFAULT, size=0):
         """
         Return a job id(Integer)
+        The duration of job is scaled by the size in bytes processed by the
+        job operation, the job only starts once an array job slot is free.
         """
+        submit_time = time.time()
+        duration = BackStore._job_duration(job_op, size)
         self._data_add(
             "jobs",
             {
-                "duration": os.getenv(
-                    "LSM_SIM_TIME", BackStore.JOB_DEFAULT_DURATION),
-                "timestamp": time.time(),
+                "submit_time": submit_time,
+                "start_time": self._job_slot_reserve(submit_time, duration),
+                "duration": duration,
                 "data_type": job_data_type,
                 "data_id": data_id,
             })
         return self.lastrowid
 
     def sim_job_delete(self, sim_job_id):
-        self._data_delete('jobs', 'id="%s"' % sim_job_id)
+        self._data_delete('jobs', 'id=?', (sim_job_id,))
 
     def sim_job_status(self, sim_job_id):
         """
         Return (progress, data_type, data) tuple.
         progress is the integer of percent.
         """
-        sim_job = self._data_find('jobs', 'id=%s' % sim_job_id,
+        sim_job = self._data_find('jobs', 'id=?', (sim_job_id,),
                                   flag_unique=True)
         if sim_job is None:
             raise LsmError(
                 ErrorNumber.NOT_FOUND_JOB, "Job not found")
 
-        progress = int(
-            (time.time() - float(sim_job['timestamp'])) /
-            sim_job['duration'] * 100)
+        # Queued job stays at 0 percent until it gets a job slot.
+        run_time = time.time() - sim_job['start_time']
+        if run_time < 0:
+            progress = 0
+        elif run_time >= sim_job['duration']:
+            progress = 100
+        else:
+            progress = min(int(run_time / sim_job['duration'] * 100), 99)
 
         data = None
         data_type = None
 
-        if progress < 0:
-            progress = 0
-
-        if progress >= 100:
-            progress = 100
+        if progress == 100:
             if sim_job['data_type'] == BackStore.JOB_DATA_TYPE_VOL:
                 data = self.sim_vol_of_id(sim_job['data_id'])
                 data_type = sim_job['data_type']
@@ -1143,7 +1854,7 @@ def lsm_disk_ids_of_pool(self, sim_pool_id):
         return list(
             d['lsm_disk_id']
             for d in self._data_find(
-                'disks_view', 'owner_pool_id="%s"' % sim_pool_id))
+                'disks_view', 'owner_pool_id=?', (sim_pool_id,)))
 
     def sim_disks(self):
         """
@@ -1151,12 +1862,24 @@ def sim_disks(self):
         """
         return self._get_table('disks_view')
 
+    def sim_disk_rows(self, columns):
+        """
+        Return a list of tuples of requested columns of sim_disk.
+        """
+        return self._data_rows('disks_view', columns)
+
     def sim_pools(self):
         """
         Return a list of sim_pool dict.
         """
         return self._get_table('pools_view')
 
+    def sim_pool_rows(self, columns):
+        """
+        Return a list of tuples of requested columns of sim_pool.
+        """
+        return self._data_rows('pools_view', columns)
+
     def sim_pool_of_id(self, sim_pool_id):
         return self._sim_data_of_id(
             "pools_view", sim_pool_id, ErrorNumber.NOT_FOUND_POOL, "Pool")
@@ -1222,13 +1945,13 @@ def sim_pool_create_sub_pool(self, name, parent_pool_id, size,
 
     def sim_pool_disks_count(self, sim_pool_id):
         return self._sql_exec(
-            "SELECT COUNT(id) FROM disks WHERE owner_pool_id=%s;" %
-            sim_pool_id)[0][0]
+            "SELECT COUNT(id) FROM disks WHERE owner_pool_id=?;",
+            (sim_pool_id,))[0][0]
 
     def sim_pool_data_disks_count(self, sim_pool_id=None):
         return self._sql_exec(
             "SELECT COUNT(id) FROM disks WHERE "
-            "owner_pool_id=%s and role='DATA';" % sim_pool_id)[0][0]
+            "owner_pool_id=? and role='DATA';", (sim_pool_id,))[0][0]
 
     def sim_vols(self, sim_ag_id=None):
         """
@@ -1236,13 +1959,22 @@ def sim_vols(self, sim_ag_id=None):
         """
         if sim_ag_id:
             return self._data_find(
-                'volumes_by_ag_view', 'ag_id=%s' % sim_ag_id)
+                'volumes_by_ag_view', 'ag_id=?', (sim_ag_id,))
         else:
             return self._get_table('volumes_view')
 
+    def sim_vol_rows(self, columns, sim_ag_id=None):
+        """
+        Return a list of tuples of requested columns of sim_vol.
+        """
+        if sim_ag_id:
+            return self._data_rows(
+                'volumes_by_ag_view', columns, 'ag_id=?', (sim_ag_id,))
+        return self._data_rows('volumes_view', columns)
+
     def _sim_data_of_id(self, table_name, data_id, lsm_error_no, data_name):
         sim_data = self._data_find(
-            table_name, 'id=%s' % data_id, flag_unique=True)
+            table_name, 'id=?', (data_id,), flag_unique=True)
         if sim_data is None:
             if lsm_error_no:
                 raise LsmError(
@@ -1318,21 +2050,20 @@ def sim_vol_delete(self, sim_vol_id):
                         "Requested volume has child dependency")
         if sim_vol['is_hw_raid_vol']:
             # Reset disk roles
-            for d in self._data_find('disks_view',
-                                     'owner_pool_id="%s"' % sim_vol["pool_id"]):
+            for d in self._data_find('disks_view', 'owner_pool_id=?',
+                                     (sim_vol["pool_id"],)):
                 self._data_update("disks", d["id"], 'role', None)
 
             # Delete the parent pool instead if found a HW RAID volume.
-            self._data_delete("pools", 'id="%s"' % sim_vol['pool_id'])
+            self._data_delete("pools", 'id=?', (sim_vol['pool_id'],))
         else:
-            self._data_delete("volumes", 'id="%s"' % sim_vol_id)
+            self._data_delete("volumes", 'id=?', (sim_vol_id,))
 
     def sim_vol_mask(self, sim_vol_id, sim_ag_id):
         self.sim_vol_of_id(sim_vol_id)
         self.sim_ag_of_id(sim_ag_id)
         exist_mask = self._data_find(
-            'vol_masks', 'ag_id="%s" AND vol_id="%s"' %
-            (sim_ag_id, sim_vol_id))
+            'vol_masks', 'ag_id=? AND vol_id=?', (sim_ag_id, sim_vol_id))
         if exist_mask:
             raise LsmError(
                 ErrorNumber.NO_STATE_CHANGE,
@@ -1346,10 +2077,11 @@ def sim_vol_mask(self, sim_vol_id, sim_ag_id):
     def sim_vol_unmask(self, sim_vol_id, sim_ag_id):
         self.sim_vol_of_id(sim_vol_id)
         self.sim_ag_of_id(sim_ag_id)
-        condition = 'ag_id="%s" AND vol_id="%s"' % (sim_ag_id, sim_vol_id)
-        exist_mask = self._data_find('vol_masks', condition)
+        condition = 'ag_id=? AND vol_id=?'
+        params = (sim_ag_id, sim_vol_id)
+        exist_mask = self._data_find('vol_masks', condition, params)
         if exist_mask:
-            self._data_delete('vol_masks', condition)
+            self._data_delete('vol_masks', condition, params)
         else:
             raise LsmError(
                 ErrorNumber.NO_STATE_CHANGE,
@@ -1359,12 +2091,12 @@ def sim_vol_unmask(self, sim_vol_id, sim_ag_id):
     def _sim_vol_ids_of_masked_ag(self, sim_ag_id):
         return list(
             m['vol_id'] for m in self._data_find(
-                'vol_masks', 'ag_id="%s"' % sim_ag_id))
+                'vol_masks', 'ag_id=?', (sim_ag_id,)))
 
     def _sim_ag_ids_of_masked_vol(self, sim_vol_id):
         return list(
             m['ag_id'] for m in self._data_find(
-                'vol_masks', 'vol_id="%s"' % sim_vol_id))
+                'vol_masks', 'vol_id=?', (sim_vol_id,)))
 
     def sim_vol_resize(self, sim_vol_id, new_size_bytes):
         org_new_size_bytes = new_size_bytes
@@ -1414,18 +2146,24 @@ def dst_sim_vol_ids_of_src(self, src_sim_vol_id):
         self.sim_vol_of_id(src_sim_vol_id)
         return list(
             d['dst_vol_id'] for d in self._data_find(
-                'vol_reps', 'src_vol_id="%s"' % src_sim_vol_id))
+                'vol_reps', 'src_vol_id=?', (src_sim_vol_id,)))
 
     def sim_vol_replica(self, src_sim_vol_id, dst_sim_vol_id, rep_type,
                         blk_ranges=None):
-        self.sim_vol_of_id(src_sim_vol_id)
-        self.sim_vol_of_id(dst_sim_vol_id)
+        """
+        The blk_ranges is a tuple of src_blocks, dst_blocks and block_counts
+        lists, or None for replicating the whole volume. Replicating ranges
+        to the same target again overrides the overlapped old ranges.
+        """
+        src_sim_vol = self.sim_vol_of_id(src_sim_vol_id)
+        dst_sim_vol = self.sim_vol_of_id(dst_sim_vol_id)
 
         # TODO(Gris Ge): Use consumed_size < total_space to reflect the CLONE
         #                type.
+        cur_sim_vol_reps = self._data_find(
+            'vol_reps', 'dst_vol_id=?', (dst_sim_vol_id,))
         cur_src_sim_vol_ids = list(
-            r['src_vol_id'] for r in self._data_find(
-                'vol_reps', 'dst_vol_id="%s"' % dst_sim_vol_id))
+            r['src_vol_id'] for r in cur_sim_vol_reps)
         if len(cur_src_sim_vol_ids) == 1 and \
            cur_src_sim_vol_ids[0] == src_sim_vol_id:
             # src and dst match. Maybe user are overriding old setting.
@@ -1439,15 +2177,45 @@ def sim_vol_replica(self, src_sim_vol_id, dst_sim_vol_id, rep_type,
                 "Target volume is already a replication target for other "
                 "source volume")
 
-        self._data_add(
-            'vol_reps',
-            {
-                'src_vol_id': src_sim_vol_id,
-                'dst_vol_id': dst_sim_vol_id,
-                'rep_type': rep_type,
-            })
+        sim_blk_ranges = None
+        if blk_ranges is not None:
+            if len(blk_ranges[2]) == 0:
+                raise LsmError(
+                    ErrorNumber.INVALID_ARGUMENT, "No block range defined")
+            sim_blk_ranges = SimBlockRanges.validated(
+                blk_ranges[0], blk_ranges[1], blk_ranges[2],
+                src_sim_vol['total_space'] // BackStore.BLK_SIZE,
+                dst_sim_vol['total_space'] // BackStore.BLK_SIZE,
+                src_sim_vol_id == dst_sim_vol_id)
+
+        if not cur_sim_vol_reps:
+            blobs = (None, None, None)
+            if sim_blk_ranges is not None:
+                blobs = sim_blk_ranges.to_blobs()
+            self._data_add(
+                'vol_reps',
+                {
+                    'src_vol_id': src_sim_vol_id,
+                    'dst_vol_id': dst_sim_vol_id,
+                    'rep_type': rep_type,
+                    'src_blocks': blobs[0],
+                    'dst_blocks': blobs[1],
+                    'block_counts': blobs[2],
+                })
+            return
 
-        # No need to trace block range due to lack of query method.
+        # Empty block_counts means whole volume is replicated already.
+        cur_sim_vol_rep = cur_sim_vol_reps[0]
+        blobs = (None, None, None)
+        if sim_blk_ranges is not None and cur_sim_vol_rep['block_counts']:
+            blobs = SimBlockRanges.from_blobs(
+                cur_sim_vol_rep['src_blocks'], cur_sim_vol_rep['dst_blocks'],
+                cur_sim_vol_rep['block_counts']).merged(
+                    sim_blk_ranges).to_blobs()
+        self._sql_exec(
+            "UPDATE vol_reps SET rep_type=?, src_blocks=?, dst_blocks=?, "
+            "block_counts=? WHERE dst_vol_id=?;",
+            (rep_type,) + blobs + (dst_sim_vol_id,))
 
     def sim_vol_src_replica_break(self, src_sim_vol_id):
 
@@ -1456,8 +2224,7 @@ def sim_vol_src_replica_break(self, src_sim_vol_id):
                 ErrorNumber.NO_STATE_CHANGE,
                 "Provided volume is not a replication source")
 
-        self._data_delete(
-            'vol_reps', 'src_vol_id="%s"' % src_sim_vol_id)
+        self._data_delete('vol_reps', 'src_vol_id=?', (src_sim_vol_id,))
 
     def sim_vol_state_change(self, sim_vol_id, new_admin_state):
         sim_vol = self.sim_vol_of_id(sim_vol_id)
@@ -1482,12 +2249,22 @@ def _sim_ag_format(sim_ag):
     def sim_ags(self, sim_vol_id=None):
         if sim_vol_id:
             sim_ags = self._data_find(
-                'ags_by_vol_view', 'vol_id=%s' % sim_vol_id)
+                'ags_by_vol_view', 'vol_id=?', (sim_vol_id,))
         else:
             sim_ags = self._get_table('ags_view')
 
         return [BackStore._sim_ag_format(a) for a in sim_ags]
 
+    def sim_ag_rows(self, columns, sim_vol_id=None):
+        """
+        Return a list of tuples of requested columns of sim_ag, the
+        'init_ids_str' column is not split.
+        """
+        if sim_vol_id:
+            return self._data_rows(
+                'ags_by_vol_view', columns, 'vol_id=?', (sim_vol_id,))
+        return self._data_rows('ags_view', columns)
+
     def _sim_init_create(self, init_type, init_id, sim_ag_id):
         try:
             self._data_add(
@@ -1529,7 +2306,7 @@ def sim_ag_delete(self, sim_ag_id):
                 ErrorNumber.IS_MASKED,
                 "Access group has volume masked to")
 
-        self._data_delete('ags', 'id="%s"' % sim_ag_id)
+        self._data_delete('ags', 'id=?', (sim_ag_id,))
 
     def sim_ag_init_add(self, sim_ag_id, init_id, init_type):
         sim_ag = self.sim_ag_of_id(sim_ag_id)
@@ -1558,7 +2335,7 @@ def sim_ag_init_delete(self, sim_ag_id, init_id):
                 ErrorNumber.LAST_INIT_IN_ACCESS_GROUP,
                 "Refused to remove the last initiator from access group")
 
-        self._data_delete('inits', 'id="%s"' % init_id)
+        self._data_delete('inits', 'id=?', (init_id,))
 
     def sim_ag_of_id(self, sim_ag_id):
         sim_ag = self._sim_data_of_id(
@@ -1573,6 +2350,12 @@ def sim_fss(self):
         """
         return self._get_table('fss_view')
 
+    def sim_fs_rows(self, columns):
+        """
+        Return a list of tuples of requested columns of sim_fs.
+        """
+        return self._data_rows('fss_view', columns)
+
     def sim_fs_of_id(self, sim_fs_id, raise_error=True):
         lsm_error_no = ErrorNumber.NOT_FOUND_FS
         if not raise_error:
@@ -1607,7 +2390,7 @@ def sim_fs_delete(self, sim_fs_id):
                 ErrorNumber.HAS_CHILD_DEPENDENCY,
                 "Requested file system has child dependency")
 
-        self._data_delete("fss", 'id="%s"' % sim_fs_id)
+        self._data_delete("fss", 'id=?', (sim_fs_id,))
 
     def sim_fs_resize(self, sim_fs_id, new_size_bytes):
         org_new_size_bytes = new_size_bytes
@@ -1641,7 +2424,7 @@ def sim_fs_resize(self, sim_fs_id, new_size_bytes):
 
     def sim_fs_snaps(self, sim_fs_id):
         self.sim_fs_of_id(sim_fs_id)
-        return self._data_find('fs_snaps_view', 'fs_id="%s"' % sim_fs_id)
+        return self._data_find('fs_snaps_view', 'fs_id=?', (sim_fs_id,))
 
     def sim_fs_snap_of_id(self, sim_fs_snap_id, sim_fs_id=None):
         sim_fs_snap = self._sim_data_of_id(
@@ -1682,11 +2465,10 @@ def sim_fs_snap_restore(self, sim_fs_id, sim_fs_snap_id, files,
     def sim_fs_snap_delete(self, sim_fs_snap_id, sim_fs_id):
         self.sim_fs_of_id(sim_fs_id)
         self.sim_fs_snap_of_id(sim_fs_snap_id, sim_fs_id)
-        self._data_delete('fs_snaps', 'id="%s"' % sim_fs_snap_id)
+        self._data_delete('fs_snaps', 'id=?', (sim_fs_snap_id,))
 
     def sim_fs_snap_del_by_fs(self, sim_fs_id):
-        sql_cmd = "DELETE FROM fs_snaps WHERE fs_id='%s';" % sim_fs_id
-        self._sql_exec(sql_cmd)
+        self._data_delete('fs_snaps', 'fs_id=?', (sim_fs_id,))
 
     def sim_fs_clone(self, src_sim_fs_id, dst_sim_fs_id, sim_fs_snap_id):
         self.sim_fs_of_id(src_sim_fs_id)
@@ -1721,10 +2503,10 @@ def clone_dst_sim_fs_ids_of_src(self, src_sim_fs_id):
         self.sim_fs_of_id(src_sim_fs_id)
         return list(
             d['dst_fs_id'] for d in self._data_find(
-                'fs_clones', 'src_fs_id="%s"' % src_sim_fs_id))
+                'fs_clones', 'src_fs_id=?', (src_sim_fs_id,)))
 
     def sim_fs_src_clone_break(self, src_sim_fs_id):
-        self._data_delete('fs_clones', 'src_fs_id="%s"' % src_sim_fs_id)
+        self._data_delete('fs_clones', 'src_fs_id=?', (src_sim_fs_id,))
 
     def _sim_exp_format(self, sim_exp):
         for key_name in ['root_hosts', 'rw_hosts', 'ro_hosts']:
@@ -1773,33 +2555,21 @@ def sim_exp_create(self, sim_fs_id, exp_path, root_hosts, rw_hosts,
 
         sim_exp_id = self.lastrowid
 
-        for root_host in root_hosts:
-            self._data_add(
-                'exp_root_hosts',
-                {
-                    'host': root_host,
-                    'exp_id': sim_exp_id,
-                })
-        for rw_host in rw_hosts:
-            self._data_add(
-                'exp_rw_hosts',
-                {
-                    'host': rw_host,
-                    'exp_id': sim_exp_id,
-                })
-        for ro_host in ro_hosts:
-            self._data_add(
-                'exp_ro_hosts',
-                {
-                    'host': ro_host,
-                    'exp_id': sim_exp_id,
-                })
+        self._data_add_many(
+            'exp_root_hosts',
+            [{'host': h, 'exp_id': sim_exp_id} for h in root_hosts])
+        self._data_add_many(
+            'exp_rw_hosts',
+            [{'host': h, 'exp_id': sim_exp_id} for h in rw_hosts])
+        self._data_add_many(
+            'exp_ro_hosts',
+            [{'host': h, 'exp_id': sim_exp_id} for h in ro_hosts])
 
         return sim_exp_id
 
     def sim_exp_delete(self, sim_exp_id):
         self.sim_exp_of_id(sim_exp_id)
-        self._data_delete('exps', 'id="%s"' % sim_exp_id)
+        self._data_delete('exps', 'id=?', (sim_exp_id,))
 
     def sim_tgts(self):
         """
@@ -1833,7 +2603,7 @@ class SimArray(object):
     @staticmethod
     def _lsm_id_to_sim_id(lsm_id, lsm_error):
         try:
-            return int(lsm_id[-BackStore._ID_FMT_LEN:])
+            return int(lsm_id.rsplit('_', 1)[-1])
         except ValueError:
             raise lsm_error
 
@@ -1881,26 +2651,47 @@ def _sim_ag_id_of(ag_id):
                 "File system export not found"))
 
     @_handle_errors
-    def __init__(self, statefile, timeout):
+    def __init__(self, statefile, timeout, profile=None, template=None):
         if statefile is None:
             statefile = SimArray.SIM_DATA_FILE
 
+        if template is not None:
+            BackStore.state_clone(template, statefile, timeout)
+
         self.bs_obj = BackStore(statefile, timeout)
-        self.bs_obj.check_version_and_init()
+        self.bs_obj.check_version_and_init(profile)
         self.statefile = statefile
         self.timeout = timeout
 
-    def _job_create(self, data_type=None, sim_data_id=None):
+    def _job_create(self, data_type=None, sim_data_id=None,
+                    job_op=BackStore.JOB_OP_DEFAULT, size=0):
         sim_job_id = self.bs_obj.sim_job_create(
-            data_type, sim_data_id)
+            data_type, sim_data_id, job_op, size)
         return "JOB_ID_%0*d" % (BackStore._ID_FMT_LEN, sim_job_id)
 
     @_handle_errors
     def job_status(self, job_id, flags=0):
-        sim_job_id = SimArray._sim_job_id_of(job_id)
+        self.bs_obj.trans_begin_read()
+        try:
+            return self._job_status(job_id)
+        finally:
+            self.bs_obj.trans_rollback()
 
+    @_handle_errors
+    def job_status_bulk(self, job_ids, flags=0):
+        """
+        Return a list of job_status() result of each job in the same order
+        as job_ids, all queried in single transaction.
+        """
+        self.bs_obj.trans_begin_read()
+        try:
+            return list(self._job_status(job_id) for job_id in job_ids)
+        finally:
+            self.bs_obj.trans_rollback()
+
+    def _job_status(self, job_id):
         (progress, data_type, sim_data) = self.bs_obj.sim_job_status(
-            sim_job_id)
+            SimArray._sim_job_id_of(job_id))
         status = JobStatus.INPROGRESS
         if progress == 100:
             status = JobStatus.COMPLETE
@@ -1924,7 +2715,7 @@ def job_free(self, job_id, flags=0):
 
     @_handle_errors
     def time_out_set(self, ms, flags=0):
-        self.bs_obj = BackStore(self.statefile, int(int_div(ms, 1000)))
+        self.bs_obj.busy_timeout_set(ms)
         self.timeout = ms
         return None
 
@@ -1968,54 +2759,51 @@ def _sim_vol_2_lsm(sim_vol):
                       sim_vol['admin_state'], BackStore.SYS_ID,
                       sim_vol['lsm_pool_id'])
 
+    # The listing methods fetch these view columns as plain tuples, in the
+    # order used by the converter of rows, instead of sim dicts.
+    _VOL_COLUMNS = ('lsm_vol_id', 'name', 'vpd83', 'total_space',
+                    'admin_state', 'lsm_pool_id')
+
+    @staticmethod
+    def _sim_vol_rows_2_lsm(rows):
+        return [
+            Volume(vol_id, name, vpd83, BackStore.BLK_SIZE,
+                   total_space // BackStore.BLK_SIZE, admin_state,
+                   BackStore.SYS_ID, pool_id)
+            for (vol_id, name, vpd83, total_space, admin_state, pool_id)
+            in rows]
+
     @_handle_errors
     def volumes(self):
-        return list(
-            SimArray._sim_vol_2_lsm(v) for v in self.bs_obj.sim_vols())
+        return SimArray._sim_vol_rows_2_lsm(
+            self.bs_obj.sim_vol_rows(SimArray._VOL_COLUMNS))
 
-    @staticmethod
-    def _sim_pool_2_lsm(sim_pool):
-        pool_id = sim_pool['lsm_pool_id']
-        name = sim_pool['name']
-        total_space = sim_pool['total_space']
-        free_space = sim_pool['free_space']
-        status = sim_pool['status']
-        status_info = sim_pool['status_info']
-        sys_id = BackStore.SYS_ID
-        element_type = sim_pool['element_type']
-        unsupported_actions = sim_pool['unsupported_actions']
-        return Pool(
-            pool_id, name, element_type, unsupported_actions, total_space,
-            free_space, status, status_info, sys_id)
+    _POOL_COLUMNS = ('lsm_pool_id', 'name', 'element_type',
+                     'unsupported_actions', 'total_space', 'free_space',
+                     'status', 'status_info')
 
     @_handle_errors
     def pools(self, flags=0):
-        self.bs_obj.trans_begin()
-        sim_pools = self.bs_obj.sim_pools()
+        self.bs_obj.trans_begin_read()
+        rows = self.bs_obj.sim_pool_rows(SimArray._POOL_COLUMNS)
         self.bs_obj.trans_rollback()
-        return list(
-            SimArray._sim_pool_2_lsm(sim_pool) for sim_pool in sim_pools)
+        return [Pool(*(row + (BackStore.SYS_ID,))) for row in rows]
 
-    @staticmethod
-    def _sim_disk_2_lsm(sim_disk):
-        disk_status = Disk.STATUS_OK
-        if sim_disk['role'] is None:
-            disk_status |= Disk.STATUS_FREE
-
-        return Disk(
-            sim_disk['lsm_disk_id'],
-            sim_disk['name'],
-            sim_disk['disk_type'], BackStore.BLK_SIZE,
-            int(int_div(sim_disk['total_space'], BackStore.BLK_SIZE)),
-            disk_status, BackStore.SYS_ID, _vpd83=sim_disk['vpd83'],
-            _location=sim_disk['location'],
-            _rpm=sim_disk['rpm'], _link_type=sim_disk['link_type'])
+    _DISK_COLUMNS = ('lsm_disk_id', 'name', 'disk_type', 'total_space',
+                     'role', 'vpd83', 'location', 'rpm', 'link_type')
 
     @_handle_errors
     def disks(self):
-        return list(
-            SimArray._sim_disk_2_lsm(sim_disk)
-            for sim_disk in self.bs_obj.sim_disks())
+        return [
+            Disk(disk_id, name, disk_type, BackStore.BLK_SIZE,
+                 total_space // BackStore.BLK_SIZE,
+                 Disk.STATUS_OK if role is not None else
+                 Disk.STATUS_OK | Disk.STATUS_FREE,
+                 BackStore.SYS_ID, _vpd83=vpd83, _location=location,
+                 _rpm=rpm, _link_type=link_type)
+            for (disk_id, name, disk_type, total_space, role, vpd83,
+                 location, rpm, link_type)
+            in self.bs_obj.sim_disk_rows(SimArray._DISK_COLUMNS)]
 
     @_handle_errors
     def volume_create(self, pool_id, vol_name, size_bytes, thinp, flags=0,
@@ -2036,7 +2824,8 @@ def volume_create(self, pool_id, vol_name, size_bytes, thinp, flags=0,
             return new_sim_vol_id
 
         job_id = self._job_create(
-            BackStore.JOB_DATA_TYPE_VOL, new_sim_vol_id)
+            BackStore.JOB_DATA_TYPE_VOL, new_sim_vol_id,
+            BackStore.JOB_OP_ALLOC, size_bytes)
         self.bs_obj.trans_commit()
 
         return job_id, None
@@ -2056,7 +2845,8 @@ def volume_resize(self, vol_id, new_size_bytes, flags=0):
         sim_vol_id = SimArray._sim_vol_id_of(vol_id)
         self.bs_obj.sim_vol_resize(sim_vol_id, new_size_bytes)
         job_id = self._job_create(
-            BackStore.JOB_DATA_TYPE_VOL, sim_vol_id)
+            BackStore.JOB_DATA_TYPE_VOL, sim_vol_id,
+            BackStore.JOB_OP_ALLOC, new_size_bytes)
         self.bs_obj.trans_commit()
 
         return job_id, None
@@ -2077,7 +2867,8 @@ def volume_replicate(self, dst_pool_id, rep_type, src_vol_id, new_vol_name,
         self.bs_obj.sim_vol_replica(src_sim_vol_id, dst_sim_vol_id, rep_type)
 
         job_id = self._job_create(
-            BackStore.JOB_DATA_TYPE_VOL, dst_sim_vol_id)
+            BackStore.JOB_DATA_TYPE_VOL, dst_sim_vol_id,
+            BackStore.JOB_OP_COPY, src_sim_vol['total_space'])
         self.bs_obj.trans_commit()
 
         return job_id, None
@@ -2093,17 +2884,23 @@ def volume_replicate_range_block_size(self, sys_id, flags=0):
     @_handle_errors
     def volume_replicate_range(self, rep_type, src_vol_id, dst_vol_id, ranges,
                                flags=0):
-        self.bs_obj.trans_begin()
+        if isinstance(ranges, BlockRanges):
+            blk_ranges = (ranges.src_blocks, ranges.dest_blocks,
+                          ranges.block_counts)
+        else:
+            blk_ranges = (list(r.src_block for r in ranges),
+                          list(r.dest_block for r in ranges),
+                          list(r.block_count for r in ranges))
 
-        # TODO(Gris Ge): check whether star_blk + count is out of volume
-        #                boundary
-        # TODO(Gris Ge): Should check block overlap.
+        self.bs_obj.trans_begin()
 
         self.bs_obj.sim_vol_replica(
-            SimArray._sim_pool_id_of(src_vol_id),
-            SimArray._sim_pool_id_of(dst_vol_id), rep_type, ranges)
+            SimArray._sim_vol_id_of(src_vol_id),
+            SimArray._sim_vol_id_of(dst_vol_id), rep_type, blk_ranges)
 
-        job_id = self._job_create()
+        job_id = self._job_create(
+            job_op=BackStore.JOB_OP_COPY,
+            size=sum(blk_ranges[2]) * BackStore.BLK_SIZE)
 
         self.bs_obj.trans_commit()
         return job_id
@@ -2145,7 +2942,9 @@ def volume_child_dependency(self, vol_id, flags=0):
         #          block replication, remove replication or raise error?
         #          # Assuming remove replication
         src_sim_vol_id = SimArray._sim_vol_id_of(vol_id)
+        self.bs_obj.trans_begin_read()
         dst_sim_vol_ids = self.bs_obj.dst_sim_vol_ids_of_src(src_sim_vol_id)
+        self.bs_obj.trans_rollback()
         for dst_sim_fs_id in dst_sim_vol_ids:
             if dst_sim_fs_id != src_sim_vol_id:
                 return True
@@ -2168,9 +2967,14 @@ def _sim_fs_2_lsm(sim_fs):
                           sim_fs['total_space'], sim_fs['free_space'],
                           sim_fs['lsm_pool_id'], BackStore.SYS_ID)
 
+    _FS_COLUMNS = ('lsm_fs_id', 'name', 'total_space', 'free_space',
+                   'lsm_pool_id')
+
     @_handle_errors
     def fs(self):
-        return list(SimArray._sim_fs_2_lsm(f) for f in self.bs_obj.sim_fss())
+        return [
+            FileSystem(*(row + (BackStore.SYS_ID,)))
+            for row in self.bs_obj.sim_fs_rows(SimArray._FS_COLUMNS)]
 
     @_handle_errors
     def fs_create(self, pool_id, fs_name, size_bytes, flags=0,
@@ -2186,7 +2990,8 @@ def fs_create(self, pool_id, fs_name, size_bytes, flags=0,
             return new_sim_fs_id
 
         job_id = self._job_create(
-            BackStore.JOB_DATA_TYPE_FS, new_sim_fs_id)
+            BackStore.JOB_DATA_TYPE_FS, new_sim_fs_id,
+            BackStore.JOB_OP_ALLOC, size_bytes)
         self.bs_obj.trans_commit()
 
         return job_id, None
@@ -2204,7 +3009,9 @@ def fs_resize(self, fs_id, new_size_bytes, flags=0):
         sim_fs_id = SimArray._sim_fs_id_of(fs_id)
         self.bs_obj.trans_begin()
         self.bs_obj.sim_fs_resize(sim_fs_id, new_size_bytes)
-        job_id = self._job_create(BackStore.JOB_DATA_TYPE_FS, sim_fs_id)
+        job_id = self._job_create(
+            BackStore.JOB_DATA_TYPE_FS, sim_fs_id, BackStore.JOB_OP_ALLOC,
+            new_size_bytes)
         self.bs_obj.trans_commit()
         return job_id, None
 
@@ -2227,7 +3034,8 @@ def fs_clone(self, src_fs_id, dst_fs_name, snap_id, flags=0):
         self.bs_obj.sim_fs_clone(src_sim_fs_id, dst_sim_fs_id, sim_fs_snap_id)
 
         job_id = self._job_create(
-            BackStore.JOB_DATA_TYPE_FS, dst_sim_fs_id)
+            BackStore.JOB_DATA_TYPE_FS, dst_sim_fs_id,
+            BackStore.JOB_OP_COPY, src_sim_fs['total_space'])
         self.bs_obj.trans_commit()
 
         return job_id, None
@@ -2299,7 +3107,7 @@ def fs_snapshot_restore(self, fs_id, snap_id, files, restore_files,
     def fs_child_dependency(self, fs_id, files, flags=0, _internal_use=False):
         sim_fs_id = SimArray._sim_fs_id_of(fs_id)
         if _internal_use is False:
-            self.bs_obj.trans_begin()
+            self.bs_obj.trans_begin_read()
         if self.bs_obj.clone_dst_sim_fs_ids_of_src(sim_fs_id) == [] and \
            self.bs_obj.sim_fs_snaps(sim_fs_id) == []:
             if _internal_use is False:
@@ -2364,9 +3172,20 @@ def _sim_ag_2_lsm(sim_ag):
                            sim_ag['init_ids'], sim_ag['init_type'],
                            BackStore.SYS_ID)
 
+    _AG_COLUMNS = ('lsm_ag_id', 'name', 'init_ids_str', 'init_type')
+
+    @staticmethod
+    def _sim_ag_rows_2_lsm(rows):
+        return [
+            AccessGroup(ag_id, name,
+                        init_ids_str.split(BackStore._LIST_SPLITTER),
+                        init_type, BackStore.SYS_ID)
+            for (ag_id, name, init_ids_str, init_type) in rows]
+
     @_handle_errors
     def ags(self):
-        return list(SimArray._sim_ag_2_lsm(a) for a in self.bs_obj.sim_ags())
+        return SimArray._sim_ag_rows_2_lsm(
+            self.bs_obj.sim_ag_rows(SimArray._AG_COLUMNS))
 
     @_handle_errors
     def access_group_create(self, name, init_id, init_type, sys_id, flags=0):
@@ -2426,21 +3245,21 @@ def volume_unmask(self, ag_id, vol_id, flags=0):
 
     @_handle_errors
     def volumes_accessible_by_access_group(self, ag_id, flags=0):
-        self.bs_obj.trans_begin()
+        self.bs_obj.trans_begin_read()
 
-        sim_vols = self.bs_obj.sim_vols(
-            sim_ag_id=SimArray._sim_ag_id_of(ag_id))
+        rows = self.bs_obj.sim_vol_rows(
+            SimArray._VOL_COLUMNS, sim_ag_id=SimArray._sim_ag_id_of(ag_id))
 
         self.bs_obj.trans_rollback()
-        return [SimArray._sim_vol_2_lsm(v) for v in sim_vols]
+        return SimArray._sim_vol_rows_2_lsm(rows)
 
     @_handle_errors
     def access_groups_granted_to_volume(self, vol_id, flags=0):
-        self.bs_obj.trans_begin()
-        sim_ags = self.bs_obj.sim_ags(
-            sim_vol_id=SimArray._sim_vol_id_of(vol_id))
+        self.bs_obj.trans_begin_read()
+        rows = self.bs_obj.sim_ag_rows(
+            SimArray._AG_COLUMNS, sim_vol_id=SimArray._sim_vol_id_of(vol_id))
         self.bs_obj.trans_rollback()
-        return [SimArray._sim_ag_2_lsm(a) for a in sim_ags]
+        return SimArray._sim_ag_rows_2_lsm(rows)
 
     @_handle_errors
     def iscsi_chap_auth(self, init_id, in_user, in_pass, out_user, out_pass,
@@ -0,0 +1,281 @@
+# Copyright (C) 2016 Red Hat, Inc.
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import math
+import os
+import random
+import time
+import six
+
+from lsm import LsmError, ErrorNumber, PluginRunner, PluginScheduler
+
+
+class SimFaultProfile(object):
+    """
+    Latency and fault injection for the simulator plug-in, so that client
+    side caching, batching, timeouts and fan-out could be benchmarked
+    without a real storage array.
+
+    The profile is a JSON file, all times are in milliseconds:
+
+        {
+            "seed": 1,
+            "concurrency": 4,
+            "default": {
+                "latency": {"type": "normal", "mean": 20, "stddev": 5},
+                "per_object": 0.01,
+                "error_rate": 0.001,
+                "error": "TIMEOUT"
+            },
+            "methods": {
+                "volumes": {
+                    "latency": {"type": "long_tail", "median": 50,
+                                "sigma": 1.0}
+                }
+            }
+        }
+
+    Supported latency types are:
+        fixed:      {"value": ms}
+        uniform:    {"min": ms, "max": ms}
+        normal:     {"mean": ms, "stddev": ms}
+        long_tail:  {"median": ms, "sigma": float}, log-normal distribution.
+
+    Settings of "methods" override the "default" ones of that method.
+    "per_object" is the extra time spent for each item of returned list.
+    "error" is the name of ErrorNumber raised for "error_rate" of calls.
+    "concurrency" is the maximum number of calls served at once by the
+    simulated array across all plug-in processes using the same state file.
+    """
+
+    # Longest sleep without checking whether the client gave up.
+    _SLEEP_STEP = 0.05
+
+    # Requests which never reach the array.
+    _EXCLUDED_METHODS = frozenset([
+        'plugin_register', 'plugin_unregister', 'plugin_info',
+        'time_out_set', 'time_out_get'])
+
+    _LATENCY_TYPES = {
+        'fixed': (['value'],
+                  lambda rnd, lat: lat['value']),
+        'uniform': (['min', 'max'],
+                    lambda rnd, lat: rnd.uniform(lat['min'], lat['max'])),
+        'normal': (['mean', 'stddev'],
+                   lambda rnd, lat: rnd.gauss(lat['mean'], lat['stddev'])),
+        'long_tail': (['median', 'sigma'],
+                      lambda rnd, lat: rnd.lognormvariate(
+                          math.log(lat['median']), lat['sigma'])),
+    }
+
+    def __init__(self, profile, key, timeout):
+        self._rnd = random.Random(profile.get('seed'))
+        self._default = profile.get('default', {})
+        self._methods = profile.get('methods', {})
+        self._key = key
+        # PluginScheduler timeout is in seconds.
+        self._timeout = timeout / 1000.0
+        self._scheduler = PluginScheduler(profile.get('concurrency', 0))
+
+    @staticmethod
+    def _invalid(msg):
+        return LsmError(ErrorNumber.INVALID_ARGUMENT,
+                        "Invalid simulator fault profile: %s" % msg)
+
+    @staticmethod
+    def _is_number(value):
+        return isinstance(value, (int, float)) and \
+            not isinstance(value, bool)
+
+    @staticmethod
+    def _check_latency(latency):
+        if not isinstance(latency, dict):
+            raise SimFaultProfile._invalid("'latency' should be an object")
+        lat_type = latency.get('type')
+        if not isinstance(lat_type, six.string_types) or \
+           lat_type not in SimFaultProfile._LATENCY_TYPES:
+            raise SimFaultProfile._invalid(
+                "unknown latency type '%s'" % lat_type)
+        for key in SimFaultProfile._LATENCY_TYPES[lat_type][0]:
+            if not SimFaultProfile._is_number(latency.get(key)):
+                raise SimFaultProfile._invalid(
+                    "latency type '%s' require number '%s'" % (lat_type, key))
+        if lat_type == 'uniform' and latency['min'] > latency['max']:
+            raise SimFaultProfile._invalid(
+                "latency type 'uniform' require 'min' not greater than "
+                "'max'")
+        if lat_type == 'normal' and latency['stddev'] < 0:
+            raise SimFaultProfile._invalid(
+                "latency type 'normal' require non-negative 'stddev'")
+        if lat_type == 'long_tail' and \
+           (latency['median'] <= 0 or latency['sigma'] < 0):
+            raise SimFaultProfile._invalid(
+                "latency type 'long_tail' require positive 'median' "
+                "and non-negative 'sigma'")
+
+    @staticmethod
+    def _check(settings, name):
+        """
+        Check the settings of 'default' or of a method named 'name'.
+        """
+        if not isinstance(settings, dict):
+            raise SimFaultProfile._invalid(
+                "settings of '%s' should be an object" % name)
+        if settings.get('latency') is not None:
+            SimFaultProfile._check_latency(settings['latency'])
+        per_object = settings.get('per_object', 0)
+        if not SimFaultProfile._is_number(per_object) or per_object < 0:
+            raise SimFaultProfile._invalid(
+                "'per_object' should be a non-negative number")
+        error_rate = settings.get('error_rate', 0)
+        if not SimFaultProfile._is_number(error_rate) or \
+           not 0 <= error_rate <= 1:
+            raise SimFaultProfile._invalid(
+                "'error_rate' should be a number between 0 and 1")
+        error_name = settings.get('error', 'TIMEOUT')
+        if not isinstance(error_name, six.string_types) or \
+           error_name.startswith('_') or \
+           not isinstance(getattr(ErrorNumber, error_name, None), int):
+            raise SimFaultProfile._invalid("unknown error '%s'" % error_name)
+
+    @staticmethod
+    def _check_profile(profile):
+        if not isinstance(profile, dict):
+            raise SimFaultProfile._invalid("should be a JSON object")
+        seed = profile.get('seed')
+        if seed is not None and not SimFaultProfile._is_number(seed) and \
+           not isinstance(seed, six.string_types):
+            raise SimFaultProfile._invalid(
+                "'seed' should be a number or a string")
+        concurrency = profile.get('concurrency', 0)
+        if not isinstance(concurrency, int) or isinstance(concurrency, bool) \
+           or concurrency < 0:
+            raise SimFaultProfile._invalid(
+                "'concurrency' should be a non-negative integer")
+        SimFaultProfile._check(profile.get('default', {}), 'default')
+        methods = profile.get('methods', {})
+        if not isinstance(methods, dict):
+            raise SimFaultProfile._invalid("'methods' should be an object")
+        for (method, settings) in methods.items():
+            SimFaultProfile._check(settings, method)
+
+    @staticmethod
+    def load(parameters, key, timeout):
+        """
+        The 'key' identifies the simulated array and 'timeout' is the
+        plug-in timeout in milliseconds.
+
+        Return SimFaultProfile defined by 'fault_profile' URI parameter or
+        LSM_SIM_FAULT_PROFILE environment variable, or None if not defined.
+        The 'latency', 'error_rate' and 'concurrency' URI parameters
+        override the default fixed latency, error rate and concurrency.
+        """
+        profile = {}
+        path = parameters.get('fault_profile') or \
+            os.getenv('LSM_SIM_FAULT_PROFILE')
+        if path:
+            try:
+                with open(path) as f:
+                    profile = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                raise SimFaultProfile._invalid("%s: %s" % (path, e))
+            if not isinstance(profile, dict):
+                raise SimFaultProfile._invalid(
+                    "%s: should be a JSON object" % path)
+
+        try:
+            if parameters.get('latency') is not None:
+                default = profile.setdefault('default', {})
+                if isinstance(default, dict):
+                    default['latency'] = {
+                        'type': 'fixed',
+                        'value': float(parameters['latency'])}
+            if parameters.get('error_rate') is not None:
+                default = profile.setdefault('default', {})
+                if isinstance(default, dict):
+                    default['error_rate'] = float(parameters['error_rate'])
+            if parameters.get('concurrency') is not None:
+                profile['concurrency'] = int(parameters['concurrency'])
+        except ValueError as e:
+            raise SimFaultProfile._invalid(str(e))
+
+        SimFaultProfile._check_profile(profile)
+        if not profile:
+            return None
+        return SimFaultProfile(profile, key, timeout)
+
+    def _settings(self, method):
+        settings = dict(self._default)
+        settings.update(self._methods.get(method, {}))
+        return settings
+
+    def _latency(self, settings):
+        latency = settings.get('latency')
+        if latency is None:
+            return 0.0
+        return max(0.0, SimFaultProfile._LATENCY_TYPES[latency['type']][1](
+            self._rnd, latency)) / 1000.0
+
+    @staticmethod
+    def _sleep(seconds):
+        # Sleep in steps to stop once the client cancelled the request or
+        # its deadline passed.
+        ctx = PluginRunner.call_context()
+        end = time.time() + seconds
+        while seconds > 0:
+            step = min(seconds, SimFaultProfile._SLEEP_STEP)
+            remain = ctx.remaining()
+            if remain is not None:
+                step = min(step, remain)
+            time.sleep(step)
+            ctx.check()
+            if remain is not None and remain <= step:
+                raise LsmError(ErrorNumber.TIMEOUT,
+                               "Request deadline exceeded")
+            seconds = end - time.time()
+
+    def _wrap(self, method, func):
+        def wrapper(*args, **kwargs):
+            with self._scheduler.slot(self._key, method, self._timeout):
+                start = time.time()
+                settings = self._settings(method)
+                delay = self._latency(settings)
+
+                if self._rnd.random() < settings.get('error_rate', 0):
+                    SimFaultProfile._sleep(delay)
+                    raise LsmError(
+                        getattr(ErrorNumber, settings.get('error', 'TIMEOUT')),
+                        "Injected fault of %s()" % method)
+
+                result = func(*args, **kwargs)
+                if isinstance(result, list):
+                    delay += settings.get('per_object', 0) * len(result) / \
+                        1000.0
+                SimFaultProfile._sleep(delay - (time.time() - start))
+                return result
+        return wrapper
+
+    def install(self, plugin):
+        """
+        Wrap all public methods of plugin object with the latency and fault
+        injection of this profile.
+        """
+        for method in dir(plugin):
+            if method.startswith('_') or \
+               method in SimFaultProfile._EXCLUDED_METHODS:
+                continue
+            func = getattr(plugin, method)
+            if callable(func):
+                setattr(plugin, method, self._wrap(method, func))
@@ -18,7 +18,10 @@
 from lsm import (uri_parse, VERSION, Capabilities, INfs,
                  IStorageAreaNetwork, search_property, Client)
 
-from lsm.plugin.sim.simarray import SimArray
+import os
+
+from lsm.plugin.sim.simarray import SimArray, BackStore
+from lsm.plugin.sim.simfault import SimFaultProfile
 
 
 class SimPlugin(INfs, IStorageAreaNetwork):
@@ -37,11 +40,24 @@ def plugin_register(self, uri, password, timeout, flags=0):
         # The caller may want to start clean, so we allow the caller to specify
         # a file to store and retrieve individual state.
         qp = uri_parse(uri)
-        if 'parameters' in qp and 'statefile' in qp['parameters'] \
-                and qp['parameters']['statefile'] is not None:
-            self.sim_array = SimArray(qp['parameters']['statefile'], timeout)
-        else:
-            self.sim_array = SimArray(None, timeout)
+        parameters = qp.get('parameters', {})
+
+        # A large inventory could be loaded into new state file by
+        # 'profile' parameter, check BackStore.PROFILES.
+        profile = None
+        if parameters.get('profile') is not None:
+            profile = BackStore.profile_of(parameters['profile'], parameters)
+
+        # New state file could be copied from a prebuilt 'template' state
+        # file instead.
+        self.sim_array = SimArray(parameters.get('statefile'), timeout,
+                                  profile, parameters.get('template'))
+
+        fault_profile = SimFaultProfile.load(
+            parameters, "sim://%s" % os.path.abspath(self.sim_array.statefile),
+            timeout)
+        if fault_profile:
+            fault_profile.install(self)
 
         return None
 
@@ -51,6 +67,9 @@ def plugin_unregister(self, flags=0):
     def job_status(self, job_id, flags=0):
         return self.sim_array.job_status(job_id, flags)
 
+    def job_status_bulk(self, job_ids, flags=0):
+        return self.sim_array.job_status_bulk(job_ids, flags)
+
     def job_free(self, job_id, flags=0):
         return self.sim_array.job_free(job_id, flags)
 
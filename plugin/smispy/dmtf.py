@@ -184,6 +184,9 @@ def op_status_list_conv(conv_dict, dmtf_op_status_list,
 JOB_STATE_STARTING = 3
 JOB_STATE_RUNNING = 4
 JOB_STATE_COMPLETED = 7
+JOB_STATE_TERMINATED = 8
+JOB_STATE_KILLED = 9
+JOB_STATE_EXCEPTION = 10
 
 # CIM_Synchronized['SyncType'] also used by
 # CIM_ReplicationService.CreateElementReplica() 'SyncType' parameter.
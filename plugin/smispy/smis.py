@@ -22,7 +22,7 @@
 from lsm import (IStorageAreaNetwork, uri_parse, LsmError, ErrorNumber,
                  JobStatus, md5, Volume, AccessGroup, Pool,
                  VERSION, TargetPort,
-                 search_property)
+                 search_property, PluginRunner)
 from lsm.plugin.smispy.smis_common import SmisCommon
 from lsm.plugin.smispy import smis_cap
 from lsm.plugin.smispy import smis_sys
@@ -161,9 +161,44 @@ def plugin_register(self, uri, password, timeout, flags=0):
                                "ca_cert_file: '%s' does not exists")
             no_ssl_verify = False
 
+        profile_cache_ttl = None
+        if 'profile_cache_ttl' in u['parameters']:
+            try:
+                profile_cache_ttl = int(u['parameters']['profile_cache_ttl'])
+            except ValueError:
+                raise LsmError(ErrorNumber.INVALID_ARGUMENT,
+                               "profile_cache_ttl: '%s' is not an integer" %
+                               u['parameters']['profile_cache_ttl'])
+
+        workers = None
+        if 'workers' in u['parameters']:
+            try:
+                workers = int(u['parameters']['workers'])
+            except ValueError:
+                raise LsmError(ErrorNumber.INVALID_ARGUMENT,
+                               "workers: '%s' is not an integer" %
+                               u['parameters']['workers'])
+
+        record_path = None
+        if 'record_path' in u['parameters']:
+            record_path = u['parameters']['record_path']
+
+        cache_ttl = None
+        if 'cache_ttl' in u['parameters']:
+            try:
+                cache_ttl = int(u['parameters']['cache_ttl'])
+            except ValueError:
+                raise LsmError(ErrorNumber.INVALID_ARGUMENT,
+                               "cache_ttl: '%s' is not an integer" %
+                               u['parameters']['cache_ttl'])
+
         self._c = SmisCommon(
             url, u['username'], password, namespace, no_ssl_verify,
-            debug_path, system_list, ca_cert_file)
+            debug_path, system_list, ca_cert_file, profile_cache_ttl,
+            workers, record_path, cache_ttl)
+
+        if 'indication_listener' in u['parameters']:
+            self._c.job_listener_start(u['parameters']['indication_listener'])
 
         self.tmo = timeout
 
@@ -177,6 +212,8 @@ def time_out_get(self, flags=0):
 
     @handle_cim_errors
     def plugin_unregister(self, flags=0):
+        if self._c is not None:
+            self._c.close()
         self._c = None
 
     @handle_cim_errors
@@ -315,23 +352,32 @@ def volumes(self, search_key=None, search_value=None, flags=0):
         As 'Block Services Package' is mandatory for 'Array' profile, we
         don't check support status here as startup() already checked 'Array'
         profile.
+        The volumes of each pool are queried in parallel.
         """
         rc = []
         cim_sys_pros = smis_sys.cim_sys_id_pros()
         cim_syss = smis_sys.root_cim_sys(self._c, cim_sys_pros)
         cim_vol_pros = smis_vol.cim_vol_pros()
+
+        def _lsm_vols_of_cim_pool(smis_common, cim_pool):
+            (sys_id, cim_pool) = cim_pool
+            pool_id = smis_pool.pool_id_of_cim_pool(cim_pool)
+            return list(
+                smis_vol.cim_vol_to_lsm_vol(cim_vol, pool_id, sys_id)
+                for cim_vol in smis_vol.cim_vol_of_cim_pool_path(
+                    smis_common, cim_pool.path, cim_vol_pros))
+
+        cim_pools = []
         for cim_sys in cim_syss:
             sys_id = smis_sys.sys_id_of_cim_sys(cim_sys)
             pool_pros = smis_pool.cim_pool_id_pros()
-            cim_pools = smis_pool.cim_pools_of_cim_sys_path(
-                self._c, cim_sys.path, pool_pros)
-            for cim_pool in cim_pools:
-                pool_id = smis_pool.pool_id_of_cim_pool(cim_pool)
-                cim_vols = smis_vol.cim_vol_of_cim_pool_path(
-                    self._c, cim_pool.path, cim_vol_pros)
-                for cim_vol in cim_vols:
-                    rc.append(
-                        smis_vol.cim_vol_to_lsm_vol(cim_vol, pool_id, sys_id))
+            cim_pools.extend(
+                (sys_id, cim_pool)
+                for cim_pool in smis_pool.cim_pools_of_cim_sys_path(
+                    self._c, cim_sys.path, pool_pros))
+        for lsm_vols in self._c.parallel_map(
+                _lsm_vols_of_cim_pool, cim_pools):
+            rc.extend(lsm_vols)
         return search_property(rc, search_key, search_value)
 
     @handle_cim_errors
@@ -353,6 +399,7 @@ def pools(self, search_key=None, search_value=None, flags=0):
             cim_pools = smis_pool.cim_pools_of_cim_sys_path(
                 self._c, cim_sys.path, cim_pool_pros)
             for cim_pool in cim_pools:
+                PluginRunner.call_context().check()
                 rc.append(
                     smis_pool.cim_pool_to_lsm_pool(
                         self._c, cim_pool, system_id))
@@ -1130,7 +1177,7 @@ def _is_access_group(self, cim_spc):
 
     def _cim_spc_of(self, system_id, property_list=None):
         """
-        Return a list of CIM_SCSIProtocolController.
+        Return a generator of CIM_SCSIProtocolController.
         Following SNIA SMIS 'Masking and Mapping Profile':
             CIM_ControllerConfigurationService
                 |
@@ -1139,7 +1186,6 @@ def _cim_spc_of(self, system_id, property_list=None):
             CIM_SCSIProtocolController
         """
         cim_ccs = None
-        rc_cim_spcs = []
 
         if property_list is None:
             property_list = []
@@ -1157,15 +1203,13 @@ def _cim_spc_of(self, system_id, property_list=None):
             raise LsmError(ErrorNumber.NO_SUPPORT,
                            'AccessGroup is not supported by this array')
 
-        cim_spcs = self._c.Associators(
+        cim_spcs = self._c.AssociatorsIter(
             cim_ccs.path,
             AssocClass='CIM_ConcreteDependency',
             ResultClass='CIM_SCSIProtocolController',
             PropertyList=property_list)
-        for cim_spc in cim_spcs:
-            if self._is_access_group(cim_spc):
-                rc_cim_spcs.append(cim_spc)
-        return rc_cim_spcs
+        return (cim_spc for cim_spc in cim_spcs
+                if self._is_access_group(cim_spc))
 
     @handle_cim_errors
     def volumes_accessible_by_access_group(self, access_group, flags=0):
@@ -1198,13 +1242,12 @@ def volumes_accessible_by_access_group(self, access_group, flags=0):
                 self._c, access_group)
             cim_vols = smis_ag.cim_vols_masked_to_cim_spc_path(
                 self._c, cim_spc_path, cim_vol_pros)
-        rc = []
-        for cim_vol in cim_vols:
-            pool_id = smis_pool.pool_id_of_cim_vol(self._c, cim_vol.path)
-            sys_id = smis_sys.sys_id_of_cim_vol(cim_vol)
-            rc.append(
-                smis_vol.cim_vol_to_lsm_vol(cim_vol, pool_id, sys_id))
-        return rc
+        pool_ids = smis_pool.pool_ids_of_cim_vols(
+            self._c, (cim_vol.path for cim_vol in cim_vols))
+        return list(
+            smis_vol.cim_vol_to_lsm_vol(
+                cim_vol, pool_id, smis_sys.sys_id_of_cim_vol(cim_vol))
+            for cim_vol, pool_id in zip(cim_vols, pool_ids))
 
     @handle_cim_errors
     def access_groups_granted_to_volume(self, volume, flags=0):
@@ -1265,7 +1308,7 @@ def _cim_init_mg_of(self, system_id, property_list=None):
 
         cim_gmms = self._c.cim_gmms_of_sys_id(system_id)
 
-        return self._c.Associators(
+        return self._c.AssociatorsIter(
             cim_gmms.path,
             AssocClass='CIM_ServiceAffectsElement',
             ResultClass='CIM_InitiatorMaskingGroup',
@@ -1273,12 +1316,14 @@ def _cim_init_mg_of(self, system_id, property_list=None):
 
     @handle_cim_errors
     def access_groups(self, search_key=None, search_value=None, flags=0):
-        rc = []
         mask_type = smis_cap.mask_type(self._c, raise_error=True)
 
         cim_sys_pros = smis_sys.cim_sys_id_pros()
         cim_syss = smis_sys.root_cim_sys(self._c, cim_sys_pros)
 
+        # Initiators of all systems are resolved in bulk.
+        cim_init_mgs = []
+        cim_spcs = []
         cim_spc_pros = smis_ag.cim_spc_pros()
         for cim_sys in cim_syss:
             if cim_sys.path.classname == 'Clar_StorageSystem':
@@ -1290,23 +1335,20 @@ def access_groups(self, search_key=None, search_value=None, flags=0):
             system_id = smis_sys.sys_id_of_cim_sys(cim_sys)
             if mask_type == smis_cap.MASK_TYPE_GROUP:
                 cim_init_mg_pros = smis_ag.cim_init_mg_pros()
-                cim_init_mgs = self._cim_init_mg_of(
-                    system_id, cim_init_mg_pros)
-                rc.extend(
-                    list(
-                        smis_ag.cim_init_mg_to_lsm_ag(self._c, x, system_id)
-                        for x in cim_init_mgs))
+                cim_init_mgs.extend(
+                    (x, system_id)
+                    for x in self._cim_init_mg_of(system_id, cim_init_mg_pros))
             elif mask_type == smis_cap.MASK_TYPE_MASK:
-                cim_spcs = self._cim_spc_of(system_id, cim_spc_pros)
-                rc.extend(
-                    list(
-                        smis_ag.cim_spc_to_lsm_ag(self._c, cim_spc, system_id)
-                        for cim_spc in cim_spcs))
+                cim_spcs.extend(
+                    (x, system_id)
+                    for x in self._cim_spc_of(system_id, cim_spc_pros))
             else:
                 raise LsmError(ErrorNumber.PLUGIN_BUG,
                                "_get_cim_spc_by_id(): Got invalid mask_type: "
                                "%s" % mask_type)
 
+        rc = smis_ag.cim_init_mgs_to_lsm_ags(self._c, cim_init_mgs)
+        rc.extend(smis_ag.cim_spcs_to_lsm_ags(self._c, cim_spcs))
         return search_property(rc, search_key, search_value)
 
     def _ag_init_add_group(self, access_group, init_id, init_type):
@@ -1489,6 +1531,7 @@ def job_free(self, job_id, flags=0):
                 self._c.DeleteInstance(cim_job.path)
             except pywbem.CIMError:
                 pass
+        self._c.cim_job_forget(job_id)
 
     @handle_cim_errors
     def disks(self, search_key=None, search_value=None, flags=0):
@@ -1502,21 +1545,22 @@ def disks(self, search_key=None, search_value=None, flags=0):
         sub ComputerSystem. To improve performance of listing disks, we will
         use EnumerateInstances(). Which means we have to filter the results
         by ourselves in case URI contain 'system=xxx'.
+        The Primordial CIM_StorageExtent and spare state of all disks are
+        also resolved in bulk, check smis_disk.cim_disks_to_lsm_disks().
         """
-        rc = []
         self._c.profile_check(SmisCommon.SNIA_DISK_LITE_PROFILE,
                               SmisCommon.SMIS_SPEC_VER_1_4,
                               raise_error=True)
         cim_disk_pros = smis_disk.cim_disk_pros()
-        cim_disks = self._c.EnumerateInstances(
+        cim_disks = self._c.EnumerateInstancesIter(
             'CIM_DiskDrive', PropertyList=cim_disk_pros)
-        for cim_disk in cim_disks:
-            if self._c.system_list and \
-               smis_disk.sys_id_of_cim_disk(cim_disk) not in \
-               self._c.system_list:
-                continue
+        if self._c.system_list:
+            cim_disks = (
+                cim_disk for cim_disk in cim_disks
+                if smis_disk.sys_id_of_cim_disk(cim_disk) in
+                self._c.system_list)
 
-            rc.extend([smis_disk.cim_disk_to_lsm_disk(self._c, cim_disk)])
+        rc = smis_disk.cim_disks_to_lsm_disks(self._c, cim_disks)
         return search_property(rc, search_key, search_value)
 
     @staticmethod
@@ -1570,7 +1614,8 @@ def _cim_fc_tgt_to_lsm(cim_fc_tgt, system_id):
         return TargetPort(port_id, port_type, wwpn, wwpn, wwpn, port_name,
                           system_id, plugin_data)
 
-    def _iscsi_node_names_of(self, cim_iscsi_pg_path):
+    @staticmethod
+    def _iscsi_node_names_of(smis_common, cim_iscsi_pg_path):
         """
             CIM_iSCSIProtocolEndpoint
                     |
@@ -1582,7 +1627,7 @@ def _iscsi_node_names_of(self, cim_iscsi_pg_path):
                     v
             CIM_SCSIProtocolController  # iSCSI Node
         """
-        cim_spcs = self._c.Associators(
+        cim_spcs = smis_common.Associators(
             cim_iscsi_pg_path,
             ResultClass='CIM_SCSIProtocolController',
             AssocClass='CIM_SAPAvailableForElement',
@@ -1625,7 +1670,8 @@ def _cim_iscsi_pg_of(self, cim_sys_path, property_list=None):
                     rc.extend([cim_iscsi_pg])
         return rc
 
-    def _cim_iscsi_pg_to_lsm(self, cim_iscsi_pg, system_id):
+    @staticmethod
+    def _cim_iscsi_pg_to_lsm(smis_common, cim_iscsi_pg, system_id):
         """
         Return a list of TargetPort CIM_iSCSIProtocolEndpoint
         Associations:
@@ -1653,7 +1699,7 @@ def _cim_iscsi_pg_to_lsm(self, cim_iscsi_pg, system_id):
         rc = []
         port_type = TargetPort.TYPE_ISCSI
         plugin_data = None
-        cim_tcps = self._c.Associators(
+        cim_tcps = smis_common.Associators(
             cim_iscsi_pg.path,
             ResultClass='CIM_TCPProtocolEndpoint',
             AssocClass='CIM_BindsTo',
@@ -1663,14 +1709,15 @@ def _cim_iscsi_pg_to_lsm(self, cim_iscsi_pg, system_id):
                            "_cim_iscsi_pg_to_lsm():  "
                            "No CIM_TCPProtocolEndpoint associated to %s"
                            % cim_iscsi_pg.path)
-        iscsi_node_names = self._iscsi_node_names_of(cim_iscsi_pg.path)
+        iscsi_node_names = Smis._iscsi_node_names_of(
+            smis_common, cim_iscsi_pg.path)
 
         if len(iscsi_node_names) == 0:
             return []
 
         for cim_tcp in cim_tcps:
             tcp_port = cim_tcp['PortNumber']
-            cim_ips = self._c.Associators(
+            cim_ips = smis_common.Associators(
                 cim_tcp.path,
                 ResultClass='CIM_IPProtocolEndpoint',
                 AssocClass='CIM_BindsTo',
@@ -1703,7 +1750,7 @@ def _cim_iscsi_pg_to_lsm(self, cim_iscsi_pg, system_id):
                 if ipv6_addr[0:29] == '0000:0000:0000:0000:0000:0000':
                     ipv6_addr = ''
 
-                cim_eths = self._c.Associators(
+                cim_eths = smis_common.Associators(
                     cim_ip.path,
                     ResultClass='CIM_EthernetPort',
                     AssocClass='CIM_DeviceSAPImplementation',
@@ -1834,9 +1881,12 @@ def target_ports(self, search_key=None, search_value=None, flags=0):
 
             if flag_iscsi_support:
                 cim_iscsi_pgs = self._cim_iscsi_pg_of(cim_sys.path)
-                for cim_iscsi_pg in cim_iscsi_pgs:
-                    rc.extend(
-                        self._cim_iscsi_pg_to_lsm(cim_iscsi_pg, system_id))
+                for lsm_tps in self._c.parallel_map(
+                        lambda smis_common, cim_iscsi_pg:
+                        Smis._cim_iscsi_pg_to_lsm(
+                            smis_common, cim_iscsi_pg, system_id),
+                        cim_iscsi_pgs):
+                    rc.extend(lsm_tps)
 
         # NetApp is sharing CIM_TCPProtocolEndpoint which
         # cause duplicate TargetPort. It's a long story, they heard my
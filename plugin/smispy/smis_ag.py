@@ -23,7 +23,8 @@
 from lsm import AccessGroup, md5, LsmError, ErrorNumber
 from lsm.plugin.smispy.smis_common import SmisCommon
 from lsm.plugin.smispy import dmtf
-from lsm.plugin.smispy.utils import cim_path_to_path_str, path_str_to_cim_path
+from lsm.plugin.smispy.utils import (cim_path_to_path_str,
+                                     path_str_to_cim_path, cim_path_key)
 
 _CIM_INIT_PROS = ['StorageID', 'IDType']
 
@@ -129,13 +130,94 @@ def cim_init_of_cim_spc_path(smis_common, cim_spc_path):
     return cim_inits
 
 
-def cim_spc_to_lsm_ag(smis_common, cim_spc, system_id):
+def _cim_init_of_key(smis_common):
+    """
+    Return a dictionary of all CIM_StorageHardwareID with cim_path_key() of
+    its path as key.
+    """
+    return dict(
+        (cim_path_key(cim_init.path), cim_init)
+        for cim_init in smis_common.EnumerateInstancesIter(
+            'CIM_StorageHardwareID', PropertyList=_CIM_INIT_PROS))
+
+
+def _assoc_key_pairs(smis_common, assoc_class, role, result_role):
+    """
+    Yield (cim_path_key(role path), cim_path_key(result_role path)) of all
+    instances of association class.
+    """
+    for cim_assoc in smis_common.EnumerateInstancesIter(
+            assoc_class, PropertyList=[role, result_role]):
+        if cim_assoc.get(role) is not None and \
+           cim_assoc.get(result_role) is not None:
+            yield (cim_path_key(cim_assoc[role]),
+                   cim_path_key(cim_assoc[result_role]))
+
+
+def _cim_inits_of_cim_spcs(smis_common, cim_spcs):
+    """
+    Bulk version of cim_init_of_cim_spc_path() for a list of
+    CIM_SCSIProtocolController. Instead of a few calls per SPC and per
+    CIM_AuthorizedPrivilege, all CIM_StorageHardwareID and instances of
+    these association classes are enumerated once and joined here:
+        CIM_AssociatedPrivilege             # Method A
+        CIM_AuthorizedTarget                # Method B
+        CIM_AuthorizedSubject               # Method B
+    Return a dictionary with cim_path_key() of SPC path as key and list of
+    CIM_StorageHardwareID as value, or None if provider failed to enumerate
+    association instances.
+    """
+    spc_keys = list(cim_path_key(cim_spc.path) for cim_spc in cim_spcs)
+    try:
+        cim_init_of_key = _cim_init_of_key(smis_common)
+
+        rc = {}
+        if smis_common.profile_check(SmisCommon.SNIA_MASK_PROFILE,
+                                     SmisCommon.SMIS_SPEC_VER_1_6,
+                                     raise_error=False):
+            for (spc_key, init_key) in _assoc_key_pairs(
+                    smis_common, 'CIM_AssociatedPrivilege', 'Target',
+                    'Subject'):
+                if init_key in cim_init_of_key:
+                    rc.setdefault(spc_key, []).append(
+                        cim_init_of_key[init_key])
+
+        if all(spc_key in rc for spc_key in spc_keys):
+            return rc
+
+        init_keys_of_ap_key = {}
+        for (ap_key, init_key) in _assoc_key_pairs(
+                smis_common, 'CIM_AuthorizedSubject', 'Privilege',
+                'PrivilegedElement'):
+            init_keys_of_ap_key.setdefault(ap_key, []).append(init_key)
+
+        method_b_rc = {}
+        for (spc_key, ap_key) in _assoc_key_pairs(
+                smis_common, 'CIM_AuthorizedTarget', 'TargetElement',
+                'Privilege'):
+            for init_key in init_keys_of_ap_key.get(ap_key, []):
+                if init_key in cim_init_of_key:
+                    method_b_rc.setdefault(spc_key, []).append(
+                        cim_init_of_key[init_key])
+    except pywbem.CIMError:
+        return None
+
+    # Like cim_init_of_cim_spc_path(), method B is only used when method A
+    # found nothing.
+    method_b_rc.update(rc)
+    return method_b_rc
+
+
+def cim_spc_to_lsm_ag(smis_common, cim_spc, system_id, cim_inits=None):
     """
     Convert CIM_SCSIProtocolController to lsm.AccessGroup
+    The cim_inits is the list of CIM_StorageHardwareID of this SPC, will be
+    queried from provider if not defined.
     """
     ag_id = md5(cim_spc['DeviceID'])
     ag_name = cim_spc['ElementName']
-    cim_inits = cim_init_of_cim_spc_path(smis_common, cim_spc.path)
+    if cim_inits is None:
+        cim_inits = cim_init_of_cim_spc_path(smis_common, cim_spc.path)
     (init_ids, init_type) = _init_id_and_type_of(cim_inits)
     plugin_data = cim_path_to_path_str(cim_spc.path)
     return AccessGroup(
@@ -159,19 +241,93 @@ def cim_init_of_cim_init_mg_path(smis_common, cim_init_mg_path):
         PropertyList=_CIM_INIT_PROS)
 
 
-def cim_init_mg_to_lsm_ag(smis_common, cim_init_mg, system_id):
+def _cim_inits_of_cim_init_mgs(smis_common, cim_init_mgs):
+    """
+    Bulk version of cim_init_of_cim_init_mg_path() for a list of
+    CIM_InitiatorMaskingGroup by enumerating all CIM_StorageHardwareID and
+    CIM_MemberOfCollection once.
+    Return a dictionary with cim_path_key() of CIM_InitiatorMaskingGroup path
+    as key and list of CIM_StorageHardwareID as value, or None if provider
+    failed to enumerate association instances.
+    """
+    rc = dict(
+        (cim_path_key(cim_init_mg.path), []) for cim_init_mg in cim_init_mgs)
+    try:
+        cim_init_of_key = _cim_init_of_key(smis_common)
+        for (init_mg_key, init_key) in _assoc_key_pairs(
+                smis_common, 'CIM_MemberOfCollection', 'Collection',
+                'Member'):
+            if init_mg_key in rc and init_key in cim_init_of_key:
+                rc[init_mg_key].append(cim_init_of_key[init_key])
+    except pywbem.CIMError:
+        return None
+    return rc
+
+
+def cim_init_mg_to_lsm_ag(smis_common, cim_init_mg, system_id,
+                          cim_inits=None):
     """
     Convert CIM_InitiatorMaskingGroup to lsm.AccessGroup
+    The cim_inits is the list of CIM_StorageHardwareID of this group, will be
+    queried from provider if not defined.
     """
     ag_name = cim_init_mg['ElementName']
     ag_id = md5(cim_init_mg['InstanceID'])
-    cim_inits = cim_init_of_cim_init_mg_path(smis_common, cim_init_mg.path)
+    if cim_inits is None:
+        cim_inits = cim_init_of_cim_init_mg_path(
+            smis_common, cim_init_mg.path)
     (init_ids, init_type) = _init_id_and_type_of(cim_inits)
     plugin_data = cim_path_to_path_str(cim_init_mg.path)
     return AccessGroup(
         ag_id, ag_name, init_ids, init_type, system_id, plugin_data)
 
 
+def cim_spcs_to_lsm_ags(smis_common, cim_spcs_with_sys_id):
+    """
+    Convert a list of (CIM_SCSIProtocolController, system_id) to a list of
+    lsm.AccessGroup, resolving the initiators of all SPCs in bulk.
+    Fall back to querying each SPC in parallel if provider does not support
+    enumerating the association classes.
+    """
+    cim_spcs_with_sys_id = list(cim_spcs_with_sys_id)
+    if len(cim_spcs_with_sys_id) == 0:
+        return []
+    cim_inits_of_key = _cim_inits_of_cim_spcs(
+        smis_common, list(x[0] for x in cim_spcs_with_sys_id))
+    if cim_inits_of_key is None:
+        return smis_common.parallel_map(
+            lambda c, x: cim_spc_to_lsm_ag(c, x[0], x[1]),
+            cim_spcs_with_sys_id)
+    return list(
+        cim_spc_to_lsm_ag(
+            smis_common, cim_spc, system_id,
+            cim_inits_of_key.get(cim_path_key(cim_spc.path), []))
+        for (cim_spc, system_id) in cim_spcs_with_sys_id)
+
+
+def cim_init_mgs_to_lsm_ags(smis_common, cim_init_mgs_with_sys_id):
+    """
+    Convert a list of (CIM_InitiatorMaskingGroup, system_id) to a list of
+    lsm.AccessGroup, resolving the initiators of all groups in bulk.
+    Fall back to querying each group in parallel if provider does not support
+    enumerating the association classes.
+    """
+    cim_init_mgs_with_sys_id = list(cim_init_mgs_with_sys_id)
+    if len(cim_init_mgs_with_sys_id) == 0:
+        return []
+    cim_inits_of_key = _cim_inits_of_cim_init_mgs(
+        smis_common, list(x[0] for x in cim_init_mgs_with_sys_id))
+    if cim_inits_of_key is None:
+        return smis_common.parallel_map(
+            lambda c, x: cim_init_mg_to_lsm_ag(c, x[0], x[1]),
+            cim_init_mgs_with_sys_id)
+    return list(
+        cim_init_mg_to_lsm_ag(
+            smis_common, cim_init_mg, system_id,
+            cim_inits_of_key[cim_path_key(cim_init_mg.path)])
+        for (cim_init_mg, system_id) in cim_init_mgs_with_sys_id)
+
+
 def lsm_ag_to_cim_spc_path(smis_common, lsm_ag):
     """
     Convert lsm.AccessGroup to CIMInstanceName of CIM_SCSIProtocolController
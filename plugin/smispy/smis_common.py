@@ -21,17 +21,29 @@
 #   * Profile register
 #   * WBEM actions: enumerate, associations, getinstance and etc.
 
+import base64
+import collections
+import copy
 import os
 import datetime
+import json
+import tempfile
+import threading
 import time
 import sys
+import unittest
 import six
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
 
-from lsm import LsmError, ErrorNumber, md5
+from lsm import (LsmError, ErrorNumber, md5, PluginRunner, error,
+                 private_dir)
 
 import pywbem
-from lsm.plugin.smispy.utils import merge_list
+from lsm.plugin.smispy.utils import (merge_list, cim_path_to_path_str,
+                                     path_str_to_cim_path, Error)
 from lsm.plugin.smispy import dmtf
+from lsm.plugin.smispy.smis_indication import SmisJobListener
 
 
 def _profile_register_load(wbem_conn):
@@ -95,6 +107,232 @@ def _profile_register_load(wbem_conn):
     return profile_dict, root_blk_cim_rp
 
 
+def _provider_fingerprint(wbem_conn, interop_namespace):
+    """
+    Return a string identifying the version of SMI-S provider, changed when
+    provider is upgraded or reconfigured. Return None if not supported.
+    """
+    try:
+        cim_oms = wbem_conn.EnumerateInstances(
+            'CIM_ObjectManager', namespace=interop_namespace, LocalOnly=False)
+    except pywbem.CIMError:
+        return None
+    if len(cim_oms) == 0:
+        return None
+    return md5(repr(sorted(
+        (str(cim_om.path), sorted((k, str(v)) for k, v in cim_om.items()))
+        for cim_om in cim_oms)))
+
+
+class _ProfileCache(object):
+    """
+    On-disk cache of _profile_register_load() result, saving the profile
+    register walk on every plugin_register() of the same SMI-S provider.
+    Entries expire after 'ttl' seconds and are ignored once the
+    _provider_fingerprint() changed. Any failure of reading or writing the
+    cache falls back to the full profile register walk.
+    The cache folder is only used when private to current user, as anyone
+    able to write into it could make the plug-in trust forged profiles.
+    """
+    _VERSION = 1
+    DEFAULT_TTL = 3600
+
+    def __init__(self, url, username, namespace, ttl, cache_dir=None):
+        self._ttl = ttl
+        if cache_dir is None:
+            cache_dir = os.getenv('LSM_SMISPY_CACHE_DIR') or \
+                _ProfileCache._default_cache_dir()
+        self._cache_dir = cache_dir
+        self._path = os.path.join(
+            cache_dir,
+            "profile_%s.json" % md5("%s %s %s" % (url, username, namespace)))
+
+    @staticmethod
+    def _default_cache_dir():
+        """
+        Return $XDG_CACHE_HOME/lsm_smispy, or ~/.cache/lsm_smispy, if home
+        folder of current user is writable, else a folder named after the
+        uid in temporary folder.
+        """
+        home = os.path.expanduser('~')
+        if home != '~' and os.access(home, os.W_OK):
+            return os.path.join(
+                os.getenv('XDG_CACHE_HOME') or os.path.join(home, '.cache'),
+                'lsm_smispy')
+        return os.path.join(
+            tempfile.gettempdir(), 'lsm_smispy_cache_%d' % os.getuid())
+
+    def _dir_check(self):
+        if private_dir(self._cache_dir):
+            return True
+        error("SMI-S profile cache folder %s is not a folder private to "
+              "uid %d, ignored" % (self._cache_dir, os.getuid()))
+        return False
+
+    def load(self, wbem_conn):
+        """
+        Return (profile_dict, root_blk_cim_rp) or None if not cached.
+        """
+        if self._ttl <= 0 or not self._dir_check():
+            return None
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+            if data['version'] != _ProfileCache._VERSION or \
+               time.time() - data['time'] > self._ttl:
+                return None
+            root_blk_cim_rp_path = path_str_to_cim_path(
+                data['root_blk_cim_rp_path'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+        fingerprint = _provider_fingerprint(
+            wbem_conn, root_blk_cim_rp_path.namespace)
+        if fingerprint is None or fingerprint != data['fingerprint']:
+            return None
+
+        root_blk_cim_rp = pywbem.CIMInstance(
+            root_blk_cim_rp_path.classname, path=root_blk_cim_rp_path)
+        return data['profile_dict'], root_blk_cim_rp
+
+    def save(self, wbem_conn, profile_dict, root_blk_cim_rp):
+        if self._ttl <= 0 or root_blk_cim_rp is None or \
+           root_blk_cim_rp.path is None or \
+           not root_blk_cim_rp.path.namespace:
+            return
+        fingerprint = _provider_fingerprint(
+            wbem_conn, root_blk_cim_rp.path.namespace)
+        if fingerprint is None or not self._dir_check():
+            return
+
+        try:
+            (tmp_fd, tmp_path) = tempfile.mkstemp(dir=self._cache_dir)
+            try:
+                with os.fdopen(tmp_fd, 'w') as f:
+                    json.dump({
+                        'version': _ProfileCache._VERSION,
+                        'time': time.time(),
+                        'fingerprint': fingerprint,
+                        'profile_dict': profile_dict,
+                        'root_blk_cim_rp_path':
+                            cim_path_to_path_str(root_blk_cim_rp.path),
+                    }, f)
+                os.rename(tmp_path, self._path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+
+
+class _WbemRecorder(object):
+    """
+    Append the CIM-XML request and reply of every WBEM operation to a JSON
+    lines file:
+        {"request": "<?xml ...", "reply": "<?xml ..."}
+    The file could be replayed by 'test/smis_benchmark.py --serve'.
+    """
+    _OPERATIONS = [
+        'EnumerateInstances', 'EnumerateInstanceNames', 'GetInstance',
+        'Associators', 'AssociatorNames', 'References', 'ReferenceNames',
+        'InvokeMethod', 'DeleteInstance', 'OpenEnumerateInstances',
+        'OpenAssociatorInstances', 'PullInstancesWithPath',
+        'CloseEnumeration']
+
+    def __init__(self, record_path):
+        self._record_path = record_path
+        self._lock = threading.Lock()
+
+    def install(self, wbem_conn):
+        wbem_conn.debug = True
+        last = [None]
+        for op in _WbemRecorder._OPERATIONS:
+            func = getattr(wbem_conn, op, None)
+            if func is not None:
+                setattr(wbem_conn, op,
+                        self._wrap(wbem_conn, func, last))
+
+    def _wrap(self, wbem_conn, func, last):
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._save(wbem_conn, last)
+        return wrapper
+
+    @staticmethod
+    def _text(data):
+        if isinstance(data, six.binary_type):
+            return data.decode('utf-8')
+        return data
+
+    def _save(self, wbem_conn, last):
+        # Newer pywbem prettify last_request and last_reply.
+        request = getattr(wbem_conn, 'last_raw_request', None) or \
+            wbem_conn.last_request
+        reply = getattr(wbem_conn, 'last_raw_reply', None) or \
+            wbem_conn.last_reply
+        # Nothing sent, like connection failure.
+        if not request or not reply or request is last[0]:
+            return
+        last[0] = request
+        with self._lock:
+            with open(self._record_path, 'a') as f:
+                f.write(json.dumps({'request': _WbemRecorder._text(request),
+                                    'reply': _WbemRecorder._text(reply)}))
+                f.write('\n')
+
+
+class _CimCache(object):
+    """
+    In-memory cache of WBEM query results of one plugin session, for
+    queries of objects rarely changed like IDs of root CIM_ComputerSystem and
+    services. Entries are keyed by operation, object path or class name
+    and query parameters like AssocClass, ResultClass and PropertyList.
+    Entries expire after 'ttl' seconds, only the MAX_ENTRIES most recently
+    used entries are kept. Shared by the parallel_map() workers.
+    """
+    DEFAULT_TTL = 60
+    MAX_ENTRIES = 256
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def key(operation, obj, params):
+        return (operation, str(obj), tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v)
+            for k, v in params.items())))
+
+    def get(self, key):
+        """
+        Return cached result or None.
+        """
+        if self._ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or time.time() - entry[0] > self._ttl:
+                return None
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, result):
+        if self._ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), result)
+            while len(self._entries) > _CimCache.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 def _profile_check(profile_dict, profile_name, spec_ver,
                    raise_error=False):
     """
@@ -186,14 +424,43 @@ class SmisCommon(object):
     _INVOKE_MAX_LOOP_COUNT = 60
     _INVOKE_CHECK_INTERVAL = 5
 
+    # Maximum number of instances in each reply of DMTF DSP0200 pull
+    # operations.
+    PULL_MAX_OBJECT_COUNT = 500
+    # CIMError of Open*() pull operations indicating we should use the
+    # single-shot operations instead.
+    _PULL_FALLBACK_ERRORS = [pywbem.CIM_ERR_NOT_SUPPORTED,
+                             pywbem.CIM_ERR_FAILED]
+
+    # Maximum number of WBEM connections used by parallel_map().
+    DEFAULT_WORKERS = 4
+
+    # Maximum number of CIM_ConcreteJob paths remembered by a session.
+    _MAX_CIM_JOB_PATHS = 1024
+
     def __init__(self, url, username, password,
                  namespace=dmtf.DEFAULT_NAMESPACE,
                  no_ssl_verify=False, debug_path=None, system_list=None,
-                 ca_cert_file=None):
+                 ca_cert_file=None, profile_cache_ttl=None, workers=None,
+                 record_path=None, cache_ttl=None):
         self._wbem_conn = None
         self._profile_dict = {}
         self.root_blk_cim_rp = None    # For root_cim_
         self._vendor_product = None     # For vendor workaround codes.
+        self._pull_supported = True
+        self._workers = workers
+        if self._workers is None:
+            self._workers = SmisCommon.DEFAULT_WORKERS
+        self._idle_workers = queue.Queue()
+        # md5 of CIM_ConcreteJob['InstanceID'] to CIMInstanceName
+        self._cim_job_path_of_md5 = collections.OrderedDict()
+        self._job_listener = None
+        if cache_ttl is None:
+            cache_ttl = _CimCache.DEFAULT_TTL
+        self._cim_cache = _CimCache(cache_ttl)
+        self._recorder = None
+        if record_path is not None:
+            self._recorder = _WbemRecorder(record_path)
         self.system_list = system_list
         self._debug_path = debug_path
         self._ca_cert_file = ca_cert_file
@@ -201,20 +468,9 @@ def __init__(self, url, username, password,
         if namespace is None:
             namespace = dmtf.DEFAULT_NAMESPACE
 
-        self._wbem_conn = pywbem.WBEMConnection(
-            url, (username, password), namespace, ca_certs=self._ca_cert_file)
-        if no_ssl_verify:
-            try:
-                self._wbem_conn = pywbem.WBEMConnection(
-                    url, (username, password), namespace,
-                    no_verification=True)
-            except TypeError:
-                # pywbem is not holding fix from
-                # https://bugzilla.redhat.com/show_bug.cgi?id=1039801
-                pass
-
-        if debug_path is not None:
-            self._wbem_conn.debug = True
+        self._wbem_conn_args = (
+            url, (username, password), namespace, no_ssl_verify)
+        self._wbem_conn = self._wbem_conn_new()
 
         if namespace.lower() == SmisCommon._MEGARAID_NAMESPACE.lower():
             # Skip profile register check on MegaRAID for better performance.
@@ -229,8 +485,18 @@ def __init__(self, url, username, password,
             }
             self._vendor_product = SmisCommon._PRODUCT_MEGARAID
         else:
-            (self._profile_dict, self.root_blk_cim_rp) = \
-                _profile_register_load(self._wbem_conn)
+            if profile_cache_ttl is None:
+                profile_cache_ttl = _ProfileCache.DEFAULT_TTL
+            profile_cache = _ProfileCache(
+                url, username, namespace, profile_cache_ttl)
+            cached = profile_cache.load(self._wbem_conn)
+            if cached is not None:
+                (self._profile_dict, self.root_blk_cim_rp) = cached
+            else:
+                (self._profile_dict, self.root_blk_cim_rp) = \
+                    _profile_register_load(self._wbem_conn)
+                profile_cache.save(
+                    self._wbem_conn, self._profile_dict, self.root_blk_cim_rp)
 
         if namespace.lower() == SmisCommon._NETAPP_E_NAMESPACE.lower():
             self._vendor_product = SmisCommon._PRODUCT_NETAPP_E
@@ -251,6 +517,125 @@ def __init__(self, url, username, password,
             self._profile_dict, SmisCommon.SNIA_BLK_ROOT_PROFILE,
             SmisCommon.SMIS_SPEC_VER_1_4, raise_error=True)
 
+    def job_listener_start(self, listener_url):
+        """
+        Start a local CIM indication listener for CIM_ConcreteJob, so that
+        cim_job_of_job_id() could skip the query to provider for finished
+        jobs. Failure is logged and job status will be polled as usual.
+        """
+        try:
+            namespace = self._wbem_conn.default_namespace
+            if namespace in dmtf.INTEROP_NAMESPACES:
+                namespace = self._vendor_namespace()
+            self._job_listener = SmisJobListener(
+                self._wbem_conn_new(), namespace, listener_url)
+        except LsmError:
+            raise
+        except Exception as e:
+            error("Failed to start CIM indication listener on %s: %s" %
+                  (listener_url, e))
+
+    def close(self):
+        if self._job_listener is not None:
+            try:
+                self._job_listener.close()
+            except Exception as e:
+                error("Failed to remove CIM indication subscription: %s" % e)
+            self._job_listener = None
+        # Release the WBEM connections of parallel_map() workers.
+        while True:
+            try:
+                worker = self._idle_workers.get_nowait()
+            except queue.Empty:
+                break
+            # WBEMConnection.close() only exists since pywbem 1.0, older
+            # versions do not keep the connection open.
+            if hasattr(worker._wbem_conn, 'close'):
+                try:
+                    worker._wbem_conn.close()
+                except Exception as e:
+                    error("Failed to close WBEM connection: %s" % e)
+            worker._wbem_conn = None
+
+    def _wbem_conn_new(self):
+        (url, creds, namespace, no_ssl_verify) = self._wbem_conn_args
+        wbem_conn = pywbem.WBEMConnection(
+            url, creds, namespace, ca_certs=self._ca_cert_file)
+        if no_ssl_verify:
+            try:
+                wbem_conn = pywbem.WBEMConnection(
+                    url, creds, namespace, no_verification=True)
+            except TypeError:
+                # pywbem is not holding fix from
+                # https://bugzilla.redhat.com/show_bug.cgi?id=1039801
+                pass
+
+        if self._debug_path is not None:
+            wbem_conn.debug = True
+        if self._recorder is not None:
+            self._recorder.install(wbem_conn)
+        return wbem_conn
+
+    def _worker_get(self):
+        """
+        Return an idle copy of this SmisCommon using its own WBEM connection.
+        """
+        try:
+            return self._idle_workers.get_nowait()
+        except queue.Empty:
+            pass
+        worker = copy.copy(self)
+        worker._wbem_conn = self._wbem_conn_new()
+        worker._wbem_conn.default_namespace = \
+            self._wbem_conn.default_namespace
+        # No nested thread pool.
+        worker._workers = 1
+        return worker
+
+    def parallel_map(self, func, items):
+        """
+        Usage:
+            Run independent WBEM queries in parallel, for example one
+            Associators() call per CIM_StoragePool.
+            Up to 'workers' items are processed at the same time, each by a
+            copy of this SmisCommon holding its own WBEM connection, as
+            pywbem.WBEMConnection is not thread safe. The connections are
+            kept for later calls.
+        Parameter:
+            func    # func(smis_common, item), should only use the
+                    # smis_common argument for WBEM calls.
+            items   # iterable of items.
+        Returns:
+            [func(smis_common, item) for item in items], in the same order
+            as items regardless of completion order.
+            The first exception raised by func() is raised.
+        """
+        items = list(items)
+        # Worker threads do not have the context of the request.
+        ctx = PluginRunner.call_context()
+
+        if self._workers <= 1 or len(items) <= 1:
+            rc = []
+            for item in items:
+                ctx.check()
+                rc.append(func(self, item))
+            return rc
+
+        def _run(item):
+            ctx.check()
+            worker = self._worker_get()
+            try:
+                return func(worker, item)
+            finally:
+                self._idle_workers.put(worker)
+
+        pool = ThreadPool(min(self._workers, len(items)))
+        try:
+            return pool.map(_run, items)
+        finally:
+            pool.close()
+            pool.join()
+
     def profile_check(self, profile_name, spec_ver, raise_error=False):
         """
         Usage:
@@ -288,11 +673,38 @@ def _vendor_namespace(self):
                 ErrorNumber.PLUGIN_BUG,
                 "_vendor_namespace(): self.root_blk_cim_rp not set yet")
 
-    def EnumerateInstances(self, ClassName, namespace=None, **params):
+    def _cached(self, operation, obj, params, func):
+        """
+        Return func() result from the session cache or store it there.
+        A copy is returned so that callers could not modify cached
+        CIMInstance.
+        """
+        key = _CimCache.key(operation, obj, params)
+        result = self._cim_cache.get(key)
+        if result is None:
+            result = func()
+            self._cim_cache.set(key, result)
+        return copy.deepcopy(result)
+
+    def EnumerateInstances(self, ClassName, namespace=None, cache=False,
+                           **params):
+        """
+        With 'cache' set to True, the result is taken from or stored into
+        the session cache, which is cleared by any change requested to the
+        provider. Only use it for objects not changed by others, like
+        services.
+        """
         if self._wbem_conn.default_namespace in dmtf.INTEROP_NAMESPACES:
             # We have to enumerate in vendor namespace
             self._wbem_conn.default_namespace = self._vendor_namespace()
         params['LocalOnly'] = False
+        if cache:
+            return self._cached(
+                'EnumerateInstances',
+                (namespace or self._wbem_conn.default_namespace, ClassName),
+                params,
+                lambda: self._wbem_conn.EnumerateInstances(
+                    ClassName, namespace, **params))
         return self._wbem_conn.EnumerateInstances(
             ClassName, namespace, **params)
 
@@ -300,13 +712,84 @@ def EnumerateInstanceNames(self, ClassName, namespace=None, **params):
         if self._wbem_conn.default_namespace in dmtf.INTEROP_NAMESPACES:
             # We have to enumerate in vendor namespace
             self._wbem_conn.default_namespace = self._vendor_namespace()
-        params['LocalOnly'] = False
         return self._wbem_conn.EnumerateInstanceNames(
             ClassName, namespace, **params)
 
-    def Associators(self, ObjectName, **params):
+    def Associators(self, ObjectName, cache=False, **params):
+        """
+        The 'cache' argument is the same as EnumerateInstances().
+        """
+        if cache:
+            return self._cached(
+                'Associators', ObjectName, params,
+                lambda: self._wbem_conn.Associators(ObjectName, **params))
         return self._wbem_conn.Associators(ObjectName, **params)
 
+    def _pull_iter(self, open_method_name, pull_args, fallback):
+        """
+        Yield CIMInstance using pull operations defined in DMTF DSP0200 1.4,
+        PULL_MAX_OBJECT_COUNT instances per reply. If pywbem or provider
+        does not support pull operations, yield from fallback() instead and
+        stop trying pull operations for this connection.
+        """
+        open_method = getattr(self._wbem_conn, open_method_name, None)
+        if not self._pull_supported or open_method is None:
+            self._pull_supported = False
+            for cim_xxx in fallback():
+                yield cim_xxx
+            return
+
+        try:
+            result = open_method(
+                *pull_args[0], MaxObjectCount=self.PULL_MAX_OBJECT_COUNT,
+                **pull_args[1])
+        except pywbem.CIMError as ce:
+            if ce.args[0] not in SmisCommon._PULL_FALLBACK_ERRORS:
+                raise
+            self._pull_supported = False
+            for cim_xxx in fallback():
+                yield cim_xxx
+            return
+
+        try:
+            while True:
+                for cim_xxx in result.instances:
+                    yield cim_xxx
+                if result.eos:
+                    break
+                result = self._wbem_conn.PullInstancesWithPath(
+                    result.context, MaxObjectCount=self.PULL_MAX_OBJECT_COUNT)
+        finally:
+            if not result.eos:
+                # Consumer stopped early, release provider resources.
+                try:
+                    self._wbem_conn.CloseEnumeration(result.context)
+                except Error:
+                    pass
+
+    def EnumerateInstancesIter(self, ClassName, namespace=None, **params):
+        """
+        Like EnumerateInstances(), but return a generator receiving the
+        instances in batches via pull operations when supported by provider,
+        so that neither provider nor plugin hold the whole reply at once.
+        """
+        if self._wbem_conn.default_namespace in dmtf.INTEROP_NAMESPACES:
+            # We have to enumerate in vendor namespace
+            self._wbem_conn.default_namespace = self._vendor_namespace()
+        # Pull operations always return all properties of sub-classes.
+        return self._pull_iter(
+            'OpenEnumerateInstances', ((ClassName, namespace), params),
+            lambda: self.EnumerateInstances(ClassName, namespace, **params))
+
+    def AssociatorsIter(self, ObjectName, **params):
+        """
+        Like Associators(), but return a generator using pull operations
+        when supported by provider. Check EnumerateInstancesIter().
+        """
+        return self._pull_iter(
+            'OpenAssociatorInstances', ((ObjectName,), params),
+            lambda: self.Associators(ObjectName, **params))
+
     def AssociatorNames(self, ObjectName, **params):
         return self._wbem_conn.AssociatorNames(ObjectName, **params)
 
@@ -315,6 +798,7 @@ def GetInstance(self, InstanceName, **params):
         return self._wbem_conn.GetInstance(InstanceName, **params)
 
     def DeleteInstance(self, InstanceName, **params):
+        self._cim_cache.clear()
         return self._wbem_conn.DeleteInstance(InstanceName, **params)
 
     def References(self, ObjectName, **params):
@@ -340,30 +824,106 @@ def cim_job_of_job_id(self, job_id, property_list=None):
             property_list = merge_list(
                 property_list, SmisCommon.cim_job_pros())
 
-        cim_jobs = self.EnumerateInstances(
-            'CIM_ConcreteJob',
-            PropertyList=property_list)
         real_job_id = SmisCommon.parse_job_id(job_id)[0]
-        for cim_job in cim_jobs:
-            if md5(cim_job['InstanceID']) == real_job_id:
+
+        # Lookup order:
+        #   1. CIMInstanceName of job created by this session.
+        #   2. CIMInstanceName stored in job_id.
+        #   3. Index of all CIM_ConcreteJob, refreshed if not found.
+        cim_job_path = self._cim_job_path_of_md5.get(real_job_id)
+        if cim_job_path is None:
+            cim_job_path = SmisCommon._cim_job_path_of_job_id(job_id)
+        if cim_job_path is None:
+            cim_job_path = self._cim_job_path_index_lookup(real_job_id)
+        if cim_job_path is None:
+            raise LsmError(
+                ErrorNumber.NOT_FOUND_JOB,
+                "Job %s not found" % job_id)
+
+        if self._job_listener is not None:
+            # Finished job reported by CIM indication.
+            cim_job = self._job_listener.cim_job_of(real_job_id, property_list)
+            if cim_job is not None:
+                cim_job.path = cim_job_path
                 return cim_job
 
-        raise LsmError(
-            ErrorNumber.NOT_FOUND_JOB,
-            "Job %s not found" % job_id)
+        try:
+            cim_job = self.GetInstance(
+                cim_job_path, PropertyList=property_list)
+        except pywbem.CIMError as ce:
+            if ce.args[0] != pywbem.CIM_ERR_NOT_FOUND:
+                raise
+            self._cim_job_path_of_md5.pop(real_job_id, None)
+            raise LsmError(
+                ErrorNumber.NOT_FOUND_JOB,
+                "Job %s not found" % job_id)
+        self._cim_job_path_save(real_job_id, cim_job.path)
+        return cim_job
+
+    def cim_job_forget(self, job_id):
+        """
+        Drop the cached information of given job_id.
+        """
+        real_job_id = SmisCommon.parse_job_id(job_id)[0]
+        self._cim_job_path_of_md5.pop(real_job_id, None)
+        if self._job_listener is not None:
+            self._job_listener.forget(real_job_id)
+
+    def _cim_job_path_save(self, real_job_id, cim_job_path):
+        """
+        Remember CIMInstanceName of CIM_ConcreteJob, only the
+        _MAX_CIM_JOB_PATHS most recently used ones are kept.
+        """
+        self._cim_job_path_of_md5.pop(real_job_id, None)
+        self._cim_job_path_of_md5[real_job_id] = cim_job_path
+        while len(self._cim_job_path_of_md5) > SmisCommon._MAX_CIM_JOB_PATHS:
+            self._cim_job_path_of_md5.popitem(last=False)
+
+    def _cim_job_path_index_lookup(self, real_job_id):
+        """
+        Return CIMInstanceName of CIM_ConcreteJob for given md5 of its
+        InstanceID using EnumerateInstanceNames(), or None if not found.
+        Used for jobs created by other sessions or older plugin versions.
+        """
+        for cim_job_path in self.EnumerateInstanceNames('CIM_ConcreteJob'):
+            if md5(cim_job_path['InstanceID']) == real_job_id:
+                return cim_job_path
+        return None
 
     @staticmethod
-    def _job_id_of_cim_job(cim_job, retrieve_data, method_data):
+    def _cim_job_path_of_job_id(job_id):
+        """
+        Return CIMInstanceName of CIM_ConcreteJob stored in job_id or None if
+        not stored or invalid.
+        """
+        tmp_list = job_id.split('@', 1)[0].split(':', 1)
+        if len(tmp_list) != 2:
+            return None
+        try:
+            cim_job_path = path_str_to_cim_path(
+                base64.urlsafe_b64decode(
+                    tmp_list[1].encode('utf-8')).decode('utf-8'))
+            if md5(cim_job_path['InstanceID']) == tmp_list[0]:
+                return cim_job_path
+        except Exception:
+            pass
+        return None
+
+    def _job_id_of_cim_job(self, cim_job_path, retrieve_data, method_data):
         """
-        Return the MD5 has of CIM_ConcreteJob['InstanceID'] in conjunction
-        with '@%s' % retrieve_data
+        Return the MD5 has of CIM_ConcreteJob['InstanceID'] and base64 of
+        its CIMInstanceName in conjunction with '@%s' % retrieve_data
         retrieve_data should be SmisCommon.JOB_RETRIEVE_NONE or
         SmisCommon.JOB_RETRIEVE_VOLUME or etc
         method_data is any string a method would like store for error
         handling by job_status().
         """
-        return "%s@%d@%s" % (
-            md5(cim_job['InstanceID']), int(retrieve_data), str(method_data))
+        md5_str = md5(cim_job_path['InstanceID'])
+        self._cim_job_path_save(md5_str, cim_job_path)
+        path_str = base64.urlsafe_b64encode(
+            cim_path_to_path_str(cim_job_path).encode('utf-8')).decode('utf-8')
+        return "%s:%s@%d@%s" % (
+            md5_str, path_str, int(retrieve_data), str(method_data))
 
     @staticmethod
     def parse_job_id(job_id):
@@ -373,7 +933,7 @@ def parse_job_id(job_id):
         (md5_str, retrieve_data, method_data)
         """
         tmp_list = job_id.split('@', 3)
-        md5_str = tmp_list[0]
+        md5_str = tmp_list[0].split(':', 1)[0]
         retrieve_data = SmisCommon.JOB_RETRIEVE_NONE
         method_data = None
         if len(tmp_list) == 3:
@@ -437,6 +997,8 @@ def invoke_method(self, cmd, cim_path, in_params, out_handler=None,
         """
         if retrieve_data is None:
             retrieve_data = SmisCommon.JOB_RETRIEVE_NONE
+        # Methods invoked are changing configuration.
+        self._cim_cache.clear()
         try:
             (rc, out) = self._wbem_conn.InvokeMethod(
                 cmd, cim_path, **in_params)
@@ -450,7 +1012,7 @@ def invoke_method(self, cmd, cim_path, in_params, out_handler=None,
 
             elif rc == SmisCommon.SNIA_INVOKE_ASYNC:
                 # We have an async operation
-                job_id = SmisCommon._job_id_of_cim_job(
+                job_id = self._job_id_of_cim_job(
                     out['Job'], retrieve_data, method_data)
                 return job_id, None
             elif rc == SmisCommon.SNIA_INVOKE_NOT_SUPPORTED:
@@ -486,6 +1048,7 @@ def invoke_method_wait(self, cmd, cim_path, in_params,
         If flag_out_array is True, return the first element of out[out_key].
         """
         cim_job = dict()
+        self._cim_cache.clear()
         (rc, out) = self._wbem_conn.InvokeMethod(cmd, cim_path, **in_params)
 
         try:
@@ -579,7 +1142,7 @@ def _cim_srv_of_sys_id(self, srv_name, sys_id, raise_error):
 
         try:
             cim_srvs = self.EnumerateInstances(
-                srv_name,
+                srv_name, cache=True,
                 PropertyList=property_list)
             for cim_srv in cim_srvs:
                 if cim_srv['SystemName'] == sys_id:
@@ -664,3 +1227,178 @@ def cim_job_completed_ok(status):
             rc = True
 
         return rc
+
+
+class _TestCimCache(unittest.TestCase):
+    _KEY = _CimCache.key(
+        'EnumerateInstances', ('root/vendor', 'CIM_ComputerSystem'),
+        {'PropertyList': ['Name']})
+
+    def test_expiry(self):
+        cim_cache = _CimCache(0.1)
+        cim_cache.set(_TestCimCache._KEY, [1])
+        self.assertEqual(cim_cache.get(_TestCimCache._KEY), [1])
+        time.sleep(0.2)
+        self.assertTrue(cim_cache.get(_TestCimCache._KEY) is None)
+
+    def test_disabled(self):
+        cim_cache = _CimCache(0)
+        cim_cache.set(_TestCimCache._KEY, [1])
+        self.assertTrue(cim_cache.get(_TestCimCache._KEY) is None)
+
+    def test_clear(self):
+        cim_cache = _CimCache(60)
+        cim_cache.set(_TestCimCache._KEY, [1])
+        cim_cache.clear()
+        self.assertTrue(cim_cache.get(_TestCimCache._KEY) is None)
+
+    def test_max_entries(self):
+        cim_cache = _CimCache(60)
+        for i in range(_CimCache.MAX_ENTRIES + 1):
+            cim_cache.set(i, [i])
+        self.assertTrue(cim_cache.get(0) is None)
+        self.assertEqual(cim_cache.get(_CimCache.MAX_ENTRIES),
+                         [_CimCache.MAX_ENTRIES])
+
+    def test_copy(self):
+        smis_common = SmisCommon.__new__(SmisCommon)
+        smis_common._cim_cache = _CimCache(60)
+        queries = []
+
+        def _query():
+            queries.append(1)
+            return [pywbem.CIMInstance(
+                'CIM_ComputerSystem', properties={'Name': 'sys'})]
+
+        cim_syss = smis_common._cached('EnumerateInstances', 'obj', {},
+                                       _query)
+        cim_syss[0]['Name'] = 'changed'
+        cim_syss.append(None)
+        cim_syss = smis_common._cached('EnumerateInstances', 'obj', {},
+                                       _query)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(cim_syss), 1)
+        self.assertEqual(cim_syss[0]['Name'], 'sys')
+
+
+class _TestCimJobPath(unittest.TestCase):
+    def setUp(self):
+        self.smis_common = SmisCommon.__new__(SmisCommon)
+        self.smis_common._cim_job_path_of_md5 = collections.OrderedDict()
+
+    @staticmethod
+    def _cim_job_path(i):
+        return pywbem.CIMInstanceName(
+            'CIM_ConcreteJob', keybindings={'InstanceID': 'job%d' % i})
+
+    def test_bound(self):
+        for i in range(SmisCommon._MAX_CIM_JOB_PATHS + 1):
+            self.smis_common._cim_job_path_save(
+                md5('job%d' % i), _TestCimJobPath._cim_job_path(i))
+        self.assertEqual(len(self.smis_common._cim_job_path_of_md5),
+                         SmisCommon._MAX_CIM_JOB_PATHS)
+        self.assertFalse(md5('job0') in self.smis_common._cim_job_path_of_md5)
+
+    def test_index_lookup(self):
+        self.smis_common.EnumerateInstanceNames = lambda class_name: list(
+            _TestCimJobPath._cim_job_path(i) for i in range(10))
+        self.assertEqual(
+            self.smis_common._cim_job_path_index_lookup(md5('job5')),
+            _TestCimJobPath._cim_job_path(5))
+        self.assertTrue(
+            self.smis_common._cim_job_path_index_lookup(md5('job10')) is None)
+        # Jobs of other sessions are not remembered.
+        self.assertEqual(len(self.smis_common._cim_job_path_of_md5), 0)
+
+
+class _FakeWbemConn(object):
+    def __init__(self):
+        self.default_namespace = 'root/vendor'
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class _TestParallelMap(unittest.TestCase):
+    def setUp(self):
+        self.smis_common = SmisCommon.__new__(SmisCommon)
+        self.smis_common._workers = 4
+        self.smis_common._idle_workers = queue.Queue()
+        self.smis_common._job_listener = None
+        self.smis_common._wbem_conn = _FakeWbemConn()
+        self.conns = []
+
+        def _wbem_conn_new():
+            self.conns.append(_FakeWbemConn())
+            return self.conns[-1]
+
+        self.smis_common._wbem_conn_new = _wbem_conn_new
+
+    def test_order(self):
+        # Later items finish first.
+        def _func(smis_common, item):
+            time.sleep(0.05 * (8 - item))
+            return item * 10
+
+        self.assertEqual(self.smis_common.parallel_map(_func, range(8)),
+                         list(item * 10 for item in range(8)))
+        self.assertEqual(len(self.conns), 4)
+
+    def test_exception(self):
+        # The exception raised first is propagated, not the first of items.
+        def _func(smis_common, item):
+            if item == 0:
+                time.sleep(0.3)
+                raise LsmError(ErrorNumber.PLUGIN_BUG, "item 0")
+            if item == 2:
+                time.sleep(0.05)
+                raise LsmError(ErrorNumber.TIMEOUT, "item 2")
+            return item
+
+        with self.assertRaises(LsmError) as cm:
+            self.smis_common.parallel_map(_func, range(4))
+        self.assertEqual(cm.exception.code, ErrorNumber.TIMEOUT)
+        # All workers are back in idle queue.
+        self.assertEqual(self.smis_common._idle_workers.qsize(),
+                         len(self.conns))
+
+    def test_no_nested_pool(self):
+        threads = []
+
+        def _inner(smis_common, item):
+            threads.append((item, threading.current_thread()))
+            return item
+
+        def _func(smis_common, item):
+            self.assertTrue(smis_common is not self.smis_common)
+            self.assertTrue(smis_common._wbem_conn in self.conns)
+            rc = smis_common.parallel_map(
+                _inner, ['%d.%d' % (item, i) for i in range(3)])
+            threads.append((item, threading.current_thread()))
+            return rc
+
+        self.assertEqual(len(self.smis_common.parallel_map(_func, range(4))),
+                         4)
+        # Inner items ran in the thread of their outer item.
+        thread_of_item = dict(
+            (item, thread) for (item, thread) in threads
+            if not isinstance(item, str))
+        for (item, thread) in threads:
+            if isinstance(item, str):
+                self.assertTrue(
+                    thread is thread_of_item[int(item.split('.')[0])])
+        self.assertTrue(len(self.conns) <= 4)
+
+    def test_close(self):
+        self.smis_common.parallel_map(lambda smis_common, item: item,
+                                      range(4))
+        self.assertTrue(len(self.conns) > 0)
+        self.smis_common.close()
+        self.assertTrue(all(conn.closed for conn in self.conns))
+        self.assertTrue(self.smis_common._idle_workers.empty())
+        self.assertFalse(self.smis_common._wbem_conn.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,9 +14,12 @@
 #
 # Author: Gris Ge <fge@redhat.com>
 
+import pywbem
+import unittest
+
 from lsm import Disk, md5, LsmError, ErrorNumber
 from lsm.plugin.smispy.smis_common import SmisCommon
-from lsm.plugin.smispy.utils import merge_list
+from lsm.plugin.smispy.utils import merge_list, cim_path_key
 from lsm.plugin.smispy import dmtf
 
 
@@ -138,6 +141,92 @@ def _pri_cim_ext_of_cim_disk(smis_common, cim_disk_path, property_list=None):
                        (cim_disk_path, cim_exts))
 
 
+def _pri_cim_exts_of_cim_disks(smis_common, property_list):
+    """
+    Usage:
+        Find out the Primordial CIM_StorageExtent of all CIM_DiskDrive with
+        a few WBEM calls instead of one Associators() call per disk:
+            1. Enumerate all CIM_MediaPresent association instances.
+            2. Enumerate the CIM_StorageExtent sub-classes they refer to.
+               If they refer to CIM_StorageExtent itself, give up.
+            3. Join them by path locally.
+    Parameter:
+        property_list   # a List of properties needed on returned
+                        # CIM_StorageExtent
+    Returns:
+        A dictionary with cim_path_key() of CIM_DiskDrive path as key and
+        the CIM_Instance of Primordial CIM_StorageExtent as value. Disks
+        not found in it should be queried by _pri_cim_ext_of_cim_disk().
+    """
+    property_list = merge_list(property_list, ['Primordial'])
+    try:
+        cim_mps = smis_common.EnumerateInstances(
+            'CIM_MediaPresent', PropertyList=['Antecedent', 'Dependent'])
+    except pywbem.CIMError:
+        # Provider does not support enumerating association instances.
+        return {}
+
+    disk_key_of_ext_key = {}
+    ext_class_names = set()
+    for cim_mp in cim_mps:
+        if cim_mp['Antecedent'] is None or cim_mp['Dependent'] is None:
+            continue
+        disk_key_of_ext_key[cim_path_key(cim_mp['Dependent'])] = \
+            cim_path_key(cim_mp['Antecedent'])
+        ext_class_names.add(cim_mp['Dependent'].classname)
+
+    # Enumerating the generic class would also return every
+    # CIM_StorageVolume, as sub-class instances are returned regardless
+    # of DeepInheritance.
+    if any(ext_class_name.lower() == 'cim_storageextent'
+           for ext_class_name in ext_class_names):
+        return {}
+
+    rc = {}
+    duplicate_disk_keys = set()
+    for ext_class_name in sorted(ext_class_names):
+        try:
+            cim_exts = smis_common.EnumerateInstances(
+                ext_class_name, PropertyList=property_list)
+        except pywbem.CIMError:
+            # Fall back to per-disk Associators() for all disks.
+            return {}
+        for cim_ext in cim_exts:
+            if not cim_ext.get('Primordial'):
+                continue
+            disk_key = disk_key_of_ext_key.get(cim_path_key(cim_ext.path))
+            if disk_key is None:
+                continue
+            if disk_key in rc:
+                duplicate_disk_keys.add(disk_key)
+            rc[disk_key] = cim_ext
+
+    # Let _pri_cim_ext_of_cim_disk() complain about these.
+    for disk_key in duplicate_disk_keys:
+        del rc[disk_key]
+    return rc
+
+
+def _spare_cim_ext_keys(smis_common):
+    """
+    Return a set of cim_path_key() of all CIM_StorageExtent associated to
+    CIM_StorageRedundancySet by CIM_IsSpare, or None if provider does not
+    support enumerating CIM_IsSpare.
+    """
+    try:
+        cim_iss = smis_common.EnumerateInstances(
+            'CIM_IsSpare', PropertyList=['Antecedent', 'Dependent'])
+    except pywbem.CIMError:
+        return None
+
+    rc = set()
+    for cim_is in cim_iss:
+        for role in ['Antecedent', 'Dependent']:
+            if cim_is[role] is not None:
+                rc.add(cim_path_key(cim_is[role]))
+    return rc
+
+
 # LSIESG_DiskDrive['MediaType']
 # Value was retrieved from MOF file of MegaRAID SMI-S provider.
 _MEGARAID_DISK_MEDIA_TYPE_SSD = 1
@@ -168,25 +257,55 @@ def _disk_type_megaraid(cim_disk):
     return Disk.TYPE_UNKNOWN
 
 
-def cim_disk_to_lsm_disk(smis_common, cim_disk):
+def cim_disks_to_lsm_disks(smis_common, cim_disks):
+    """
+    Convert an iterable of CIM_DiskDrive to a list of lsm.Disk, resolving the
+    Primordial CIM_StorageExtent and spare state of all disks in bulk.
+    """
+    cim_ext_of_disk_key = _pri_cim_exts_of_cim_disks(
+        smis_common, ['BlockSize', 'NumberOfBlocks'])
+    spare_ext_keys = None
+    if smis_common.profile_check(SmisCommon.SNIA_SPARE_DISK_PROFILE,
+                                 SmisCommon.SMIS_SPEC_VER_1_4,
+                                 raise_error=False):
+        spare_ext_keys = _spare_cim_ext_keys(smis_common)
+
+    return [
+        cim_disk_to_lsm_disk(
+            smis_common, cim_disk,
+            cim_ext_of_disk_key.get(cim_path_key(cim_disk.path)),
+            spare_ext_keys)
+        for cim_disk in cim_disks]
+
+
+def cim_disk_to_lsm_disk(smis_common, cim_disk, cim_ext=None,
+                         spare_ext_keys=None):
     """
     Convert CIM_DiskDrive to lsm.Disk.
+    The cim_ext is the Primordial CIM_StorageExtent of this disk and
+    spare_ext_keys is the set of cim_path_key() of spare CIM_StorageExtent,
+    both will be queried from provider if not defined.
     """
     # CIM_DiskDrive does not have disk size information.
     # We have to find out the Primordial CIM_StorageExtent for that.
-    cim_ext = _pri_cim_ext_of_cim_disk(
-        smis_common, cim_disk.path,
-        property_list=['BlockSize', 'NumberOfBlocks'])
+    if cim_ext is None:
+        cim_ext = _pri_cim_ext_of_cim_disk(
+            smis_common, cim_disk.path,
+            property_list=['BlockSize', 'NumberOfBlocks'])
 
     status = _disk_status_of_cim_disk(cim_disk)
     if smis_common.profile_check(SmisCommon.SNIA_SPARE_DISK_PROFILE,
                                  SmisCommon.SMIS_SPEC_VER_1_4,
                                  raise_error=False):
-        cim_srss = smis_common.AssociatorNames(
-            cim_ext.path, AssocClass='CIM_IsSpare',
-            ResultClass='CIM_StorageRedundancySet')
-        if len(cim_srss) >= 1:
-            status |= Disk.STATUS_SPARE_DISK
+        if spare_ext_keys is not None:
+            if cim_path_key(cim_ext.path) in spare_ext_keys:
+                status |= Disk.STATUS_SPARE_DISK
+        else:
+            cim_srss = smis_common.AssociatorNames(
+                cim_ext.path, AssocClass='CIM_IsSpare',
+                ResultClass='CIM_StorageRedundancySet')
+            if len(cim_srss) >= 1:
+                status |= Disk.STATUS_SPARE_DISK
 
     if 'EMCInUse' in list(cim_disk.keys()) and cim_disk['EMCInUse'] is False:
         status |= Disk.STATUS_FREE
@@ -226,3 +345,52 @@ def cim_disk_to_lsm_disk(smis_common, cim_disk):
 
     return Disk(disk_id, name, disk_type, block_size, num_of_block, status,
                 sys_id)
+
+
+class _TestPriCimExtsOfCimDisks(unittest.TestCase):
+    @staticmethod
+    def _smis_common(ext_class_name, enumerated):
+        """
+        Return a fake SmisCommon with one disk whose CIM_MediaPresent
+        refers to an extent of 'ext_class_name'.  Enumerated class names
+        are appended to 'enumerated'.
+        """
+        disk_path = pywbem.CIMInstanceName(
+            'CIM_DiskDrive', keybindings={'DeviceID': 'disk0'})
+        ext_path = pywbem.CIMInstanceName(
+            ext_class_name, keybindings={'DeviceID': 'ext0'})
+
+        def _enumerate_instances(class_name, **kwargs):
+            enumerated.append(class_name)
+            if class_name == 'CIM_MediaPresent':
+                return [pywbem.CIMInstance(
+                    class_name,
+                    properties={'Antecedent': disk_path,
+                                'Dependent': ext_path})]
+            return [pywbem.CIMInstance(
+                ext_class_name, properties={'Primordial': True},
+                path=ext_path)]
+
+        smis_common = SmisCommon.__new__(SmisCommon)
+        smis_common.EnumerateInstances = _enumerate_instances
+        return smis_common
+
+    def test_vendor_class(self):
+        enumerated = []
+        rc = _pri_cim_exts_of_cim_disks(
+            self._smis_common('Vendor_DiskExtent', enumerated), [])
+        self.assertEqual(list(rc.keys()), [(('deviceid', 'disk0'),)])
+        self.assertEqual(enumerated,
+                         ['CIM_MediaPresent', 'Vendor_DiskExtent'])
+
+    def test_generic_class(self):
+        # Never enumerate all CIM_StorageExtent including volumes.
+        enumerated = []
+        rc = _pri_cim_exts_of_cim_disks(
+            self._smis_common('CIM_StorageExtent', enumerated), [])
+        self.assertEqual(rc, {})
+        self.assertEqual(enumerated, ['CIM_MediaPresent'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,406 @@
+# Copyright (C) 2016 Red Hat, Inc.
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module intend to provide CIM indication based tracking of
+CIM_ConcreteJob, so that job_status() does not need to query the SMI-S
+provider once the job is finished.
+"""
+
+import collections
+import errno
+import socket
+import threading
+import unittest
+
+import pywbem
+from six.moves.urllib.parse import urlparse
+
+from lsm import LsmError, ErrorNumber, md5
+from lsm.plugin.smispy import dmtf
+
+try:
+    import pywbem_mock
+except ImportError:
+    pywbem_mock = None
+
+
+class SmisJobListener(object):
+    """
+    Local WBEM listener subscribed to CIM_InstModification indications of
+    CIM_ConcreteJob, as defined in SNIA SMI-S 'Job Control' subprofile:
+
+        CIM_IndicationSubscription
+            |-> CIM_IndicationFilter        # WQL query of job modification
+            |-> CIM_ListenerDestination     # URL of this listener
+
+    Only finished jobs are kept in memory, up to _MAX_CIM_JOBS of them.
+    Indications not sent from the address of the SMI-S provider are dropped.
+
+    The subscription is owned by this listener and removed by close().  Its
+    CIM instances are named after the listener URL, so a subscription left
+    behind by a plug-in killed before close() is removed by the next
+    listener on the same URL instead of piling up on the provider.  Only one
+    listener could use a given port of this host; another connection
+    asking for the same listener URL fails to start its listener and polls
+    job status from the provider.
+    """
+    _SUBSCRIPTION_MANAGER_ID = 'lsm-smispy'
+    _JOB_QUERY = "SELECT * FROM CIM_InstModification " \
+                 "WHERE SourceInstance ISA CIM_ConcreteJob"
+    _FINISHED_JOB_STATES = [
+        dmtf.JOB_STATE_COMPLETED, dmtf.JOB_STATE_TERMINATED,
+        dmtf.JOB_STATE_KILLED, dmtf.JOB_STATE_EXCEPTION]
+    _MAX_CIM_JOBS = 10000
+
+    def __init__(self, wbem_conn, namespace, listener_url):
+        """
+        The 'wbem_conn' is a pywbem.WBEMConnection dedicated to this
+        listener, 'namespace' is the vendor namespace holding
+        CIM_ConcreteJob and 'listener_url' is the 'http://<address>:<port>'
+        URL of this listener reachable from the SMI-S provider.
+        """
+        u = urlparse(listener_url)
+        if u.scheme != 'http' or u.port is None:
+            raise LsmError(ErrorNumber.INVALID_ARGUMENT,
+                           "indication_listener: '%s' is not a "
+                           "'http://<address>:<port>' URL" % listener_url)
+
+        self._lock = threading.Lock()
+        self._cim_jobs = collections.OrderedDict()
+        self._sub_mgr = None
+        self._server_id = None
+        self._provider_addrs = SmisJobListener._addresses_of(
+            urlparse(wbem_conn.url).hostname)
+
+        self._listener = pywbem.WBEMListener(u.hostname, http_port=u.port)
+        self._listener.add_callback(self._on_indication)
+        try:
+            self._listener.start()
+        except Exception as e:
+            if getattr(e, 'errno', None) != errno.EADDRINUSE and \
+               not isinstance(e, getattr(pywbem, 'ListenerPortError', ())):
+                raise
+            raise EnvironmentError(
+                errno.EADDRINUSE,
+                "Port %d is already in use, each connection needs its own "
+                "indication_listener port" % u.port)
+        try:
+            self._subscribe(wbem_conn, namespace, listener_url)
+        except Exception:
+            self.close()
+            raise
+
+    @staticmethod
+    def _addresses_of(hostname):
+        """
+        Return the set of IP addresses of 'hostname', including 'hostname'
+        itself.
+        """
+        addrs = set([hostname])
+        try:
+            for addr_info in socket.getaddrinfo(hostname, None):
+                addrs.add(addr_info[4][0])
+        except socket.error:
+            pass
+        return addrs
+
+    def _subscribe(self, wbem_conn, namespace, listener_url):
+        self._sub_mgr = pywbem.WBEMSubscriptionManager(
+            subscription_manager_id="%s-%s" % (
+                SmisJobListener._SUBSCRIPTION_MANAGER_ID, md5(listener_url)))
+        self._server_id = self._sub_mgr.add_server(
+            pywbem.WBEMServer(wbem_conn))
+        self._stale_subscription_remove()
+
+        if hasattr(self._sub_mgr, 'add_destination'):
+            cim_dests = [self._sub_mgr.add_destination(
+                self._server_id, listener_url, owned=True,
+                destination_id='job')]
+        else:
+            # pywbem older than 1.0
+            cim_dests = self._sub_mgr.add_listener_destinations(
+                self._server_id, listener_url, owned=True)
+
+        cim_filter = self._sub_mgr.add_filter(
+            self._server_id, namespace, SmisJobListener._JOB_QUERY,
+            query_language='WQL', owned=True, filter_id='job')
+        self._sub_mgr.add_subscriptions(
+            self._server_id, cim_filter.path,
+            list(cim_dest.path for cim_dest in cim_dests), owned=True)
+
+    def _stale_subscription_remove(self):
+        """
+        Remove the subscription found by add_server() with our subscription
+        manager ID, left behind by a listener which did not close().
+        """
+        sub_paths = list(
+            cim_sub.path
+            for cim_sub in self._sub_mgr.get_owned_subscriptions(
+                self._server_id))
+        if sub_paths:
+            self._sub_mgr.remove_subscriptions(self._server_id, sub_paths)
+        for cim_filter in self._sub_mgr.get_owned_filters(self._server_id):
+            self._sub_mgr.remove_filter(self._server_id, cim_filter.path)
+        dest_paths = list(
+            cim_dest.path
+            for cim_dest in self._sub_mgr.get_owned_destinations(
+                self._server_id))
+        if dest_paths:
+            self._sub_mgr.remove_destinations(self._server_id, dest_paths)
+
+    def _on_indication(self, indication, host):
+        """
+        Called by the listener thread for each indication received.
+        """
+        # IPv4 address could be mapped into IPv6 by a dual-stack listener.
+        if host not in self._provider_addrs and \
+           host.replace('::ffff:', '', 1) not in self._provider_addrs:
+            return
+
+        cim_job = indication.get('SourceInstance')
+        if not isinstance(cim_job, pywbem.CIMInstance) or \
+           cim_job.get('InstanceID') is None or \
+           cim_job.get('JobState') not in \
+           SmisJobListener._FINISHED_JOB_STATES:
+            return
+
+        with self._lock:
+            self._cim_jobs[md5(cim_job['InstanceID'])] = cim_job
+            while len(self._cim_jobs) > SmisJobListener._MAX_CIM_JOBS:
+                self._cim_jobs.popitem(last=False)
+
+    def cim_job_of(self, real_job_id, property_list):
+        """
+        Return a copy of finished CIM_ConcreteJob with md5 of its InstanceID
+        equal to 'real_job_id', or None if no indication received or any of
+        'property_list' is missing from it.
+        """
+        with self._lock:
+            cim_job = self._cim_jobs.get(real_job_id)
+        if cim_job is None or \
+           any(p not in cim_job for p in property_list):
+            return None
+        return cim_job.copy()
+
+    def forget(self, real_job_id):
+        with self._lock:
+            self._cim_jobs.pop(real_job_id, None)
+
+    def close(self):
+        """
+        Remove the subscription from SMI-S provider and stop listening.
+        """
+        try:
+            if self._server_id is not None:
+                self._sub_mgr.remove_server(self._server_id)
+                self._server_id = None
+        finally:
+            self._listener.stop()
+
+
+_MOCK_INTEROP_MOF = """
+Qualifier Key : boolean = false, Scope(property, reference),
+    Flavor(DisableOverride, ToSubclass);
+Qualifier Association : boolean = false, Scope(association),
+    Flavor(DisableOverride, ToSubclass);
+class CIM_ManagedElement {
+    string ElementName;
+};
+class CIM_Namespace : CIM_ManagedElement {
+    [Key] string SystemCreationClassName;
+    [Key] string SystemName;
+    [Key] string ObjectManagerCreationClassName;
+    [Key] string ObjectManagerName;
+    [Key] string CreationClassName;
+    [Key] string Name;
+    uint16 ClassInfo;
+};
+class CIM_ObjectManager : CIM_ManagedElement {
+    [Key] string SystemCreationClassName;
+    [Key] string SystemName;
+    [Key] string CreationClassName;
+    [Key] string Name;
+};
+class CIM_IndicationFilter : CIM_ManagedElement {
+    [Key] string SystemCreationClassName;
+    [Key] string SystemName;
+    [Key] string CreationClassName;
+    [Key] string Name;
+    string SourceNamespace;
+    string SourceNamespaces[];
+    string Query;
+    string QueryLanguage;
+    boolean IndividualSubscriptionSupported;
+};
+class CIM_ListenerDestination : CIM_ManagedElement {
+    [Key] string SystemCreationClassName;
+    [Key] string SystemName;
+    [Key] string CreationClassName;
+    [Key] string Name;
+    uint16 PersistenceType;
+    string OtherPersistenceType;
+    string Destination;
+};
+class CIM_ListenerDestinationCIMXML : CIM_ListenerDestination {
+    uint16 Protocol;
+};
+[Association] class CIM_IndicationSubscription {
+    [Key] CIM_IndicationFilter REF Filter;
+    [Key] CIM_ListenerDestination REF Handler;
+    uint16 OnFatalErrorPolicy;
+    uint16 SubscriptionState;
+    uint16 RepeatNotificationPolicy;
+    uint64 SubscriptionDuration;
+    datetime SubscriptionStartTime;
+    uint64 SubscriptionTimeRemaining;
+    datetime TimeOfLastStateChange;
+};
+"""
+
+
+@unittest.skipIf(pywbem_mock is None, "pywbem_mock not available")
+class _TestSmisJobListener(unittest.TestCase):
+    """
+    Subscription through a pywbem_mock provider holding the DMTF classes
+    required by pywbem.WBEMSubscriptionManager.
+    """
+    _INTEROP = 'interop'
+    _NAMESPACE = 'root/vendor'
+
+    def setUp(self):
+        self.conn = pywbem_mock.FakedWBEMConnection(
+            url='http://127.0.0.1:5988')
+        self.conn.add_namespace(_TestSmisJobListener._INTEROP)
+        self.conn.add_namespace(_TestSmisJobListener._NAMESPACE)
+        self.conn.compile_mof_string(
+            _MOCK_INTEROP_MOF, namespace=_TestSmisJobListener._INTEROP)
+        keys = dict(SystemCreationClassName='CIM_ComputerSystem',
+                    SystemName='mock', CreationClassName='CIM_ObjectManager',
+                    Name='mock')
+        cim_om = pywbem.CIMInstance(
+            'CIM_ObjectManager', properties=dict(ElementName='Mock', **keys),
+            path=pywbem.CIMInstanceName(
+                'CIM_ObjectManager', keybindings=keys,
+                namespace=_TestSmisJobListener._INTEROP))
+        self.conn.add_cimobjects(
+            cim_om, namespace=_TestSmisJobListener._INTEROP)
+        for provider in [pywbem_mock.CIMNamespaceProvider,
+                         pywbem_mock.CIMIndicationFilterProvider,
+                         pywbem_mock.CIMListenerDestinationProvider,
+                         pywbem_mock.CIMIndicationSubscriptionProvider]:
+            self.conn.register_provider(
+                provider(self.conn.cimrepository),
+                namespaces=_TestSmisJobListener._INTEROP)
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%d' % s.getsockname()[1]
+        s.close()
+
+    def _cim_count(self, class_name):
+        return len(self.conn.EnumerateInstances(
+            class_name, namespace=_TestSmisJobListener._INTEROP))
+
+    def _listener_new(self):
+        return SmisJobListener(
+            self.conn, _TestSmisJobListener._NAMESPACE, self.url)
+
+    def test_subscription(self):
+        listener = self._listener_new()
+        try:
+            self.assertEqual(
+                self._cim_count('CIM_IndicationSubscription'), 1)
+            cim_filters = self.conn.EnumerateInstances(
+                'CIM_IndicationFilter',
+                namespace=_TestSmisJobListener._INTEROP)
+            self.assertEqual(len(cim_filters), 1)
+            self.assertEqual(cim_filters[0]['Query'],
+                             SmisJobListener._JOB_QUERY)
+            cim_dests = self.conn.EnumerateInstances(
+                'CIM_ListenerDestinationCIMXML',
+                namespace=_TestSmisJobListener._INTEROP)
+            self.assertEqual(len(cim_dests), 1)
+            self.assertEqual(cim_dests[0]['Destination'], self.url)
+        finally:
+            listener.close()
+        for class_name in ['CIM_IndicationSubscription',
+                           'CIM_IndicationFilter',
+                           'CIM_ListenerDestinationCIMXML']:
+            self.assertEqual(self._cim_count(class_name), 0)
+
+    def test_stale_subscription(self):
+        # Plug-in killed without close(), subscription is left behind.
+        self._listener_new()._listener.stop()
+        self.assertEqual(self._cim_count('CIM_IndicationSubscription'), 1)
+
+        listener = self._listener_new()
+        try:
+            self.assertEqual(
+                self._cim_count('CIM_IndicationSubscription'), 1)
+            self.assertEqual(self._cim_count('CIM_IndicationFilter'), 1)
+        finally:
+            listener.close()
+        self.assertEqual(self._cim_count('CIM_IndicationSubscription'), 0)
+
+    def test_port_in_use(self):
+        listener = self._listener_new()
+        try:
+            with self.assertRaises(EnvironmentError) as cm:
+                self._listener_new()
+            self.assertEqual(cm.exception.errno, errno.EADDRINUSE)
+            self.assertEqual(
+                self._cim_count('CIM_IndicationSubscription'), 1)
+        finally:
+            listener.close()
+
+    def test_indication(self):
+        listener = self._listener_new()
+        try:
+            def _indication(job_id, job_state):
+                cim_job = pywbem.CIMInstance(
+                    'CIM_ConcreteJob',
+                    properties=dict(InstanceID=job_id,
+                                    JobState=pywbem.Uint16(job_state)))
+                return pywbem.CIMInstance(
+                    'CIM_InstModification',
+                    properties=dict(SourceInstance=cim_job))
+
+            listener._on_indication(
+                _indication('running', dmtf.JOB_STATE_RUNNING), '127.0.0.1')
+            listener._on_indication(
+                _indication('spoofed', dmtf.JOB_STATE_COMPLETED),
+                '192.0.2.1')
+            listener._on_indication(
+                _indication('done', dmtf.JOB_STATE_COMPLETED),
+                '::ffff:127.0.0.1')
+
+            self.assertTrue(
+                listener.cim_job_of(md5('running'), ['JobState']) is None)
+            self.assertTrue(
+                listener.cim_job_of(md5('spoofed'), ['JobState']) is None)
+            cim_job = listener.cim_job_of(md5('done'), ['JobState'])
+            self.assertEqual(cim_job['JobState'], dmtf.JOB_STATE_COMPLETED)
+            self.assertTrue(
+                listener.cim_job_of(md5('done'), ['ErrorCode']) is None)
+
+            listener.forget(md5('done'))
+            self.assertTrue(
+                listener.cim_job_of(md5('done'), ['JobState']) is None)
+        finally:
+            listener.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
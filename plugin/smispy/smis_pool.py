@@ -14,9 +14,12 @@
 #
 # Author: Gris Ge <fge@redhat.com>
 
+import pywbem
+import unittest
+
 from lsm.plugin.smispy.utils import (merge_list, path_str_to_cim_path,
-                                     cim_path_to_path_str)
-from lsm.plugin.smispy import dmtf
+                                     cim_path_to_path_str, cim_path_key)
+from lsm.plugin.smispy import dmtf, smis_sys
 
 
 from lsm import LsmError, ErrorNumber, Pool
@@ -266,3 +269,195 @@ def pool_id_of_cim_vol(smis_common, cim_vol_path):
             len(cim_pools) +
             "associated to cim_vol: %s, %s" % (cim_vol_path, cim_pools))
     return pool_id_of_cim_pool(cim_pools[0])
+
+
+def _pool_id_of_vol_key(smis_common, max_query_count):
+    """
+    Usage:
+        Find out the lsm.Pool.id of the CIM_StorageVolume of all pools with
+        one AssociatorNames() call per pool:
+            CIM_StoragePool
+                 |
+                 | CIM_AllocatedFromStoragePool
+                 v
+            CIM_StorageVolume
+        Gives up once more than 'max_query_count' WBEM calls would be
+        needed.
+    Returns:
+        A dictionary with cim_path_key() of CIM_StorageVolume path as key
+        and lsm.Pool.id as value, empty if gave up. Volumes not found in it,
+        for example those allocated from more than one pool, should be
+        queried by pool_id_of_cim_vol().
+    """
+    cim_syss = smis_sys.root_cim_sys(smis_common)
+    query_count = len(cim_syss)
+    cim_pools = []
+    for cim_sys in cim_syss:
+        if query_count + len(cim_pools) > max_query_count:
+            return {}
+        cim_pools.extend(cim_pools_of_cim_sys_path(
+            smis_common, cim_sys.path, cim_pool_id_pros()))
+    if query_count + len(cim_pools) > max_query_count:
+        return {}
+
+    def _vol_paths_of_cim_pool(smis_common, cim_pool):
+        return smis_common.AssociatorNames(
+            cim_pool.path,
+            AssocClass='CIM_AllocatedFromStoragePool',
+            ResultClass='CIM_StorageVolume')
+
+    rc = {}
+    duplicate_vol_keys = set()
+    for cim_pool, cim_vol_paths in zip(
+            cim_pools,
+            smis_common.parallel_map(_vol_paths_of_cim_pool, cim_pools)):
+        pool_id = pool_id_of_cim_pool(cim_pool)
+        for cim_vol_path in cim_vol_paths:
+            vol_key = cim_path_key(cim_vol_path)
+            if vol_key in rc:
+                duplicate_vol_keys.add(vol_key)
+            rc[vol_key] = pool_id
+
+    # Let pool_id_of_cim_vol() complain about these.
+    for vol_key in duplicate_vol_keys:
+        del rc[vol_key]
+    return rc
+
+
+def pool_ids_of_cim_vols(smis_common, cim_vol_paths):
+    """
+    Find out the lsm.Pool.id of each CIM_StorageVolume path, in the same
+    order, using _pool_id_of_vol_key() when the array has fewer pools than
+    the volume count.
+    """
+    cim_vol_paths = list(cim_vol_paths)
+    pool_id_of_vol_key = {}
+    if len(cim_vol_paths) > 1:
+        pool_id_of_vol_key = _pool_id_of_vol_key(
+            smis_common, len(cim_vol_paths) - 1)
+
+    rc = []
+    for cim_vol_path in cim_vol_paths:
+        pool_id = pool_id_of_vol_key.get(cim_path_key(cim_vol_path))
+        if pool_id is None:
+            pool_id = pool_id_of_cim_vol(smis_common, cim_vol_path)
+        rc.append(pool_id)
+    return rc
+
+
+class _FakeSmisCommon(object):
+    """
+    One root system holding the pools named by the keys of 'vols_of_pool',
+    each allocating the volumes listed as value.  WBEM calls are recorded
+    in 'calls'.
+    """
+
+    def __init__(self, vols_of_pool):
+        self.vols_of_pool = vols_of_pool
+        self.system_list = None
+        self.root_blk_cim_rp = pywbem.CIMInstance(
+            'CIM_RegisteredProfile',
+            path=pywbem.CIMInstanceName('CIM_RegisteredProfile'))
+        self.calls = []
+
+    @staticmethod
+    def cim_vol_path(name):
+        return pywbem.CIMInstanceName(
+            'CIM_StorageVolume', keybindings={'DeviceID': name})
+
+    @staticmethod
+    def _cim_pool(pool_id):
+        return pywbem.CIMInstance(
+            'CIM_StoragePool', properties={'InstanceID': pool_id},
+            path=pywbem.CIMInstanceName(
+                'CIM_StoragePool', keybindings={'InstanceID': pool_id}))
+
+    def is_megaraid(self):
+        return False
+
+    def parallel_map(self, func, items):
+        return list(func(self, item) for item in items)
+
+    def Associators(self, obj_name, **kwargs):
+        self.calls.append(kwargs['AssocClass'])
+        if kwargs['AssocClass'] == 'CIM_ElementConformsToProfile':
+            return [pywbem.CIMInstance(
+                'CIM_ComputerSystem', properties={'Name': 'sys'},
+                path=pywbem.CIMInstanceName(
+                    'CIM_ComputerSystem', keybindings={'Name': 'sys'}))]
+        if kwargs['AssocClass'] == 'CIM_HostedStoragePool':
+            return list(_FakeSmisCommon._cim_pool(pool_id)
+                        for pool_id in sorted(self.vols_of_pool.keys()))
+        # CIM_AllocatedFromStoragePool of a volume
+        return list(_FakeSmisCommon._cim_pool(pool_id)
+                    for pool_id, names in sorted(self.vols_of_pool.items())
+                    if obj_name['DeviceID'] in names)
+
+    def AssociatorNames(self, obj_name, **kwargs):
+        self.calls.append('AssociatorNames')
+        return list(_FakeSmisCommon.cim_vol_path(name)
+                    for name in self.vols_of_pool[obj_name['InstanceID']])
+
+
+class _TestPoolIdsOfCimVols(unittest.TestCase):
+    def test_bulk(self):
+        smis_common = _FakeSmisCommon(
+            {'p0': ['v0', 'v1', 'v2'], 'p1': ['v3', 'v4']})
+        self.assertEqual(
+            pool_ids_of_cim_vols(
+                smis_common,
+                (_FakeSmisCommon.cim_vol_path(name)
+                 for name in ['v4', 'v0', 'v2', 'v3'])),
+            ['p1', 'p0', 'p0', 'p1'])
+        # No query per volume.
+        self.assertEqual(smis_common.calls.count('AssociatorNames'), 2)
+        self.assertFalse('CIM_AllocatedFromStoragePool' in smis_common.calls)
+
+    def test_fallback(self):
+        # 'v1' is allocated from two pools, 'v5' is not listed by any pool
+        # reply while the volume itself reports 'p2'.
+        smis_common = _FakeSmisCommon(
+            {'p0': ['v0', 'v1'], 'p1': ['v1', 'v2']})
+        afsp_of_v5 = _FakeSmisCommon._cim_pool('p2')
+        orig_associators = smis_common.Associators
+
+        def _associators(obj_name, **kwargs):
+            if obj_name.classname == 'CIM_StorageVolume' and \
+               obj_name['DeviceID'] == 'v5':
+                smis_common.calls.append(kwargs['AssocClass'])
+                return [afsp_of_v5]
+            return orig_associators(obj_name, **kwargs)
+
+        smis_common.Associators = _associators
+        vol_paths = list(_FakeSmisCommon.cim_vol_path(name)
+                         for name in ['v0', 'v2', 'v5', 'v2'])
+        self.assertEqual(pool_ids_of_cim_vols(smis_common, vol_paths),
+                         ['p0', 'p1', 'p2', 'p1'])
+        self.assertEqual(
+            smis_common.calls.count('CIM_AllocatedFromStoragePool'), 1)
+
+        # A volume allocated from two pools is a plug-in bug.
+        with self.assertRaises(LsmError) as cm:
+            pool_ids_of_cim_vols(
+                smis_common,
+                list(_FakeSmisCommon.cim_vol_path(name)
+                     for name in ['v0', 'v1', 'v2', 'v2']))
+        self.assertEqual(cm.exception.code, ErrorNumber.PLUGIN_BUG)
+
+    def test_many_pools(self):
+        # With more pools than volumes, query each volume.
+        smis_common = _FakeSmisCommon(
+            dict(('p%d' % i, ['v%d' % i]) for i in range(10)))
+        self.assertEqual(
+            pool_ids_of_cim_vols(
+                smis_common,
+                (_FakeSmisCommon.cim_vol_path(name)
+                 for name in ['v3', 'v7'])),
+            ['p3', 'p7'])
+        self.assertEqual(smis_common.calls.count('AssociatorNames'), 0)
+        self.assertEqual(
+            smis_common.calls.count('CIM_AllocatedFromStoragePool'), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -63,14 +63,18 @@ def root_cim_sys(smis_common, property_list=None):
     else:
         property_list = merge_list(property_list, id_pros)
 
+    # Only the system ID is cached, properties like OperationalStatus are
+    # always queried.
+    cache = set(property_list) <= set(id_pros)
+
     if smis_common.is_megaraid():
         cim_syss = smis_common.EnumerateInstances(
-            'CIM_ComputerSystem', PropertyList=property_list)
+            'CIM_ComputerSystem', cache=cache, PropertyList=property_list)
     else:
         cim_syss = smis_common.Associators(
             smis_common.root_blk_cim_rp.path,
             ResultClass='CIM_ComputerSystem',
-            AssocClass='CIM_ElementConformsToProfile',
+            AssocClass='CIM_ElementConformsToProfile', cache=cache,
             PropertyList=property_list)
 
         if len(cim_syss) == 0:
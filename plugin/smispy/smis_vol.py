@@ -73,25 +73,22 @@ def cim_vol_of_cim_pool_path(smis_common, cim_pool_path, property_list=None):
         CIM_StorageVolume
     CIM_StorageVolume['Usage'] == dmtf.VOL_USAGE_SYS_RESERVED will be filtered
     out.
-    Return a list of CIM_StorageVolume.
+    Return a generator of CIM_StorageVolume streamed from provider.
     """
     if property_list is None:
         property_list = ['Usage']
     else:
         property_list = merge_list(property_list, ['Usage'])
 
-    cim_vols = smis_common.Associators(
+    cim_vols = smis_common.AssociatorsIter(
         cim_pool_path,
         AssocClass='CIM_AllocatedFromStoragePool',
         ResultClass='CIM_StorageVolume',
         PropertyList=property_list)
 
-    needed_cim_vols = []
-    for cim_vol in cim_vols:
-        if 'Usage' not in cim_vol or \
-           cim_vol['Usage'] != dmtf.VOL_USAGE_SYS_RESERVED:
-            needed_cim_vols.append(cim_vol)
-    return needed_cim_vols
+    return (cim_vol for cim_vol in cim_vols
+            if 'Usage' not in cim_vol or
+            cim_vol['Usage'] != dmtf.VOL_USAGE_SYS_RESERVED)
 
 
 def _vpd83_in_cim_vol_name(cim_vol):
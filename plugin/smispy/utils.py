@@ -98,6 +98,19 @@ def cim_path_to_path_str(cim_path):
     })
 
 
+def cim_path_key(cim_path):
+    """
+    Return a hashable key of CIMInstanceName for matching the same instance
+    across the reply of different WBEM calls. Only the key properties are
+    used as some providers do not include host and namespace in references
+    or use the parent class name in them.
+    Args:
+        cim_path: CIM path
+    """
+    return tuple(sorted((k.lower(), str(v))
+                        for k, v in cim_path.keybindings.items()))
+
+
 def path_str_to_cim_path(path_str):
     """
     Convert a string into CIMInstanceName.
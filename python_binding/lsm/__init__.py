@@ -16,17 +16,20 @@
 
 from lsm._common import error, info, LsmError, ErrorNumber, \
     JobStatus, uri_parse, md5, Proxy, size_bytes_2_size_human, \
-    common_urllib2_error_handler, size_human_2_size_bytes, int_div
+    common_urllib2_error_handler, size_human_2_size_bytes, int_div, \
+    private_dir
 
 from lsm._local_disk import LocalDisk
 
 from lsm._data import (Disk, Volume, Pool, System, FileSystem, FsSnapshot,
-                    NfsExport, BlockRange, AccessGroup, TargetPort,
+                    NfsExport, BlockRange, BlockRanges, AccessGroup,
+                    TargetPort,
                     Capabilities, Battery)
 from lsm._iplugin import IPlugin, IStorageAreaNetwork, \
     INetworkAttachedStorage, INfs
 
 from lsm._client import Client
-from lsm._pluginrunner import PluginRunner, search_property
+from lsm._pluginrunner import PluginRunner, SingleFlight, PluginScheduler, \
+    search_property
 
 __all__ = []
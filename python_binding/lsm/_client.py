@@ -133,9 +133,12 @@ def _plugin_uds_path():
     # @param    plain_text_password     Password as plain text (Optional)
     # @param    timeout_ms              The timeout in ms
     # @param    flags                   Reserved for future use, must be zero.
+    # @param    deadline_ms             Per request deadline in ms, None to
+    #                                   wait for the plug-in as long as it
+    #                                   takes (Optional)
     # @returns None
     def __init__(self, uri, plain_text_password=None, timeout_ms=30000,
-                 flags=0):
+                 flags=0, deadline_ms=None):
         self._uri = uri
         self._password = plain_text_password
         self._timeout = timeout_ms
@@ -162,6 +165,7 @@ def __init__(self, uri, plain_text_password=None, timeout_ms=30000,
             else:
                 _raise_no_daemon()
 
+        self._tp.deadline_ms = deadline_ms
         self.__start(uri, plain_text_password, timeout_ms, flags)
 
     # Synonym for close.
@@ -224,7 +228,38 @@ def time_out_set(self, ms, flags=FLAG_RSVD):
 
         Return None on success, else LsmError exception
         """
-        return self._tp.rpc('time_out_set', _del_self(locals()))
+        rc = self._tp.rpc('time_out_set', _del_self(locals()))
+        self._timeout = ms
+        return rc
+
+    # Sets the deadline of each request sent to the plug-in
+    # @param    self    The this pointer
+    # @param    ms      Deadline in ms, None to disable
+    def deadline_set(self, ms):
+        """
+        Sets the deadline (ms) of each request, independently of the time-out
+        used by the plug-in to talk to the storage array.  The plug-in aborts
+        work still running after the deadline and the client gives up waiting
+        a few seconds later, raising LsmError with ErrorNumber.TIMEOUT.
+        Disabled (None) by default.
+
+        Return None.
+        """
+        self._tp.deadline_ms = ms
+
+    # Aborts the request currently in flight on this connection.
+    # @param    self    The this pointer
+    # @param    flags   Reserved for future use, must be zero.
+    def cancel(self, flags=FLAG_RSVD):
+        """
+        Asks the plug-in to abort the request this client is waiting for.
+        Meant to be called from another thread, the aborted call raises
+        LsmError with ErrorNumber.TIMEOUT.  Plug-ins not supporting
+        cancellation simply finish the request.
+
+        Return None.
+        """
+        self._tp.cancel()
 
     # Retrieves the current time-out value.
     # @param    self    The this pointer
@@ -256,6 +291,29 @@ def job_status(self, job_id, flags=FLAG_RSVD):
         """
         return self._tp.rpc('job_status', _del_self(locals()))
 
+    # Retrieves the status of several jobs at once.
+    # @param    self    The this pointer
+    # @param    job_ids List of job identifiers
+    # @param    flags   Reserved for future use, must be zero.
+    # @returns A list of job_status() tuples in the order of job_ids
+    @_return_requires([[int, int, _IData]])
+    def job_status_bulk(self, job_ids, flags=FLAG_RSVD):
+        """
+        Returns the status of all given jobs in a single request, which
+        is cheaper than calling job_status() for each job when polling a
+        large number of jobs.
+
+        Returns a list of job_status() tuples in the same order as job_ids,
+        else LsmError exception.  Falls back to job_status() of each job if
+        plug-in does not support bulk query.
+        """
+        try:
+            return self._tp.rpc('job_status_bulk', _del_self(locals()))
+        except LsmError as lsm_err:
+            if lsm_err.code != ErrorNumber.NO_SUPPORT:
+                raise
+        return list(self.job_status(job_id, flags) for job_id in job_ids)
+
     # Frees the resources for the specified job id.
     # @param    self    The this pointer
     # @param    job_id  Job id in which to release resource for
@@ -484,7 +542,7 @@ def volume_replicate_range_block_size(self, system, flags=FLAG_RSVD):
     #                       (enumeration, see common.data.Volume)
     # @param    volume_src  The volume src to replicate from
     # @param    volume_dest The volume dest to replicate to
-    # @param    ranges      An array of Block range objects
+    # @param    ranges      An array of Block range objects or BlockRanges
     #                       @see lsm.common.data.BlockRange
     # @param    flags       Reserved for future use, must be zero.
     # @returns Job id or None when completed, else raises LsmError on errors.
@@ -496,6 +554,10 @@ def volume_replicate_range(self, rep_type, volume_src, volume_dest, ranges,
         dest and number of blocks values change with vendor, call
         volume_replicate_range_block_size to get block unit size.
 
+        The ranges could be a list of BlockRange or a BlockRanges which is
+        sent in compact form, suitable for a large number of ranges.  Only
+        plug-ins written in python accept BlockRanges.
+
         Returns Job id or None when completed, else raises LsmError on errors.
         """
         return self._tp.rpc('volume_replicate_range', _del_self(locals()))
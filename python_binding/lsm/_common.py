@@ -14,9 +14,13 @@
 #
 # Author: tasleson
 
+import errno
 import hashlib
 
 import os
+import shutil
+import stat
+import tempfile
 import unittest
 import re
 
@@ -349,6 +353,26 @@ def int_div(a, b):
         return a / b
 
 
+def private_dir(path):
+    """
+    Create 'path' as a 0700 directory if missing.
+    Return True if 'path' is a directory, not a symbolic link, owned by
+    current user and not accessible by other users, so that files in it
+    could be trusted. Return False otherwise.
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return False
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and \
+        (st.st_mode & 0o077) == 0
+
+
 # Converts a list of arguments to string.
 # @param    args    Args to join
 # @return string of arguments joined together.
@@ -618,6 +642,28 @@ def test_simple(self):
                         ed['exception'] == 'exception' and
                         ed['debug_data'] == 'debug_data')
 
+    def test_private_dir(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'private')
+            self.assertTrue(private_dir(path))
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+            self.assertTrue(private_dir(path))
+
+            os.chmod(path, 0o755)
+            self.assertFalse(private_dir(path))
+
+            link = os.path.join(tmp_dir, 'link')
+            os.chmod(path, 0o700)
+            os.symlink(path, link)
+            self.assertFalse(private_dir(link))
+
+            not_dir = os.path.join(tmp_dir, 'file')
+            open(not_dir, 'w').close()
+            self.assertFalse(private_dir(not_dir))
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def tearDown(self):
         pass
 
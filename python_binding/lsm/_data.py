@@ -735,6 +735,46 @@ def __init__(self, _src_block, _dest_block, _block_count):
         self._block_count = _block_count
 
 
+@default_property('src_blocks', doc="List of source logical block addresses")
+@default_property('dest_blocks',
+                  doc="List of destination logical block addresses")
+@default_property('block_counts', doc="List of block counts")
+class BlockRanges(IData):
+    """
+    Compact form of a list of BlockRange, stored as three parallel integer
+    lists.  Much smaller on the wire than a list of BlockRange objects when
+    replicating a large number of ranges.  Iterating it yields BlockRange
+    objects, so plug-ins could handle it like a list of BlockRange.
+    """
+    def __init__(self, _src_blocks, _dest_blocks, _block_counts):
+        if not len(_src_blocks) == len(_dest_blocks) == len(_block_counts):
+            raise LsmError(ErrorNumber.INVALID_ARGUMENT,
+                           "BlockRanges lists should have the same length")
+        self._src_blocks = list(_src_blocks)
+        self._dest_blocks = list(_dest_blocks)
+        self._block_counts = list(_block_counts)
+
+    @staticmethod
+    def from_block_ranges(block_ranges):
+        """
+        Convert a list of BlockRange into BlockRanges.
+        """
+        return BlockRanges([r.src_block for r in block_ranges],
+                           [r.dest_block for r in block_ranges],
+                           [r.block_count for r in block_ranges])
+
+    def __len__(self):
+        return len(self._block_counts)
+
+    def __getitem__(self, index):
+        return BlockRange(self._src_blocks[index], self._dest_blocks[index],
+                          self._block_counts[index])
+
+    def __iter__(self):
+        for i in range(len(self._block_counts)):
+            yield self[i]
+
+
 @default_property('id', doc="Unique instance identifier")
 @default_property('name', doc="Access group name")
 @default_property('init_ids', doc="List of initiator IDs")
@@ -17,13 +17,28 @@
 import socket
 import traceback
 import sys
-from lsm import LsmError, error, ErrorNumber
+from lsm import (LsmError, error, info, ErrorNumber, md5, uri_parse,
+                 private_dir)
 from lsm.lsmcli import cmd_line_wrapper
 import six
 import errno
+import json
+import threading
+import heapq
+import itertools
+import contextlib
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from six.moves import queue
 
-from lsm._common import SocketEOF as _SocketEOF
+from lsm._common import SocketEOF as _SocketEOF, UDS_PATH as _UDS_PATH
 from lsm._transport import TransPort
+from lsm._data import DataEncoder as _DataEncoder
+from lsm._data import DataDecoder as _DataDecoder
 
 def search_property(lsm_objs, search_key, search_value):
     """
@@ -36,12 +51,455 @@ def search_property(lsm_objs, search_key, search_value):
                 if getattr(lsm_obj, search_key) == search_value)
 
 
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical calls of all plug-in processes of current
+    user.  As every client connection gets its own plug-in process, this is
+    where requests of several clients meet.  While a call for a given key is
+    in flight, other callers using the same key wait for it to finish and
+    share its result (or its LsmError) instead of running it again.
+
+    The leader holds a lock file of the key in 'lock_dir' while running the
+    call and saves the outcome next to it.  Callers which arrived before that
+    outcome was saved reuse it, later callers run the call again, hence a
+    result is never served from a cache.  If 'lock_dir' is not private to
+    current user, calls are not coalesced.  Files of keys not used for
+    _STALE_AGE seconds are removed.
+    """
+
+    _LOCK_POLL_INTERVAL = 0.05
+
+    _FILE_PREFIX = 'lsm_flight_'
+
+    _STALE_AGE = 60
+
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        self._lock_dir_ok = None
+        self._last_sweep = 0
+
+    @staticmethod
+    def key_of(method, params):
+        """
+        Returns the coalescing key for a method and its parameters.  The
+        parameters are serialized the same way they travel on the wire so
+        that equal requests always map to the same key.
+        """
+        return "%s:%s" % (
+            method, json.dumps(params, cls=_DataEncoder, sort_keys=True))
+
+    def _lock(self, lock_file, ctx):
+        """
+        Wait for the lock of lock_file, checking ctx between attempts.
+        Return the opened file descriptor holding the lock.
+        """
+        fd = os.open(lock_file, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if ctx is not None:
+                    ctx.check()
+                time.sleep(SingleFlight._LOCK_POLL_INTERVAL)
+        except Exception:
+            os.close(fd)
+            raise
+
+    @staticmethod
+    def _outcome_load(outcome_file, arrival):
+        """
+        Return the outcome saved in outcome_file if its call finished after
+        'arrival', otherwise None.
+        """
+        try:
+            with open(outcome_file) as f:
+                outcome = json.load(f, cls=_DataDecoder)
+        except (IOError, OSError, ValueError):
+            return None
+        if outcome.get('finished', 0) < arrival:
+            return None
+        return outcome
+
+    def _outcome_save(self, outcome_file, outcome):
+        (fd, tmp_file) = tempfile.mkstemp(dir=self.lock_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(outcome, f, cls=_DataEncoder)
+            os.rename(tmp_file, outcome_file)
+        except Exception:
+            os.unlink(tmp_file)
+            raise
+
+    def _sweep(self):
+        """
+        Remove the outcome and lock files not modified for _STALE_AGE
+        seconds.  Lock files are only removed when not locked.
+        """
+        now = time.time()
+        if now - self._last_sweep < SingleFlight._STALE_AGE:
+            return
+        self._last_sweep = now
+        for name in os.listdir(self.lock_dir):
+            if not name.startswith(SingleFlight._FILE_PREFIX):
+                continue
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if os.lstat(path).st_mtime > now - SingleFlight._STALE_AGE:
+                    continue
+                if not name.endswith('.lock'):
+                    os.unlink(path)
+                    continue
+                fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.unlink(path)
+                finally:
+                    os.close(fd)
+            except (IOError, OSError):
+                # Locked, or removed by another plug-in process.
+                pass
+
+    def do(self, key, func, ctx=None):
+        """
+        Runs func() unless a call with the same key is already in flight, in
+        which case waits for that call and returns its result or raises its
+        LsmError.  The result must be JSON serializable by DataEncoder.
+        Waiting is aborted by ctx.check() if 'ctx' is a CallContext.
+        """
+        if self._lock_dir_ok is None:
+            self._lock_dir_ok = private_dir(self.lock_dir)
+        if not self._lock_dir_ok:
+            return func()
+
+        arrival = time.time()
+        self._sweep()
+        base_name = os.path.join(
+            self.lock_dir, "%s%s" % (SingleFlight._FILE_PREFIX, md5(key)))
+        fd = self._lock(base_name + '.lock', ctx)
+        try:
+            # Keep the lock file of a key in use from being swept.
+            os.utime(base_name + '.lock', None)
+            outcome = SingleFlight._outcome_load(base_name + '.json', arrival)
+            if outcome is None:
+                try:
+                    outcome = dict(result=func())
+                except LsmError as lsm_err:
+                    outcome = dict(error=[lsm_err.code, lsm_err.msg,
+                                          lsm_err.data])
+                outcome['finished'] = time.time()
+                self._outcome_save(base_name + '.json', outcome)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+        if 'error' in outcome:
+            raise LsmError(*outcome['error'])
+        return outcome['result']
+
+
+class PluginScheduler(object):
+    """
+    Admission control for plug-in calls against a storage array.
+
+    At most 'max_concurrent' calls per key (normally the array URI) are
+    allowed to run at once.  Other callers wait in a priority queue so that
+    interactive requests such as volume_create() or job_status() are
+    admitted ahead of bulk listings.  As every client connection gets its own
+    plug-in process, the limit is also enforced across processes serving the
+    same key by the means of lock files, with one slot reserved for non bulk
+    requests.  The lock files are kept in 'lock_dir', default to a private
+    directory of current user next to the lsmd IPC folder, or in the temp
+    folder if not writable.  If that directory is not private to current
+    user, the limit is only enforced within this process.
+
+    A 'max_concurrent' of 0 disables the scheduler.
+    """
+
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_BULK = 2
+
+    _BULK_METHODS = frozenset([
+        'systems', 'pools', 'volumes', 'disks', 'access_groups', 'fs',
+        'exports', 'target_ports', 'batteries', 'fs_snapshots',
+        'volumes_accessible_by_access_group',
+        'access_groups_granted_to_volume'])
+
+    _NORMAL_METHODS = frozenset(['plugin_register', 'capabilities'])
+
+    # Requests which never reach the array.
+    _UNSCHEDULED_METHODS = frozenset([
+        'plugin_unregister', 'plugin_info', 'time_out_set', 'time_out_get',
+        'export_auth'])
+
+    _LOCK_POLL_INTERVAL = 0.05
+
+    # Log requests which waited longer than this(seconds) for admission.
+    _SLOW_ADMISSION = 1.0
+
+    class _Queue(object):
+        def __init__(self):
+            self.running = 0
+            self.waiters = []
+            self.max_depth = 0
+            self.admitted = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def __init__(self, max_concurrent=0, lock_dir=None):
+        self.max_concurrent = max_concurrent
+        if lock_dir is None:
+            lock_dir = os.getenv('LSM_PLUGIN_LOCK_DIR')
+        if lock_dir is None:
+            base_dir = os.path.dirname(os.getenv('LSM_UDS_PATH', _UDS_PATH))
+            if not os.access(base_dir, os.W_OK):
+                base_dir = tempfile.gettempdir()
+            lock_dir = os.path.join(
+                base_dir, 'lsm_plugin_lock_%d' % os.getuid())
+        self.lock_dir = lock_dir
+        self._lock_dir_ok = None
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._seq = itertools.count()
+
+    @staticmethod
+    def key_of_uri(uri):
+        """
+        Returns the scheduling key of a plug-in URI: the host and port of
+        network plug-ins, the state file of the simulator or the scheme of
+        other local plug-ins.  The user name is not part of the key as the
+        limit protects the array, not the account.
+        """
+        try:
+            u = uri_parse(uri)
+        except ValueError as ve:
+            raise LsmError(ErrorNumber.INVALID_ARGUMENT,
+                           "Invalid URI '%s': %s" % (uri, ve))
+        if 'host' in u:
+            return "%s:%s" % (u['host'], u.get('port', ''))
+        if 'statefile' in u['parameters']:
+            return "%s://?statefile=%s" % (
+                u.get('scheme', ''), u['parameters']['statefile'])
+        return "%s://" % u.get('scheme', '')
+
+    @staticmethod
+    def priority_of(method):
+        if method in PluginScheduler._BULK_METHODS:
+            return PluginScheduler.PRIORITY_BULK
+        if method in PluginScheduler._NORMAL_METHODS:
+            return PluginScheduler.PRIORITY_NORMAL
+        return PluginScheduler.PRIORITY_INTERACTIVE
+
+    def _slot_count(self, priority):
+        """
+        Bulk requests are not allowed to use the last slot.
+        """
+        if priority == PluginScheduler.PRIORITY_BULK and \
+           self.max_concurrent > 1:
+            return self.max_concurrent - 1
+        return self.max_concurrent
+
+    def _lock_dir_check(self):
+        """
+        Return True if lock_dir is private to current user. Otherwise other
+        users could hold the lock files and block all plug-ins.
+        """
+        if self._lock_dir_ok is None:
+            self._lock_dir_ok = private_dir(self.lock_dir)
+            if not self._lock_dir_ok:
+                error("Plug-in lock folder %s is not a folder private to "
+                      "uid %d, max_concurrent is only enforced within this "
+                      "plug-in process" % (self.lock_dir, os.getuid()))
+        return self._lock_dir_ok
+
+    def _lock_slot(self, key, priority, give_up_time):
+        """
+        Take one of the cross process slot lock files of this key.
+        Return the opened file descriptor holding the lock or None if
+        'give_up_time' passed.
+        """
+        while True:
+            for slot in range(0, self._slot_count(priority)):
+                lock_file = os.path.join(
+                    self.lock_dir, "lsm_plugin_%s_%d.lock" % (md5(key), slot))
+                fd = os.open(lock_file,
+                             os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except (IOError, OSError) as e:
+                    os.close(fd)
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+            if give_up_time is not None and time.time() >= give_up_time:
+                return None
+            time.sleep(PluginScheduler._LOCK_POLL_INTERVAL)
+
+    @contextlib.contextmanager
+    def slot(self, key, method, timeout=None):
+        """
+        Context manager which waits until the request is admitted.
+        Raise LsmError(ErrorNumber.TIMEOUT) if not admitted within 'timeout'
+        seconds.
+        """
+        if self.max_concurrent < 1 or key is None or \
+           method in PluginScheduler._UNSCHEDULED_METHODS:
+            yield
+            return
+
+        priority = PluginScheduler.priority_of(method)
+        start = time.time()
+        give_up_time = None
+        if timeout is not None:
+            give_up_time = start + timeout
+
+        with self._cond:
+            key_queue = self._queues.setdefault(
+                key, PluginScheduler._Queue())
+            ticket = (priority, next(self._seq))
+            heapq.heappush(key_queue.waiters, ticket)
+            key_queue.max_depth = max(key_queue.max_depth,
+                                      len(key_queue.waiters))
+            while key_queue.waiters[0] != ticket or \
+                    key_queue.running >= self._slot_count(priority):
+                remain = None
+                if give_up_time is not None:
+                    remain = give_up_time - time.time()
+                    if remain <= 0:
+                        key_queue.waiters.remove(ticket)
+                        heapq.heapify(key_queue.waiters)
+                        self._cond.notify_all()
+                        raise LsmError(
+                            ErrorNumber.TIMEOUT,
+                            "Timeout waiting for a free slot of %s" % key)
+                self._cond.wait(remain)
+            heapq.heappop(key_queue.waiters)
+            key_queue.running += 1
+            self._cond.notify_all()
+
+        fd = None
+        try:
+            if self._lock_dir_check():
+                fd = self._lock_slot(key, priority, give_up_time)
+                if fd is None:
+                    raise LsmError(
+                        ErrorNumber.TIMEOUT,
+                        "Timeout waiting for a free slot of %s" % key)
+
+            wait_time = time.time() - start
+            if wait_time > PluginScheduler._SLOW_ADMISSION:
+                info("%s() waited %.2fs for a free slot of %s" %
+                     (method, wait_time, key))
+            with self._cond:
+                key_queue.admitted += 1
+                key_queue.wait_total += wait_time
+                key_queue.wait_max = max(key_queue.wait_max, wait_time)
+            yield
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            with self._cond:
+                key_queue.running -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        """
+        Return a dictionary of per key queue metrics:
+            {
+                key: {
+                    'queue_depth': <requests waiting now>,
+                    'running': <requests admitted now>,
+                    'max_queue_depth': <deepest queue seen>,
+                    'admitted': <requests admitted so far>,
+                    'wait_time_total': <seconds>,
+                    'wait_time_max': <seconds>,
+                }
+            }
+        """
+        with self._cond:
+            return dict(
+                (key, {
+                    'queue_depth': len(q.waiters),
+                    'running': q.running,
+                    'max_queue_depth': q.max_depth,
+                    'admitted': q.admitted,
+                    'wait_time_total': q.wait_total,
+                    'wait_time_max': q.wait_max,
+                })
+                for key, q in self._queues.items())
+
+    def log_stats(self):
+        """
+        Log the queue metrics of every key which had requests admitted.
+        """
+        for (key, s) in sorted(self.stats().items()):
+            if s['admitted'] == 0:
+                continue
+            info("Scheduler of %s: %d requests admitted, max queue depth %d, "
+                 "wait time average %.2fs, max %.2fs" %
+                 (key, s['admitted'], s['max_queue_depth'],
+                  s['wait_time_total'] / s['admitted'], s['wait_time_max']))
+
+
+class CallContext(object):
+    """
+    Deadline and cancellation state of the request being served.  Plug-ins
+    get it from PluginRunner.call_context() and should call check() between
+    calls to the storage array, so that work the client no longer waits for
+    is aborted early.
+    """
+
+    def __init__(self, deadline_ms=None):
+        self.deadline = None
+        if deadline_ms:
+            self.deadline = time.time() + int(deadline_ms) / 1000.0
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def remaining(self):
+        """
+        Return seconds left before the deadline or None if no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def check(self):
+        """
+        Raise LsmError(ErrorNumber.TIMEOUT) if the request was cancelled by
+        the client or its deadline has passed.
+        """
+        if self.cancelled:
+            raise LsmError(ErrorNumber.TIMEOUT, "Request cancelled by client")
+        if self.deadline is not None and time.time() > self.deadline:
+            raise LsmError(ErrorNumber.TIMEOUT, "Request deadline exceeded")
+
+
+_NO_CALL_CONTEXT = CallContext()
+_CALL_CONTEXT = threading.local()
+
+
 class PluginRunner(object):
     """
     Plug-in side common code which uses the passed in plugin to do meaningful
     work.
     """
 
+    # Read only requests which are safe to share between clients of the
+    # same URI.
+    _COALESCED_METHODS = PluginScheduler._BULK_METHODS
+
     @staticmethod
     def _is_number(val):
         """
@@ -53,8 +511,35 @@ def _is_number(val):
         except ValueError:
             return False
 
+    @staticmethod
+    def _max_concurrent_of_env():
+        """
+        Returns the LSM_PLUGIN_MAX_CONCURRENT set by the host, 0 if not set
+        or invalid.  This runs before any error could reach the client, so a
+        bad value is only logged.
+        """
+        val = os.getenv('LSM_PLUGIN_MAX_CONCURRENT')
+        if not val:
+            return 0
+        try:
+            max_concurrent = int(val)
+            if max_concurrent >= 0:
+                return max_concurrent
+        except ValueError:
+            pass
+        error("Invalid LSM_PLUGIN_MAX_CONCURRENT '%s', expecting a "
+              "non-negative integer, scheduler disabled" % val)
+        return 0
+
     def __init__(self, plugin, args):
         self.cmdline = False
+        self.scheduler = PluginScheduler(PluginRunner._max_concurrent_of_env())
+        self.single_flight = SingleFlight(self.scheduler.lock_dir)
+        self._sched_key = None
+        self._sched_timeout = None
+        self._flight_uri = None
+        self._requests = queue.Queue()
+        self._last_ctx = _NO_CALL_CONTEXT
         if len(args) == 2 and PluginRunner._is_number(args[1]):
             try:
                 fd = int(args[1])
@@ -81,6 +566,72 @@ def __init__(self, plugin, args):
             self.cmdline = True
             cmd_line_wrapper(plugin)
 
+    @staticmethod
+    def call_context():
+        """
+        Return the CallContext of the request served by the current thread.
+        """
+        return getattr(_CALL_CONTEXT, 'ctx', _NO_CALL_CONTEXT)
+
+    def _read_requests(self):
+        """
+        Reader thread: queues incoming requests for run() so that a cancel
+        request or a client going away is noticed while the plug-in is busy.
+        Exceptions are forwarded to run() as (None, exc_info).
+        """
+        while True:
+            try:
+                msg = self.tp.read_req()
+                if msg['method'] == TransPort.CANCEL_METHOD:
+                    self._last_ctx.cancel()
+                    ctx = None
+                else:
+                    ctx = CallContext(msg.get('deadline_ms'))
+                    self._last_ctx = ctx
+                self._requests.put((msg, ctx))
+            except ValueError:
+                self._requests.put((None, sys.exc_info()))
+            except Exception:
+                # Client is gone, nobody is waiting for the current request.
+                self._last_ctx.cancel()
+                self._requests.put((None, sys.exc_info()))
+                break
+
+    def _invoke(self, method, params):
+        """
+        Calls the plug-in method once admitted by the scheduler.  When the
+        scheduler is enabled, identical listings of the same URI from all
+        clients are coalesced.
+        """
+        func = getattr(self.plugin, method)
+        if params is None:
+            params = {}
+
+        if method == 'plugin_register':
+            self._sched_key = PluginScheduler.key_of_uri(params['uri'])
+            self._flight_uri = params['uri']
+            if params.get('timeout'):
+                self._sched_timeout = int(params['timeout']) / 1000.0
+
+        ctx = PluginRunner.call_context()
+        timeout = ctx.remaining()
+        if timeout is None:
+            timeout = self._sched_timeout
+
+        def _scheduled():
+            with self.scheduler.slot(self._sched_key, method, timeout):
+                ctx.check()
+                return func(**params)
+
+        if self.scheduler.max_concurrent > 0 and \
+           self._flight_uri is not None and \
+           method in PluginRunner._COALESCED_METHODS:
+            return self.single_flight.do(
+                "%s %s" % (self._flight_uri,
+                           SingleFlight.key_of(method, params)),
+                _scheduled, ctx)
+        return _scheduled()
+
     def run(self):
         # Don't need to invoke this when running stand alone as a cmdline
         if self.cmdline:
@@ -89,25 +640,37 @@ def run(self):
         need_shutdown = False
         msg_id = 0
 
+        reader = threading.Thread(target=self._read_requests)
+        reader.daemon = True
+        reader.start()
+
         try:
             while True:
                 try:
                     # result = None
 
-                    msg = self.tp.read_req()
+                    (msg, ctx) = self._requests.get()
+                    if msg is None:
+                        six.reraise(*ctx)
 
                     method = msg['method']
                     msg_id = msg['id']
                     params = msg['params']
 
+                    if method == TransPort.CANCEL_METHOD:
+                        # Replied after the cancelled request to keep the
+                        # client in sync.
+                        self.tp.send_resp(None)
+                        continue
+
                     # Check to see if this plug-in implements this operation
                     # if not return the expected error.
                     if hasattr(self.plugin, method):
-                        if params is None:
-                            result = getattr(self.plugin, method)()
-                        else:
-                            result = getattr(self.plugin, method)(
-                                **msg['params'])
+                        _CALL_CONTEXT.ctx = ctx
+                        try:
+                            result = self._invoke(method, params)
+                        finally:
+                            _CALL_CONTEXT.ctx = _NO_CALL_CONTEXT
                     else:
                         raise LsmError(ErrorNumber.NO_SUPPORT,
                                        "Unsupported operation")
@@ -155,7 +718,477 @@ def run(self):
                 pass
 
         finally:
+            self.scheduler.log_stats()
             if need_shutdown:
                 # Client wasn't nice, we will allow plug-in to cleanup
                 self.plugin.plugin_unregister()
                 sys.exit(2)
+
+
+class _TestCallContext(unittest.TestCase):
+    def test_no_deadline(self):
+        ctx = CallContext()
+        self.assertTrue(ctx.remaining() is None)
+        ctx.check()
+
+    def test_deadline(self):
+        ctx = CallContext(50)
+        self.assertTrue(0 < ctx.remaining() <= 0.05)
+        ctx.check()
+        time.sleep(0.1)
+        self.assertEqual(ctx.remaining(), 0)
+        with self.assertRaises(LsmError) as cm:
+            ctx.check()
+        self.assertEqual(cm.exception.code, ErrorNumber.TIMEOUT)
+
+    def test_cancel(self):
+        ctx = CallContext()
+        self.assertFalse(ctx.cancelled)
+        ctx.cancel()
+        self.assertTrue(ctx.cancelled)
+        with self.assertRaises(LsmError) as cm:
+            ctx.check()
+        self.assertEqual(cm.exception.code, ErrorNumber.TIMEOUT)
+
+
+class _FakePlugin(object):
+    """
+    Plug-in reporting the CallContext of its requests.
+    """
+
+    # Shared by all instances, like the storage array is.
+    volume_calls = []
+    release = threading.Event()
+
+    def __init__(self):
+        self.started = threading.Event()
+
+    def plugin_register(self, uri, password, timeout, flags=0):
+        pass
+
+    def plugin_unregister(self, flags=0):
+        pass
+
+    def remaining(self, flags=0):
+        return PluginRunner.call_context().remaining()
+
+    def wait(self, flags=0):
+        """
+        Wait up to 5 seconds for the request to be cancelled.
+        """
+        self.started.set()
+        ctx = PluginRunner.call_context()
+        give_up_time = time.time() + 5
+        while time.time() < give_up_time:
+            ctx.check()
+            time.sleep(0.01)
+        return 'not cancelled'
+
+    def volumes(self, search_key=None, search_value=None, flags=0):
+        """
+        Wait up to 5 seconds for the test to release the array.
+        """
+        _FakePlugin.volume_calls.append(1)
+        self.started.set()
+        _FakePlugin.release.wait(5)
+        return ['vol%d' % len(_FakePlugin.volume_calls)]
+
+
+class _TestPluginRunner(unittest.TestCase):
+    def setUp(self):
+        (self.c, s) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.runner = PluginRunner(_FakePlugin, ['fake', str(s.fileno())])
+        finally:
+            s.close()
+        self.server = threading.Thread(target=self.runner.run)
+        self.server.start()
+        self.client = TransPort(self.c)
+        self.client.rpc('plugin_register',
+                        dict(uri='fake://', password=None, timeout=1000,
+                             flags=0))
+
+    def tearDown(self):
+        self.client.rpc('plugin_unregister', dict(flags=0))
+        self.server.join()
+        self.client.close()
+
+    def test_deadline(self):
+        self.assertTrue(self.client.rpc('remaining', dict(flags=0)) is None)
+
+        self.client.deadline_ms = 60000
+        remaining = self.client.rpc('remaining', dict(flags=0))
+        self.assertTrue(0 < remaining <= 60)
+
+    def test_deadline_exceeded(self):
+        self.client.deadline_ms = 100
+        with self.assertRaises(LsmError) as cm:
+            self.client.rpc('wait', dict(flags=0))
+        self.assertEqual(cm.exception.code, ErrorNumber.TIMEOUT)
+        self.client.deadline_ms = None
+        self.assertTrue(self.client.rpc('remaining', dict(flags=0)) is None)
+
+    def test_cancel(self):
+        # The cancel request is read by the reader thread while run() is
+        # busy with wait().
+        canceller = threading.Thread(
+            target=lambda: (self.runner.plugin.started.wait(5),
+                            self.client.cancel()))
+        canceller.start()
+        with self.assertRaises(LsmError) as cm:
+            self.client.rpc('wait', dict(flags=0))
+        canceller.join()
+        self.assertEqual(cm.exception.code, ErrorNumber.TIMEOUT)
+
+        # Reply to the cancel request is skipped.
+        self.assertTrue(self.client.rpc('remaining', dict(flags=0)) is None)
+
+
+class _TestSingleFlight(unittest.TestCase):
+    _CALLERS = 8
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def _run_callers(self, key, func):
+        """
+        Run func through SingleFlight.do() from _CALLERS threads at once, each
+        with its own SingleFlight like plug-in processes do.  Return the
+        threads and the list of (result, exception) of each caller.
+        """
+        results = [None] * _TestSingleFlight._CALLERS
+
+        def _caller(i):
+            try:
+                results[i] = (SingleFlight(self.lock_dir).do(key, func), None)
+            except Exception as e:
+                results[i] = (None, e)
+
+        threads = list(threading.Thread(target=_caller, args=(i,))
+                       for i in range(_TestSingleFlight._CALLERS))
+        for t in threads:
+            t.start()
+        return threads, results
+
+    def test_shared_result(self):
+        release = threading.Event()
+        calls = []
+
+        def _func():
+            calls.append(1)
+            release.wait(5)
+            return ['vol%d' % len(calls)]
+
+        (threads, results) = self._run_callers('k', _func)
+        # Let every caller reach do() before the leader returns.
+        time.sleep(0.2)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [(['vol1'], None)] * len(results))
+
+    def test_shared_exception(self):
+        release = threading.Event()
+        calls = []
+
+        def _func():
+            calls.append(1)
+            release.wait(5)
+            raise LsmError(ErrorNumber.TIMEOUT, "failed")
+
+        (threads, results) = self._run_callers('k', _func)
+        time.sleep(0.2)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        for (result, exp) in results:
+            self.assertTrue(result is None)
+            self.assertTrue(isinstance(exp, LsmError))
+            self.assertEqual(exp.code, ErrorNumber.TIMEOUT)
+
+    def test_not_cached(self):
+        single_flight = SingleFlight(self.lock_dir)
+        calls = []
+
+        def _func():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(single_flight.do('k', _func), 1)
+        self.assertEqual(single_flight.do('k', _func), 2)
+
+        def _fail():
+            raise LsmError(ErrorNumber.PLUGIN_BUG, "failed")
+
+        self.assertRaises(LsmError, single_flight.do, 'k', _fail)
+        self.assertEqual(single_flight.do('k', _func), 3)
+
+    def test_wait_cancelled(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def _func():
+            started.set()
+            release.wait(5)
+
+        leader = threading.Thread(
+            target=SingleFlight(self.lock_dir).do, args=('k', _func))
+        leader.start()
+        started.wait(5)
+        try:
+            ctx = CallContext()
+            ctx.cancel()
+            with self.assertRaises(LsmError) as cm:
+                SingleFlight(self.lock_dir).do('k', _func, ctx)
+            self.assertEqual(cm.exception.code, ErrorNumber.TIMEOUT)
+        finally:
+            release.set()
+            leader.join()
+
+    def test_sweep(self):
+        single_flight = SingleFlight(self.lock_dir)
+        single_flight.do('old', lambda: 1)
+        self.assertEqual(len(os.listdir(self.lock_dir)), 2)
+        stale_time = time.time() - SingleFlight._STALE_AGE - 1
+        for name in os.listdir(self.lock_dir):
+            os.utime(os.path.join(self.lock_dir, name),
+                     (stale_time, stale_time))
+
+        # Swept at most once per _STALE_AGE.
+        single_flight.do('new', lambda: 2)
+        self.assertEqual(len(os.listdir(self.lock_dir)), 4)
+        single_flight._last_sweep = 0
+        single_flight.do('new', lambda: 2)
+        self.assertEqual(len(os.listdir(self.lock_dir)), 2)
+
+    def test_unsafe_lock_dir(self):
+        os.chmod(self.lock_dir, 0o777)
+        self.assertEqual(SingleFlight(self.lock_dir).do('k', lambda: 1), 1)
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+    def test_key_of(self):
+        self.assertEqual(SingleFlight.key_of('volumes', {'a': 1, 'b': 2}),
+                         SingleFlight.key_of('volumes', {'b': 2, 'a': 1}))
+        self.assertNotEqual(SingleFlight.key_of('volumes', {'a': 1}),
+                            SingleFlight.key_of('pools', {'a': 1}))
+
+
+class _TestCoalescing(unittest.TestCase):
+    """
+    Two clients, each served by its own PluginRunner, listing the same
+    array at once share one call of the plug-in.
+    """
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.orig_env = dict(os.environ)
+        os.environ['LSM_PLUGIN_MAX_CONCURRENT'] = '4'
+        os.environ['LSM_PLUGIN_LOCK_DIR'] = self.lock_dir
+        _FakePlugin.volume_calls = []
+        _FakePlugin.release.clear()
+        self.runners = []
+        self.servers = []
+        self.clients = []
+        for _ in range(2):
+            (c, s) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                runner = PluginRunner(_FakePlugin, ['fake', str(s.fileno())])
+            finally:
+                s.close()
+            server = threading.Thread(target=runner.run)
+            server.start()
+            client = TransPort(c)
+            client.rpc('plugin_register',
+                       dict(uri='fake://array', password=None, timeout=5000,
+                            flags=0))
+            self.runners.append(runner)
+            self.servers.append(server)
+            self.clients.append(client)
+
+    def tearDown(self):
+        _FakePlugin.release.set()
+        for client in self.clients:
+            client.rpc('plugin_unregister', dict(flags=0))
+            client.close()
+        for server in self.servers:
+            server.join()
+        os.environ.clear()
+        os.environ.update(self.orig_env)
+        shutil.rmtree(self.lock_dir)
+
+    def test_shared_call(self):
+        results = [None, None]
+
+        def _list(i):
+            results[i] = self.clients[i].rpc('volumes', dict(flags=0))
+
+        first = threading.Thread(target=_list, args=(0,))
+        first.start()
+        self.assertTrue(self.runners[0].plugin.started.wait(5))
+        second = threading.Thread(target=_list, args=(1,))
+        second.start()
+        # Let the second request reach the plug-in runner.
+        time.sleep(0.2)
+        _FakePlugin.release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(len(_FakePlugin.volume_calls), 1)
+        self.assertEqual(results, [['vol1'], ['vol1']])
+
+        # Finished calls are not cached.
+        self.assertEqual(self.clients[1].rpc('volumes', dict(flags=0)),
+                         ['vol2'])
+
+
+class _TestPluginScheduler(unittest.TestCase):
+    _KEY = 'smispy://array'
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def _hold(self, scheduler, method, admitted=None):
+        """
+        Start a thread holding a slot of scheduler for method until the
+        returned event is set. Admission is appended to 'admitted' list.
+        """
+        release = threading.Event()
+        started = threading.Event()
+
+        def _holder():
+            with scheduler.slot(_TestPluginScheduler._KEY, method, 5):
+                if admitted is not None:
+                    admitted.append(method)
+                started.set()
+                release.wait()
+
+        t = threading.Thread(target=_holder)
+        t.start()
+        return t, release, started
+
+    def test_priority(self):
+        scheduler = PluginScheduler(1, self.lock_dir)
+        admitted = []
+        (t0, release0, started0) = self._hold(scheduler, 'volume_create')
+        started0.wait()
+
+        (t1, release1, _) = self._hold(scheduler, 'volumes', admitted)
+        time.sleep(0.1)
+        (t2, release2, _) = self._hold(scheduler, 'job_status', admitted)
+        time.sleep(0.1)
+        self.assertEqual(
+            scheduler.stats()[_TestPluginScheduler._KEY]['queue_depth'], 2)
+
+        release0.set()
+        release1.set()
+        release2.set()
+        for t in (t0, t1, t2):
+            t.join()
+        self.assertEqual(admitted, ['job_status', 'volumes'])
+
+    def test_bulk_reservation(self):
+        scheduler = PluginScheduler(2, self.lock_dir)
+        (t0, release0, started0) = self._hold(scheduler, 'volumes')
+        started0.wait()
+        try:
+            # Bulk requests cannot use the last slot.
+            with self.assertRaises(LsmError) as cm:
+                with scheduler.slot(_TestPluginScheduler._KEY, 'pools', 0.2):
+                    pass
+            self.assertEqual(cm.exception.code, ErrorNumber.TIMEOUT)
+
+            with scheduler.slot(_TestPluginScheduler._KEY, 'job_status', 0.2):
+                pass
+        finally:
+            release0.set()
+            t0.join()
+
+    def test_cross_process(self):
+        # Each plug-in process has its own scheduler sharing the lock files.
+        scheduler = PluginScheduler(1, self.lock_dir)
+        other = PluginScheduler(1, self.lock_dir)
+        (t0, release0, started0) = self._hold(scheduler, 'volume_create')
+        started0.wait()
+        try:
+            with self.assertRaises(LsmError) as cm:
+                with other.slot(_TestPluginScheduler._KEY, 'job_status', 0.2):
+                    pass
+            self.assertEqual(cm.exception.code, ErrorNumber.TIMEOUT)
+        finally:
+            release0.set()
+            t0.join()
+        for name in os.listdir(self.lock_dir):
+            self.assertEqual(
+                os.stat(os.path.join(self.lock_dir, name)).st_mode & 0o777,
+                0o600)
+
+    def test_unsafe_lock_dir(self):
+        os.chmod(self.lock_dir, 0o777)
+        scheduler = PluginScheduler(1, self.lock_dir)
+        with scheduler.slot(_TestPluginScheduler._KEY, 'volumes', 0.2):
+            pass
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+    def test_stats(self):
+        scheduler = PluginScheduler(1, self.lock_dir)
+        for _ in range(3):
+            with scheduler.slot(_TestPluginScheduler._KEY, 'volumes', 1):
+                pass
+        # Not scheduled
+        with scheduler.slot(_TestPluginScheduler._KEY, 'plugin_info', 1):
+            pass
+        stats = scheduler.stats()[_TestPluginScheduler._KEY]
+        self.assertEqual(stats['admitted'], 3)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['max_queue_depth'], 1)
+        self.assertTrue(stats['wait_time_max'] >= 0)
+
+        logged = []
+        orig_info = globals()['info']
+        globals()['info'] = logged.append
+        try:
+            scheduler.log_stats()
+        finally:
+            globals()['info'] = orig_info
+        self.assertEqual(len(logged), 1)
+        self.assertTrue('3 requests admitted' in logged[0])
+
+    def test_key_of_uri(self):
+        key_of_uri = PluginScheduler.key_of_uri
+        self.assertEqual(key_of_uri('smispy+ssl://admin@emc-smi:5989'),
+                         key_of_uri('smispy+ssl://root@emc-smi:5989'))
+        self.assertEqual(key_of_uri('ontap://root@filer'), 'filer:')
+        self.assertNotEqual(key_of_uri('sim://?statefile=/tmp/a.db'),
+                            key_of_uri('sim://?statefile=/tmp/b.db'))
+        self.assertEqual(key_of_uri('sim://'), 'sim://')
+        with self.assertRaises(LsmError) as cm:
+            key_of_uri('smispy://array:port')
+        self.assertEqual(cm.exception.code, ErrorNumber.INVALID_ARGUMENT)
+
+    def test_max_concurrent_of_env(self):
+        orig = os.environ.pop('LSM_PLUGIN_MAX_CONCURRENT', None)
+        try:
+            self.assertEqual(PluginRunner._max_concurrent_of_env(), 0)
+            for (val, expected) in (('4', 4), ('-1', 0), ('four', 0)):
+                os.environ['LSM_PLUGIN_MAX_CONCURRENT'] = val
+                self.assertEqual(PluginRunner._max_concurrent_of_env(),
+                                 expected)
+        finally:
+            os.environ.pop('LSM_PLUGIN_MAX_CONCURRENT', None)
+            if orig is not None:
+                os.environ['LSM_PLUGIN_MAX_CONCURRENT'] = orig
+
+
+if __name__ == "__main__":
+    unittest.main()
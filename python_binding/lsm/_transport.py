@@ -20,6 +20,7 @@
 import os
 import unittest
 import threading
+import time
 
 from lsm._common import LsmError, ErrorNumber
 from lsm._common import SocketEOF as _SocketEOF
@@ -38,14 +39,24 @@ class TransPort(object):
     Notes:
     id field (json-rpc) is present but currently not being used.
     This is available to be expanded on later.
+
+    When 'deadline_ms' is set, it travels with each request so the plug-in
+    can abort work the client is no longer waiting for.  The client side
+    gives up 'TIMEOUT_GRACE_MS' later, cancels the request and skips the
+    reply when it finally arrives.
     """
 
     HDR_LEN = 10
 
-    def _read_all(self, l):
+    CANCEL_METHOD = 'request_cancel'
+    TIMEOUT_GRACE_MS = 5000
+
+    def _read_all(self, l, allow_timeout=False):
         """
         Reads l number of bytes before returning.  Will raise a SocketEOF
         if socket returns zero bytes (i.e. socket no longer connected)
+        Socket timeout is only raised when allow_timeout is True and nothing
+        has been read yet, so a message is never left half read.
         """
 
         if l < 1:
@@ -53,7 +64,12 @@ def _read_all(self, l):
 
         data = bytearray()
         while len(data) < l:
-            r = self.s.recv(l - len(data))
+            try:
+                r = self.s.recv(l - len(data))
+            except socket.timeout:
+                if allow_timeout and len(data) == 0:
+                    raise
+                continue
             if not r:
                 raise _SocketEOF()
             data += r
@@ -72,7 +88,8 @@ def _send_msg(self, msg):
         # Note: Don't catch io exceptions at this level!
         s = str.zfill(str(len(msg)), self.HDR_LEN) + msg
         # common.Info("SEND: ", msg)
-        self.s.sendall(bytes(s.encode('utf-8')))
+        with self._send_lock:
+            self.s.sendall(bytes(s.encode('utf-8')))
 
     def _recv_msg(self):
         """
@@ -80,9 +97,11 @@ def _recv_msg(self):
         bytes of the message.
         """
         try:
-            l = self._read_all(self.HDR_LEN)
+            l = self._read_all(self.HDR_LEN, allow_timeout=True)
             msg = self._read_all(int(l))
             # common.Info("RECV: ", msg)
+        except socket.timeout:
+            raise
         except socket.error as e:
             raise LsmError(ErrorNumber.TRANSPORT_COMMUNICATION,
                            "Error while reading a message from the plug-in",
@@ -91,6 +110,13 @@ def _recv_msg(self):
 
     def __init__(self, socket_descriptor):
         self.s = socket_descriptor
+        self.deadline_ms = None
+        self._send_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._in_flight = False
+        # Replies of abandoned or cancel requests still to be skipped.
+        self._stale_replies = 0
+        self._stale_after_current = 0
 
     @staticmethod
     def get_socket(path):
@@ -122,7 +148,7 @@ def close(self):
         """
         self.s.close()
 
-    def send_req(self, method, args):
+    def send_req(self, method, args, deadline_ms=None):
         """
         Sends a request given a method and arguments.
         Note: arguments must be in the form that can be automatically
@@ -130,6 +156,8 @@ def send_req(self, method, args):
         """
         try:
             msg = {'method': method, 'id': 100, 'params': args}
+            if deadline_ms:
+                msg['deadline_ms'] = deadline_ms
             data = json.dumps(msg, cls=_DataEncoder)
             self._send_msg(data)
         except socket.error as se:
@@ -150,11 +178,56 @@ def rpc(self, method, args):
         """
         Sends a request and waits for a response.
         """
-        self.send_req(method, args)
-        (reply, msg_id) = self.read_resp()
+        with self._state_lock:
+            self.send_req(method, args, self.deadline_ms)
+            self._in_flight = True
+        try:
+            if self.deadline_ms:
+                self.s.settimeout(
+                    (self.deadline_ms + self.TIMEOUT_GRACE_MS) / 1000.0)
+
+            while True:
+                with self._state_lock:
+                    if self._stale_replies == 0:
+                        break
+                self._recv_msg()
+                with self._state_lock:
+                    self._stale_replies -= 1
+
+            (reply, msg_id) = self.read_resp()
+        except socket.timeout:
+            # Ask the plug-in to stop working for us, and skip both the reply
+            # of this request and of the cancel request once they arrive.
+            self.cancel()
+            with self._state_lock:
+                self._stale_after_current += 1
+            raise LsmError(ErrorNumber.TIMEOUT,
+                           "Plug-in failed to reply to %s() in %d ms" %
+                           (method, self.deadline_ms))
+        finally:
+            with self._state_lock:
+                self._in_flight = False
+                self._stale_replies += self._stale_after_current
+                self._stale_after_current = 0
+            if self.deadline_ms:
+                self.s.settimeout(None)
         assert msg_id == 100
         return reply
 
+    def cancel(self):
+        """
+        Asks the plug-in to abort the request it is working on.  Can be
+        called from another thread while rpc() is waiting.  The plug-in
+        replies to the cancel request itself after the reply of the
+        cancelled request, that reply is skipped by the next rpc().
+        """
+        with self._state_lock:
+            self.send_req(TransPort.CANCEL_METHOD, None)
+            if self._in_flight:
+                self._stale_after_current += 1
+            else:
+                self._stale_replies += 1
+
     def send_error(self, msg_id, error_code, msg, data=None):
         """
         Used to transmit an error.
@@ -197,6 +270,9 @@ def _server(s):
                     msg['id'],
                     msg['params']['errorcode'],
                     msg['params']['errormsg'])
+            elif msg['method'] == 'sleep':
+                time.sleep(msg['params'])
+                srv.send_resp(msg.get('deadline_ms'))
             else:
                 srv.send_resp(msg['params'])
             msg = srv.read_req()
@@ -240,6 +316,24 @@ def test_exceptions(self):
             self.assertTrue(e.code == e_code)
             self.assertTrue(e.msg == e_msg)
 
+    def test_timeout(self):
+        self.client.deadline_ms = 50
+        self.client.TIMEOUT_GRACE_MS = 0
+
+        try:
+            self.client.rpc('sleep', 0.5)
+            self.assertTrue(False)
+        except LsmError as e:
+            self.assertTrue(e.code == ErrorNumber.TIMEOUT)
+
+        # Late replies of the timed out and the cancel request are skipped
+        self.client.deadline_ms = None
+        self.assertTrue(self.client.rpc('test', 'next') == 'next')
+
+        self.client.deadline_ms = 50
+        self.assertTrue(self.client.rpc('sleep', 0) == 50)
+        self.client.deadline_ms = None
+
     def test_slow(self):
 
         # Try to test the receiver getting small chunks to read